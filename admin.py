@@ -299,6 +299,91 @@ class SupporterAdmin(admin.ModelAdmin):
         return files.serve_temp_file(filepath, filename)
 
 
+class IndicatorObservationAdmin(admin.ModelAdmin):
+    list_display = (
+        'indicator',
+        'country',
+        'year',
+        'value',
+    )
+    list_filter = (
+        'indicator',
+        'year',
+    )
+    search_fields = (
+        'country',
+    )
+
+    # Observations come from World Bank datasets, and fees are
+    # calculated from the snapshot built from them, so an edit here
+    # would show a value that fees never use
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class IndicatorDatasetAdmin(admin.ModelAdmin):
+    list_display = (
+        'indicator',
+        'year',
+        'updated',
+        'checked',
+        'content_hash',
+    )
+    list_filter = (
+        'indicator',
+        'year',
+    )
+    readonly_fields = (
+        'content_hash',
+    )
+
+
+class FeeQuoteAdmin(admin.ModelAdmin):
+    list_display = (
+        'size',
+        'level',
+        'country',
+        'currency',
+        'fee',
+        'built',
+    )
+    list_filter = (
+        'size',
+        'level',
+        'currency',
+    )
+    search_fields = (
+        'country',
+    )
+
+
+class RecalculationRunAdmin(admin.ModelAdmin):
+    list_display = (
+        'pk',
+        'status',
+        'started',
+        'updated',
+        'processed',
+        'total',
+        'last_supporter_id',
+        'save_fees',
+    )
+    list_filter = (
+        'status',
+        'save_fees',
+    )
+    readonly_fields = (
+        'processed',
+        'last_supporter_id',
+    )
+
+
 admin_list = [
     (models.BillingAgent, BillingAgentAdmin),
     (models.SupporterSize, SupporterSizeAdmin),
@@ -306,6 +391,10 @@ admin_list = [
     (models.Currency, CurrencyAdmin),
     (models.Band, BandAdmin),
     (models.Supporter, SupporterAdmin),
+    (models.IndicatorObservation, IndicatorObservationAdmin),
+    (models.IndicatorDataset, IndicatorDatasetAdmin),
+    (models.FeeQuote, FeeQuoteAdmin),
+    (models.RecalculationRun, RecalculationRunAdmin),
 ]
 
 
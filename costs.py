@@ -0,0 +1,182 @@
+__copyright__ = "Copyright 2023 Birkbeck, University of London"
+__author__ = "Open Library of Humanities"
+__license__ = "AGPL v3"
+__maintainer__ = "Open Library of Humanities"
+
+import collections
+import contextlib
+import contextvars
+import functools
+import time
+
+from django.core.cache import cache
+from django.db import connection
+
+from plugins.consortial_billing import utils
+
+
+COSTS_CACHE_KEY = 'consortial_billing_fee_costs'
+COST_FIELDS = ['queries', 'media_file_opens', 'json_parses', 'ms']
+
+cost_scope = contextvars.ContextVar('consortial_billing_costs', default=None)
+
+
+class QueryCounter:
+    """
+    Counts database queries when installed with connection.execute_wrapper
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextlib.contextmanager
+def cost_context(endpoint):
+    """
+    Within this context, the costs of functions decorated with
+    measure are added up under the endpoint name, and saved to the
+    cache at the end. Use it around a request or a management
+    command; it also works as a view decorator.
+    A nested context adds to the totals of the outer one.
+    """
+    if cost_scope.get() is not None:
+        yield
+        return
+    totals = collections.defaultdict(collections.Counter)
+    token = cost_scope.set(totals)
+    try:
+        yield
+    finally:
+        cost_scope.reset(token)
+        if totals:
+            record_costs(endpoint, totals)
+
+
+def measure(operation):
+    """
+    Records the queries, media file opens, JSON parses and
+    milliseconds that each call costs, within a cost_context.
+    Outside a cost context, the function is called as normal.
+    """
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            totals = cost_scope.get()
+            if totals is None:
+                return function(*args, **kwargs)
+            counters_before = utils.io_counters.copy()
+            queries = QueryCounter()
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(queries):
+                    return function(*args, **kwargs)
+            finally:
+                ms = (time.perf_counter() - start) * 1000
+                counters = utils.io_counters - counters_before
+                totals[operation].update({
+                    'calls': 1,
+                    'queries': queries.count,
+                    'media_file_opens': counters['media_file_opens'],
+                    'json_parses': counters['json_parses'],
+                    'ms': ms,
+                })
+                totals[operation]['max_ms'] = max(
+                    totals[operation]['max_ms'],
+                    ms,
+                )
+        return wrapper
+    return decorator
+
+
+def counter_key(endpoint, operation, field):
+    return f'{COSTS_CACHE_KEY}:{endpoint}:{operation}:{field}'
+
+
+def increment(key, delta):
+    """
+    Adds delta to an integer counter in the cache without
+    a read-modify-write, so concurrent workers do not lose counts
+    """
+    if not delta:
+        return
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # The key was evicted between add and incr
+        cache.set(key, delta, None)
+
+
+def record_costs(endpoint, totals):
+    """
+    Adds the totals from one cost context to the saved summary.
+    Each counter has its own cache key, and milliseconds are
+    counted as whole microseconds, so that cache.incr can be used.
+    The maximum is best-effort, since the cache has no atomic max.
+    """
+    # The index of endpoints and operations is checked every time,
+    # so a pair lost to a concurrent write is added back next time
+    index = set(cache.get(COSTS_CACHE_KEY) or [])
+    if not index.issuperset((endpoint, operation) for operation in totals):
+        index.update((endpoint, operation) for operation in totals)
+        cache.set(COSTS_CACHE_KEY, sorted(index), None)
+    for operation, counts in totals.items():
+        increment(counter_key(endpoint, operation, 'calls'), counts['calls'])
+        for field in COST_FIELDS:
+            value = counts[field]
+            if field == 'ms':
+                field, value = 'us', round(value * 1000)
+            increment(counter_key(endpoint, operation, field), value)
+        max_us = round(counts['max_ms'] * 1000)
+        max_key = counter_key(endpoint, operation, 'max_us')
+        if max_us > (cache.get(max_key) or 0):
+            cache.set(max_key, max_us, None)
+
+
+def get_saved_counts(endpoint, operation):
+    fields = ['calls', 'max_us'] + [
+        'us' if field == 'ms' else field for field in COST_FIELDS
+    ]
+    keys = {counter_key(endpoint, operation, field): field for field in fields}
+    saved = cache.get_many(keys)
+    counts = {field: saved.get(key, 0) for key, field in keys.items()}
+    counts['ms'] = counts.pop('us') / 1000
+    counts['max_ms'] = counts.pop('max_us') / 1000
+    return counts
+
+
+def get_cost_summary():
+    """
+    Gets the saved costs with the average cost of a call
+    :return: list of dicts sorted by endpoint and operation
+    """
+    rows = []
+    for endpoint, operation in sorted(cache.get(COSTS_CACHE_KEY) or []):
+        counts = get_saved_counts(endpoint, operation)
+        calls = counts['calls'] or 1
+        row = {
+            'endpoint': endpoint,
+            'operation': operation,
+            'calls': counts['calls'],
+            'max_ms': round(counts['max_ms'], 3),
+        }
+        for field in COST_FIELDS:
+            row[field] = round(counts[field], 3)
+            row[f'{field}_per_call'] = round(counts[field] / calls, 3)
+        rows.append(row)
+    return rows
+
+
+def clear_costs():
+    keys = [COSTS_CACHE_KEY]
+    for endpoint, operation in cache.get(COSTS_CACHE_KEY) or []:
+        keys.extend(
+            counter_key(endpoint, operation, field)
+            for field in ['calls', 'us', 'max_us'] + COST_FIELDS
+        )
+    cache.delete_many(keys)
@@ -1,7 +1,9 @@
 from django import forms
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 
-from plugins.consortial_billing import models as supporter_models, logic
+from plugins.consortial_billing import models as supporter_models, logic, \
+    costs
 
 
 class BaseBandForm(forms.ModelForm):
@@ -15,13 +17,19 @@ class BaseBandForm(forms.ModelForm):
             'level',
         ]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, fee_calculator=None, **kwargs):
+        """
+        :fee_calculator: a logic.FeeCalculator to use instead of
+                         Band.calculate_fee, when saving many bands
+        """
         super().__init__(*args, **kwargs)
+        self.fee_calculator = fee_calculator
         self.fields['country'].required = True
         self.fields['currency'].required = True
         self.fields['size'].required = True
         self.fields['level'].required = True
 
+    @costs.measure('base_band_form_save')
     def save(self, commit=True):
         """
         Populates a band object matching the form input.
@@ -34,25 +42,78 @@ class BaseBandForm(forms.ModelForm):
 
         if band.category == 'calculated':
             # For calculated bands, we try to avoid duplicates to make management easier
-            band.fee, band.warnings = band.calculate_fee()
-            matches = supporter_models.Band.objects.filter(
-                level=band.level,
-                size=band.size,
-                country=band.country,
-                currency=band.currency,
-                billing_agent=band.billing_agent,
-                category=band.category,
-                fee=band.fee,
-                warnings=band.warnings,
-                datetime__year=timezone.now().year,
-            )
-            if matches:
-                band = matches.latest()
+            dependency_fingerprint = ''
+            quote = None
+            if not self.fee_calculator:
+                quote = logic.get_fee_quote(
+                    band.size,
+                    band.level,
+                    band.country,
+                    band.currency,
+                )
+            if quote:
+                band.fee, band.warnings = quote
+            elif self.fee_calculator:
+                band.fee, band.warnings = self.fee_calculator.calculate(
+                    band.size,
+                    band.level,
+                    band.country,
+                    band.currency,
+                )
+                dependency_fingerprint = \
+                    self.fee_calculator.dependency_fingerprint(
+                        band.size,
+                        band.level,
+                        band.country,
+                        band.currency,
+                    )
+            else:
+                band.fee, band.warnings = band.calculate_fee()
+
+            if commit:
+                match = self.get_matching_band(band)
+                if dependency_fingerprint:
+                    match.dependency_fingerprint = dependency_fingerprint
+                try:
+                    with transaction.atomic():
+                        match.save(claim_fingerprint=True)
+                except IntegrityError:
+                    # Another request saved the same band since the lookup
+                    with transaction.atomic():
+                        match = self.get_matching_band(band, lock=True)
+                        if not match.pk:
+                            raise
+                        if dependency_fingerprint:
+                            match.dependency_fingerprint = \
+                                dependency_fingerprint
+                            match.save()
+                return match
+
+            band = self.get_matching_band(band)
+            if dependency_fingerprint:
+                band.dependency_fingerprint = dependency_fingerprint
 
         if commit:
             band.save()
         return band
 
+    @staticmethod
+    def get_matching_band(band, lock=False):
+        """
+        Finds a calculated band from this year with the same inputs
+        and fee, via the unique year and fingerprint
+        :lock: whether to read with select_for_update, which also
+               sees rows committed after a repeatable read snapshot
+        :return: the match, or the band passed in if none
+        """
+        matches = supporter_models.Band.objects.filter(
+            year=timezone.localtime().year,
+            fingerprint=band.get_fingerprint(),
+        )
+        if lock:
+            matches = matches.select_for_update()
+        return matches.first() or band
+
 
 class BandForm(BaseBandForm):
 
@@ -5,15 +5,23 @@ __maintainer__ = "Open Library of Humanities"
 
 import os
 import decimal
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple
 
 from django.utils import timezone
 from django.conf import settings
-from django.db.models import Sum, Q
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Sum, Min
+from django_countries import countries
+from django_countries.fields import Country
 
 from core import models as core_models
 from cms import models as cms_models
-from plugins.consortial_billing import utils, models as supporter_models, plugin_settings
+from plugins.consortial_billing import utils, memo, models as supporter_models, plugin_settings
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -108,17 +116,63 @@ def get_indicator_by_country(
         indicator: str,
         year: int
     ) -> dict[str, decimal.Decimal]:
-    data = utils.open_saved_world_bank_data(indicator, year)
-    # The next few lines are written defensively because of the variation
-    # in the JSON received from the World Bank API.
-    if not data:
-        return {}
-    _metadata, country_records = data
-    if not country_records:
-        return {}
-    return {each['countryiso3code']: each['value'] for each in country_records}
+    """
+    Gets indicator values by country code, via the per-process cache
+    """
+    return utils.indicator_cache.get(
+        indicator,
+        year,
+        read_indicator_by_country,
+    )
+
+
+def read_indicator_by_country(
+        indicator: str,
+        year: int
+    ) -> dict[str, decimal.Decimal]:
+    snapshot = utils.get_indicator_snapshot()
+    if snapshot and (indicator, year) in snapshot.datasets:
+        return snapshot.values(indicator, year)
+
+    observations = supporter_models.IndicatorObservation.objects.filter(
+        indicator=indicator,
+        year=year,
+    ).values_list('country', 'value')
+    if observations:
+        return dict(observations)
+
+    # Fall back to the saved file for data that was
+    # fetched before observations were stored separately
+    return utils.open_saved_indicator_values(indicator, year)
+
+
+def get_latest_indicator_values(
+        indicator: str,
+    ) -> dict[str, Tuple[int, decimal.Decimal]]:
+    """
+    Gets the year and value of the latest data for each country,
+    via the per-process cache
+    """
+    return utils.indicator_cache.get(
+        indicator,
+        None,
+        read_latest_indicator_values,
+    )
+
+
+def read_latest_indicator_values(
+        indicator: str,
+        _year=None,
+    ) -> dict[str, Tuple[int, decimal.Decimal]]:
+    latest_values = supporter_models.LatestIndicatorValue.objects.filter(
+        indicator=indicator,
+    ).values_list('country', 'year', 'value')
+    return {
+        country: (year, value) for country, year, value in latest_values
+    }
 
 
+@memo.memoize
 def countries_with_billing_agents():
     return {
         a.country for a in supporter_models.BillingAgent.objects.filter(
@@ -127,54 +181,130 @@ def countries_with_billing_agents():
     }
 
 
-def get_base_band(level=None, country=None):
-    bases = supporter_models.Band.objects.filter(category='base')
-    query = Q()
-
-    # Check if there is a base for this country on each level.
-    # If so, filter by the country. If not, exclude bands
-    # that fall under a country-specific billing agent.
-    bases_for_country = bases.all().filter(country=country).count()
-    num_levels = supporter_models.SupportLevel.objects.count()
-    agent_countries = countries_with_billing_agents()
-    if country in agent_countries and bases_for_country == num_levels:
-        query &= Q(country=country)
-    else:
-        query &= ~Q(country__in=agent_countries)
-
-    # Check if there is a base on this level for each country
-    # (plus one for the default: no country).
-    # If so, filter by the level.
-    level = level or utils.get_standard_support_level()
-    bases_on_level = bases.all().filter(level=level).count()
-    if level and bases_on_level == len(agent_countries) + 1:
-        query &= Q(level=level)
+class BaseBandResolver:
+    """
+    Answers get_base_band for any level and country from one load
+    of the base bands, support levels and billing agent countries,
+    using the same rules as the queries it replaces.
+    A resolver can be kept for a batch or a request, but it will not
+    see changes made to the configuration after it was created.
+    """
 
-    try:
-        return bases.filter(query).latest()
-    except supporter_models.Band.DoesNotExist:
-        logger.warning('No base band found for parameters ' + str(query))
-        try:
-            return bases.latest()
-        except supporter_models.Band.DoesNotExist:
-            logger.warning('No base bands found.')
+    def __init__(self):
+        self.bases = list(
+            supporter_models.Band.objects.filter(
+                category='base',
+            ).select_related(
+                'size', 'currency', 'level', 'billing_agent',
+            )
+        )
+        self.levels = list(supporter_models.SupportLevel.objects.all())
+        self.agent_countries = countries_with_billing_agents()
+        self.agent_codes = {
+            self.country_code(country) for country in self.agent_countries
+        }
+        self.resolved = {}
+        self._standard_level = None
+
+    @staticmethod
+    def country_code(country):
+        return getattr(country, 'code', country)
+
+    @staticmethod
+    def latest(bands):
+        return max(bands, key=lambda band: (band.datetime, band.pk))
+
+    @property
+    def standard_level(self):
+        """
+        The same level as utils.get_standard_support_level
+        """
+        if not self._standard_level:
+            defaults = [level for level in self.levels if level.default]
+            if len(defaults) > 1:
+                raise supporter_models.SupportLevel.MultipleObjectsReturned(
+                    'More than one default support level found.'
+                )
+            elif defaults:
+                self._standard_level = defaults[0]
+            elif self.levels:
+                logger.error(
+                    'No default support level found. '
+                    'Using the support level ordered last, '
+                    'but that may produce unintended results. '
+                    'For best results, set a level as the default.'
+                )
+                self._standard_level = self.levels[-1]
+        return self._standard_level
 
+    def get_base_band(self, level=None, country=None):
+        key = (level.pk if level else None, self.country_code(country))
+        if key not in self.resolved:
+            self.resolved[key] = self.resolve(level, country)
+        return self.resolved[key]
 
-def get_base_bands():
+    def resolve(self, level, country):
+        code = self.country_code(country)
+        bases = self.bases
+
+        # Check if there is a base for this country on each level.
+        # If so, filter by the country. If not, exclude bands
+        # that fall under a country-specific billing agent.
+        bases_for_country = [
+            base for base in bases if self.country_code(base.country) == code
+        ]
+        if code in self.agent_codes and \
+                len(bases_for_country) == len(self.levels):
+            matches = bases_for_country
+        else:
+            matches = [
+                base for base in bases
+                if self.country_code(base.country) not in self.agent_codes
+            ]
+
+        # Check if there is a base on this level for each country
+        # (plus one for the default: no country).
+        # If so, filter by the level.
+        level = level or self.standard_level
+        level_pk = level.pk if level else None
+        bases_on_level = [base for base in bases if base.level_id == level_pk]
+        if level and len(bases_on_level) == len(self.agent_countries) + 1:
+            matches = [base for base in matches if base.level_id == level_pk]
+
+        if matches:
+            return self.latest(matches)
+        logger.warning(
+            f'No base band found for level {level} and country {country}'
+        )
+        if bases:
+            return self.latest(bases)
+        logger.warning('No base bands found.')
+
+
+def get_base_band(level=None, country=None, resolver=None):
+    """
+    :resolver: a BaseBandResolver to reuse, e.g. across a batch
+    """
+    resolver = resolver or BaseBandResolver()
+    return resolver.get_base_band(level=level, country=country)
+
+
+def get_base_bands(resolver=None):
     # We create the result set this crude way to avoid being
     # reliant on postgreSQL for order_by + distinct.
     base_bands = set()
+    resolver = resolver or BaseBandResolver()
     # Get any country-specific base bands (by billing agent)
-    for country in countries_with_billing_agents():
-        for level in supporter_models.SupportLevel.objects.all():
-            band = get_base_band(level=level, country=country)
+    for country in resolver.agent_countries:
+        for level in resolver.levels:
+            band = resolver.get_base_band(level=level, country=country)
             if band:
                 base_bands.add(band)
             else:
                 logger.warning(f'Missing base band for level {level} in country {country}')
     # Get non-country-specific base bands
-    for level in supporter_models.SupportLevel.objects.all():
-        band = get_base_band(level=level, country=None)
+    for level in resolver.levels:
+        band = resolver.get_base_band(level=level, country=None)
         if band:
             base_bands.add(band)
     return base_bands
@@ -204,8 +334,38 @@ def latest_multiplier_for_indicator(
         warning = ''
         return multiplier, warning
 
+    years = last_five_years()
+
+    # The shared snapshot answers without any database or file work
+    snapshot = utils.get_indicator_snapshot()
+    if snapshot and indicator in snapshot.indicators:
+        base_improperly_configured = 0
+        for year in reversed(years):
+            base_value = snapshot.value(indicator, year, base_key)
+            measure_value = snapshot.value(indicator, year, measure_key)
+            if not base_value:
+                base_improperly_configured += 1
+            elif measure_value:
+                multiplier = measure_value / base_value
+                warning = ''
+                return multiplier, warning
+        if base_improperly_configured == 5:
+            log_missing_base_key(indicator, base_key)
+        return multiplier, warning
+
+    # When the latest data for both keys is from the same recent year,
+    # the precomputed index gives the same answer as the loop below
+    latest_values = get_latest_indicator_values(indicator)
+    if measure_key in latest_values and base_key in latest_values:
+        measure_year, measure_value = latest_values[measure_key]
+        base_year, base_value = latest_values[base_key]
+        if measure_year == base_year and measure_year in years:
+            multiplier = measure_value / base_value
+            warning = ''
+            return multiplier, warning
+
     base_improperly_configured = 0
-    for year in reversed(last_five_years()):
+    for year in reversed(years):
         data = get_indicator_by_country(indicator, year)
         if base_key not in data or not data[base_key]:
             base_improperly_configured += 1
@@ -215,15 +375,667 @@ def latest_multiplier_for_indicator(
             return multiplier, warning
 
     if base_improperly_configured == 5:
-        logger.error(
-            f'{base_key} not found in the data for indicator {indicator}. '
-            f'World Bank data may be missing or the base band '
-            f'may not be properly configured.'
-        )
+        log_missing_base_key(indicator, base_key)
 
     return multiplier, warning
 
 
+def log_missing_base_key(indicator, base_key):
+    logger.error(
+        f'{base_key} not found in the data for indicator {indicator}. '
+        f'World Bank data may be missing or the base band '
+        f'may not be properly configured.'
+    )
+
+
+class MultiplierMatrix:
+    """
+    Economic disparity and exchange rate multipliers for every country
+    and currency against every base band, worked out together from
+    one read of the last five years of data.
+    Lookups give the same multipliers and warnings as
+    Band.economic_disparity and Currency.exchange_rate,
+    so bulk callers can use them instead of deriving each one per band.
+    Base bands that were not known when the matrix was built
+    are worked out the first time they are looked up.
+    """
+
+    def __init__(self, base_bands=None, resolver=None):
+        self.resolver = resolver
+        self.years = last_five_years()
+        self.disparity_warning = utils.setting(
+            'missing_data_economic_disparity'
+        )
+        self.rate_warning = utils.setting('missing_data_exchange_rate')
+        self.columns = {
+            indicator: self.read_columns(indicator)
+            for indicator in [
+                plugin_settings.DISPARITY_INDICATOR,
+                plugin_settings.RATE_INDICATOR,
+            ]
+        }
+        self.measure_keys = {
+            plugin_settings.DISPARITY_INDICATOR: [
+                countries.alpha3(code) for code, _name in countries
+            ],
+            plugin_settings.RATE_INDICATOR: list(
+                supporter_models.Currency.objects.values_list(
+                    'region',
+                    flat=True,
+                ).distinct()
+            ),
+        }
+        self.rows = {}
+        self._default_base_band = None
+
+        if base_bands is None:
+            base_bands = get_base_bands(resolver=resolver)
+        for base_band in base_bands:
+            self.row(
+                plugin_settings.DISPARITY_INDICATOR,
+                base_band.country.alpha3,
+            )
+            self.row(
+                plugin_settings.RATE_INDICATOR,
+                base_band.currency.region,
+            )
+
+    def read_columns(self, indicator):
+        """
+        :return: dict of keys and their values for each year, newest first,
+                 with None for missing or zero values
+        """
+        years = list(reversed(self.years))
+        columns = {}
+        for position, year in enumerate(years):
+            data = get_indicator_by_country(indicator, year)
+            for key, value in data.items():
+                column = columns.setdefault(key, [None] * len(years))
+                column[position] = value or None
+        return columns
+
+    def row(self, indicator, base_key):
+        """
+        Works out the multipliers for all known keys against one base key
+        :return: dict of measure keys and multipliers,
+                 with None where no year has data for both keys
+        """
+        if (indicator, base_key) not in self.rows:
+            base_column = self.columns[indicator].get(base_key)
+            self.rows[(indicator, base_key)] = {
+                measure_key: self.first_ratio(
+                    self.columns[indicator].get(measure_key),
+                    base_column,
+                ) for measure_key in self.measure_keys[indicator]
+            }
+        return self.rows[(indicator, base_key)]
+
+    @staticmethod
+    def first_ratio(measure_column, base_column):
+        if not measure_column or not base_column:
+            return None
+        for measure_value, base_value in zip(measure_column, base_column):
+            if measure_value and base_value:
+                return measure_value / base_value
+        return None
+
+    def multiplier(self, indicator, measure_key, base_key, warning):
+        """
+        Looks up a multiplier with the same result
+        as latest_multiplier_for_indicator
+        """
+        if base_key == '---':
+            # The plugin is being configured
+            # via the admin interface
+            return decimal.Decimal(1), ''
+
+        row = self.row(indicator, base_key)
+        if measure_key not in row:
+            row[measure_key] = self.first_ratio(
+                self.columns[indicator].get(measure_key),
+                self.columns[indicator].get(base_key),
+            )
+        if row[measure_key] is not None:
+            return row[measure_key], ''
+
+        if not any(self.columns[indicator].get(base_key) or []):
+            log_missing_base_key(indicator, base_key)
+        return decimal.Decimal(1), warning
+
+    @property
+    def default_base_band(self):
+        if not self._default_base_band:
+            self._default_base_band = get_base_band(resolver=self.resolver)
+        return self._default_base_band
+
+    def disparity(self, country, base_band):
+        """
+        :country: the band country, as a Country or country code
+        :base_band: the base band for the band's level and country
+        :return: tuple as from Band.economic_disparity
+        """
+        return self.multiplier(
+            plugin_settings.DISPARITY_INDICATOR,
+            Country(code=str(country)).alpha3,
+            base_band.country.alpha3,
+            self.disparity_warning,
+        )
+
+    def exchange_rate(self, currency, base_band=None):
+        """
+        :currency: Currency
+        :base_band: the base band, or None for the default one
+        :return: tuple as from Currency.exchange_rate
+        """
+        base_band = base_band or self.default_base_band
+        return self.multiplier(
+            plugin_settings.RATE_INDICATOR,
+            currency.region,
+            base_band.currency.region if base_band else '---',
+            self.rate_warning,
+        )
+
+
+class ExchangeRateMatrix:
+    """
+    Conversion factors between every pair of currencies, built
+    from one exchange_rate call per currency, so that each
+    conversion is a dict lookup. Use get_exchange_rate_matrix
+    to get one for the current configuration version.
+    """
+
+    def __init__(self, currencies=None):
+        if currencies is None:
+            currencies = supporter_models.Currency.objects.all()
+        rates = {}
+        for currency in currencies:
+            rates[currency.code], _warning = currency.exchange_rate()
+        self.factors = {
+            (origin, target): target_rate / origin_rate
+            for origin, origin_rate in rates.items()
+            for target, target_rate in rates.items()
+        }
+
+    def factor(self, origin_currency, target_currency):
+        """
+        :return: what one unit of the origin currency is worth
+                 in the target currency, as decimal.Decimal
+        """
+        return self.factors[(
+            getattr(origin_currency, 'code', origin_currency),
+            getattr(target_currency, 'code', target_currency),
+        )]
+
+    def convert(self, value, origin_currency, target_currency):
+        return value * self.factor(origin_currency, target_currency)
+
+
+exchange_rate_matrices = {}
+
+
+def get_exchange_rate_matrix():
+    """
+    Gets the exchange rate matrix for the current configuration
+    version, building it if base bands, currencies or rate data
+    have changed since the last one was built
+    :return: ExchangeRateMatrix
+    """
+    version = utils.get_configuration_version()
+    if version not in exchange_rate_matrices:
+        exchange_rate_matrices.clear()
+        exchange_rate_matrices[version] = ExchangeRateMatrix()
+    return exchange_rate_matrices[version]
+
+
+# The calculator each worker process inherits from
+# FeeCalculator.calculate_in_processes
+worker_fee_calculator = None
+
+
+class WorkerQueryBlocker:
+    """
+    Stops a worker process from using a database connection
+    it shares with its parent
+    """
+
+    def __call__(self, execute, sql, params, many, context):
+        raise DatabaseError('Fee workers cannot query the database')
+
+
+def start_fee_worker(fee_calculator):
+    global worker_fee_calculator
+    worker_fee_calculator = fee_calculator
+    for connection in connections.all():
+        connection.execute_wrappers.append(WorkerQueryBlocker())
+
+
+def calculate_fee_chunk(band_tuples):
+    """
+    :return: dict of FeeCalculator keys and (fee, warnings) tuples
+    """
+    results = {}
+    for band_tuple in band_tuples:
+        try:
+            key = worker_fee_calculator.key(*band_tuple)
+            results[key] = worker_fee_calculator.calculate(*band_tuple)
+        except Exception as e:
+            # Left for the parent, which will raise or report it
+            logger.debug(f'Fee worker skipped {band_tuple}: {e}')
+    return results
+
+
+def to_fixed_point(value):
+    """
+    :value: int or decimal.Decimal
+    :return: tuple of an int mantissa and a power of ten
+             that give exactly the same value,
+             or None if the value is not finite
+    """
+    value = decimal.Decimal(value)
+    if not value.is_finite():
+        return None
+    sign, digits, exponent = value.as_tuple()
+    mantissa = int(''.join(str(digit) for digit in digits))
+    return -mantissa if sign else mantissa, exponent
+
+
+def round_fixed_point_to_ten(mantissa, exponent):
+    """
+    Rounds mantissa * 10 ** exponent to the nearest ten,
+    with halves going to even as round(fee, -1) does.
+    The Decimal path rounds each product to the context precision,
+    so values this close to a halfway point are left to it.
+    :return: int, or None if the result could differ from the Decimal path
+    """
+    context = decimal.getcontext()
+    if context.rounding != decimal.ROUND_HALF_EVEN:
+        return None
+    sign = -1 if mantissa < 0 else 1
+    mantissa = abs(mantissa)
+    shift = 1 - exponent
+    if shift <= 0:
+        return sign * mantissa * 10 ** exponent
+    divisor = 10 ** shift
+    tens, remainder = divmod(mantissa, divisor)
+
+    # Three products rounded to prec digits can be out by less than
+    # one part in 10 ** (prec - 2), so stay clear of the halfway point
+    distance = abs(2 * remainder - divisor)
+    if distance * 10 ** (context.prec - 2) <= 2 * mantissa:
+        return None
+    if 2 * remainder > divisor:
+        tens += 1
+    return sign * tens * 10
+
+
+class FeeCalculator:
+    """
+    Works out fees for many bands at once. Base bands, multipliers,
+    exchange rates and settings are loaded once, when the calculator
+    is created, and each distinct band is only calculated once.
+    The fees and warnings are the same as from Band.calculate_fee.
+
+    With fixed_point, fees are multiplied out with exact integer
+    arithmetic on scaled multipliers. Any fee too close to a rounding
+    boundary to be sure of is worked out with Decimal instead,
+    so the results are still identical.
+    """
+
+    def __init__(self, resolver=None, matrix=None, fixed_point=False):
+        self.resolver = resolver or BaseBandResolver()
+        self.matrix = matrix or MultiplierMatrix(resolver=self.resolver)
+        self.minimum_fee = int(utils.setting('minimum_fee'))
+        self.fixed_point = fixed_point
+        self.scaled_multipliers = {}
+        self.fallbacks = 0
+        self.results = {}
+        self.dependency_fingerprints = {}
+
+    def calculate(self, size, level, country, currency) -> Tuple[int, str]:
+        """
+        :return: The fee, as an int rounded to the nearest ten, and
+                 a string containing warnings for the end user
+        """
+        for field in [size, level, country, currency]:
+            if not field:
+                raise ValidationError(
+                    'Band does not have data needed for fee calculation'
+                )
+        key = self.key(size, level, country, currency)
+        if key not in self.results:
+            self.results[key] = self.calculate_fee(
+                size,
+                level,
+                country,
+                currency,
+            )
+        return self.results[key]
+
+    def dependency_fingerprint(self, size, level, country, currency) -> str:
+        """
+        Hashes everything the fee for a band depends on: the base band,
+        the size multiplier, the indicator values read for the band
+        and base band, the fee settings and the billing agent routing
+        :return: a hex digest
+        """
+        key = self.key(size, level, country, currency)
+        if key not in self.dependency_fingerprints:
+            base_band = self.resolver.get_base_band(
+                level=level,
+                country=country,
+            )
+            alpha3 = Country(code=str(getattr(country, 'code', country))).alpha3
+            columns = self.matrix.columns
+            disparity = columns[plugin_settings.DISPARITY_INDICATOR]
+            rate = columns[plugin_settings.RATE_INDICATOR]
+            billing_agent = determine_billing_agent(country)
+            values = [
+                base_band.pk,
+                base_band.fee,
+                base_band.size.multiplier,
+                base_band.country.alpha3,
+                base_band.currency.region,
+                size.multiplier,
+                level.default,
+                alpha3,
+                currency.region,
+                disparity.get(alpha3),
+                disparity.get(base_band.country.alpha3),
+                rate.get(currency.region),
+                rate.get(base_band.currency.region),
+                self.matrix.years,
+                self.minimum_fee,
+                self.matrix.disparity_warning,
+                self.matrix.rate_warning,
+                billing_agent.pk if billing_agent else None,
+            ]
+            self.dependency_fingerprints[key] = hashlib.sha256(
+                repr(values).encode('utf-8'),
+            ).hexdigest()
+        return self.dependency_fingerprints[key]
+
+    @staticmethod
+    def key(size, level, country, currency):
+        return (
+            size.pk,
+            level.pk,
+            getattr(country, 'code', country),
+            currency.pk,
+        )
+
+    def calculate_in_processes(self, band_tuples, workers, chunk_size=500):
+        """
+        Fills in results for many bands with a pool of worker processes.
+        Each worker inherits a copy of this calculator's configuration
+        and does no database work, and the results come back here,
+        so later calls to calculate are lookups.
+        Bands a worker cannot calculate are left for calculate,
+        which raises the same errors as it would have without workers.
+        :band_tuples: (size, level, country, currency) tuples
+        :workers: number of processes
+        :return: number of results filled in
+        """
+        try:
+            mp_context = multiprocessing.get_context('fork')
+        except ValueError:
+            logger.warning(
+                'Worker processes need the fork start method. '
+                'Calculating fees in this process instead.'
+            )
+            return 0
+
+        pending = {}
+        for band_tuple in band_tuples:
+            if all(band_tuple):
+                key = self.key(*band_tuple)
+                if key not in self.results:
+                    pending.setdefault(key, band_tuple)
+        band_tuples = list(pending.values())
+        chunks = [
+            band_tuples[start:start + chunk_size]
+            for start in range(0, len(band_tuples), chunk_size)
+        ]
+        filled = 0
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp_context,
+            initializer=start_fee_worker,
+            initargs=(self,),
+        ) as executor:
+            for results in executor.map(calculate_fee_chunk, chunks):
+                self.results.update(results)
+                filled += len(results)
+        return filled
+
+    def calculate_many(self, band_tuples) -> list[Tuple[int, str]]:
+        """
+        :band_tuples: (size, level, country, currency) tuples
+        :return: list of (fee, warnings) tuples in the same order
+        """
+        return [self.calculate(*band_tuple) for band_tuple in band_tuples]
+
+    def calculate_fee(self, size, level, country, currency):
+        # Follows the steps of Band.calculate_fee
+        warnings = ''
+
+        base_band = self.resolver.get_base_band(level=level, country=country)
+        base_fee = base_band.fee
+        if base_fee is None:
+            logger.error(
+                'No fee has been set on base band'
+            )
+
+        multipliers = []
+        if level.default:
+            multipliers.append(size.multiplier / base_band.size.multiplier)
+
+        disparity, warning = self.matrix.disparity(country, base_band)
+        multipliers.append(disparity)
+        warnings += warning
+
+        rate, warning = self.matrix.exchange_rate(currency, base_band)
+        multipliers.append(rate)
+        warnings += warning
+
+        fee = None
+        if self.fixed_point:
+            fee = self.multiply_fixed_point(base_fee, multipliers)
+            if fee is None:
+                self.fallbacks += 1
+        if fee is None:
+            fee = base_fee
+            for multiplier in multipliers:
+                fee *= multiplier
+            fee = int(round(fee, -1))
+        fee = max(fee, self.minimum_fee)
+
+        return fee, warnings
+
+    def multiply_fixed_point(self, base_fee, multipliers):
+        """
+        :return: the fee rounded to the nearest ten,
+                 or None if it has to be worked out with Decimal
+        """
+        if not isinstance(base_fee, int):
+            return None
+        mantissa, exponent = base_fee, 0
+        for multiplier in multipliers:
+            if multiplier not in self.scaled_multipliers:
+                self.scaled_multipliers[multiplier] = to_fixed_point(
+                    multiplier,
+                )
+            scaled = self.scaled_multipliers[multiplier]
+            if scaled is None:
+                return None
+            mantissa *= scaled[0]
+            exponent += scaled[1]
+        return round_fixed_point_to_ten(mantissa, exponent)
+
+
+def iter_fee_grid():
+    """
+    :return: iterator of (size, level, country code, currency)
+             for every combination
+    """
+    return (
+        (size, level, code, currency)
+        for size, level, (code, _name), currency in itertools.product(
+            list(supporter_models.SupporterSize.objects.all()),
+            list(supporter_models.SupportLevel.objects.all()),
+            countries,
+            list(supporter_models.Currency.objects.all()),
+        )
+    )
+
+
+def verify_fixed_point_fees():
+    """
+    Cross-checks the fixed-point fee path against the Decimal path
+    for every size, level, country and currency
+    :return: tuple of the number of fees checked, the number
+             the fixed-point path left to Decimal, and a list of
+             (band tuple, Decimal result, fixed-point result) mismatches
+    """
+    resolver = BaseBandResolver()
+    matrix = MultiplierMatrix(resolver=resolver)
+    decimal_calculator = FeeCalculator(resolver=resolver, matrix=matrix)
+    fixed_point_calculator = FeeCalculator(
+        resolver=resolver,
+        matrix=matrix,
+        fixed_point=True,
+    )
+    checked = 0
+    mismatches = []
+    for band_tuple in iter_fee_grid():
+        expected = decimal_calculator.calculate(*band_tuple)
+        result = fixed_point_calculator.calculate(*band_tuple)
+        checked += 1
+        if result != expected:
+            mismatches.append((band_tuple, expected, result))
+    return checked, fixed_point_calculator.fallbacks, mismatches
+
+
+def build_fee_quotes(fixed_point=False):
+    """
+    Replaces the fee quote grid with a fee for every
+    combination of size, level, country and currency
+    :fixed_point: whether to use the fixed-point fee path
+    :return: number of quotes built
+    """
+    built = timezone.now()
+    version = utils.get_configuration_version()
+    quotes = []
+    try:
+        # Reads the fee settings, which may not all exist yet
+        fee_calculator = FeeCalculator(fixed_point=fixed_point)
+        for size, level, code, currency in iter_fee_grid():
+            fee, warnings = fee_calculator.calculate(
+                size,
+                level,
+                code,
+                currency,
+            )
+            quotes.append(
+                supporter_models.FeeQuote(
+                    size=size,
+                    level=level,
+                    country=code,
+                    currency=currency,
+                    fee=fee,
+                    warnings=warnings,
+                    built=built,
+                    version=version,
+                )
+            )
+    except (
+        AttributeError,
+        TypeError,
+        ValueError,
+        ValidationError,
+        ObjectDoesNotExist,
+    ) as e:
+        # The plugin is not fully configured yet
+        logger.warning(f'Could not build fee quotes: {e}')
+        invalidate_fee_quotes()
+        return 0
+
+    with transaction.atomic():
+        invalidate_fee_quotes()
+        supporter_models.FeeQuote.objects.bulk_create(
+            quotes,
+            batch_size=1000,
+        )
+    return len(quotes)
+
+
+def invalidate_fee_quotes():
+    supporter_models.FeeQuote.objects.all().delete()
+
+
+def configuration_changed():
+    """
+    Bumps the configuration version. Called for every write to
+    billing configuration, including queryset updates.
+    Quotes from older versions are then ignored, and fees are
+    calculated as needed until the grid is rebuilt outside the
+    request cycle, by build_fee_quotes --if-stale on a schedule,
+    by fetch_world_bank_data, or from the manager page.
+    """
+    utils.bump_configuration_version()
+
+
+def rebuild_stale_fee_quotes():
+    """
+    Rebuilds the fee quote grid unless it is for the current version
+    :return: number of quotes built
+    """
+    if current_fee_quotes().exists():
+        return 0
+    try:
+        return build_fee_quotes()
+    except DatabaseError as e:
+        logger.error(e)
+        logger.error('...while trying to rebuild fee quotes')
+        return 0
+
+
+def get_fee_quote(size, level, country, currency):
+    """
+    Looks up a precomputed fee
+    :return: tuple of fee and warnings, or None if there is no quote
+    """
+    if not all([size, level, country, currency]):
+        return None
+    return supporter_models.FeeQuote.objects.filter(
+        size=size,
+        level=level,
+        country=country,
+        currency=currency,
+        version=utils.get_configuration_version(),
+    ).values_list(
+        'fee', 'warnings',
+    ).first()
+
+
+def current_fee_quotes():
+    """
+    :return: the fee quotes built from the current configuration version
+    """
+    return supporter_models.FeeQuote.objects.filter(
+        version=utils.get_configuration_version(),
+    )
+
+
+def fee_quotes_built():
+    """
+    :return: when the fee quote grid for the current
+             configuration was built, or None
+    """
+    return current_fee_quotes().aggregate(
+        Min('built'),
+    )['built__min']
+
+
 def latest_dataset_for_indicator(indicator):
     try:
         return cms_models.MediaFile.objects.filter(
@@ -255,6 +1067,7 @@ def get_settings_for_display():
     return display_settings
 
 
+@memo.memoize
 def determine_billing_agent(country):
     """
     :country: a two-letter country code like the ones
@@ -294,16 +1107,18 @@ def get_total_revenue(currency=None):
         else:
             return 0, None
     revenue = 0
-    for supporter_currency in supporter_models.Currency.objects.all():
-        revenue_in_currency = supporter_models.Supporter.objects.filter(
-            active=True,
-            band__isnull=False,
-            band__currency=supporter_currency
-        ).aggregate(
-            Sum('band__fee')
-        )['band__fee__sum']
-        target_exchange_rate, _warnings = currency.exchange_rate()
-        origin_exchange_rate, _warnings = supporter_currency.exchange_rate()
-        revenue += revenue_in_currency * (target_exchange_rate / origin_exchange_rate)
+    revenue_by_currency = supporter_models.Supporter.objects.filter(
+        active=True,
+        band__isnull=False,
+        band__currency__isnull=False,
+    ).values_list(
+        'band__currency__code',
+    ).annotate(
+        Sum('band__fee'),
+    ).order_by()
+    matrix = get_exchange_rate_matrix()
+    for code, revenue_in_currency in revenue_by_currency:
+        if revenue_in_currency:
+            revenue += matrix.convert(revenue_in_currency, code, currency)
 
     return round(revenue), currency
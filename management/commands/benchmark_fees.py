@@ -0,0 +1,405 @@
+import decimal
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import django
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django_countries import countries
+
+from plugins.consortial_billing import (
+    costs,
+    forms,
+    logic,
+    models,
+    plugin_settings,
+    utils,
+)
+
+from cms import models as cms_models
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = """
+           Measures the fee calculation pipeline against synthetic data.
+           Run it against an empty database, such as a copy made for
+           the purpose, not a live site.
+           Each scale is seeded inside a transaction that is rolled back,
+           with indicator data written to a temporary media root,
+           so nothing is left behind. Prints JSON results.
+           """
+
+    SEEDED_MODELS = [
+        models.Supporter,
+        models.Band,
+        models.BillingAgent,
+        models.SupportLevel,
+        models.SupporterSize,
+        models.Currency,
+        models.IndicatorObservation,
+        models.LatestIndicatorValue,
+        models.IndicatorDataset,
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales',
+            nargs='+',
+            type=int,
+            default=[100, 10000, 100000],
+            help='Numbers of supporters to seed, one run per scale',
+        )
+        parser.add_argument(
+            '--sample',
+            type=int,
+            default=100,
+            help='How many bands to pass to each per-band entry point',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for the synthetic data',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the JSON results to this file instead of stdout',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Run even though the database has billing data. '
+                 'The synthetic data is added alongside it, and the '
+                 'tables stay locked until each scale is rolled back. '
+                 'Indicator files that already exist are read, '
+                 'never replaced.',
+        )
+
+    def handle(self, *args, **options):
+        in_use = [
+            model._meta.verbose_name_plural for model in self.SEEDED_MODELS
+            if model.objects.exists()
+        ]
+        if self.indicator_files().exists():
+            in_use.append('indicator media files')
+        if in_use and not options['force']:
+            raise CommandError(
+                f'The database already has {", ".join(in_use)}. '
+                'Run the benchmark against an empty database, '
+                'or pass --force.'
+            )
+        results = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'sample': options['sample'],
+            'seed': options['seed'],
+            'scales': [],
+        }
+        for scale in options['scales']:
+            with tempfile.TemporaryDirectory() as media_root:
+                with override_settings(MEDIA_ROOT=media_root):
+                    self.created_files = []
+                    self.seeded_datasets = []
+                    try:
+                        with transaction.atomic():
+                            results['scales'].append(
+                                self.run_scale(scale, options)
+                            )
+                            transaction.set_rollback(True)
+                    finally:
+                        # Nothing seeded should outlive the benchmark,
+                        # and nothing else should be touched
+                        for file_name in self.created_files:
+                            cms_models.MediaFile.file.field.storage.delete(
+                                file_name,
+                            )
+                        utils.indicator_cache.clear()
+            if options['verbosity'] > 1:
+                logger.info(
+                    self.style.SUCCESS(f'Benchmarked {scale} supporters')
+                )
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file_ref:
+                file_ref.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_scale(self, scale, options):
+        rng = random.Random(options['seed'])
+        start = time.perf_counter()
+        self.seed_data(scale, rng)
+        seed_seconds = time.perf_counter() - start
+
+        band_ids = list(
+            models.Band.objects.filter(
+                category='calculated',
+            ).values_list('pk', flat=True)
+        )
+        sample_ids = rng.sample(band_ids, min(options['sample'], len(band_ids)))
+        bands = list(
+            models.Band.objects.filter(
+                pk__in=sample_ids,
+            ).select_related(
+                'size', 'level', 'currency',
+            )
+        )
+
+        def form_save(band):
+            form = forms.BaseBandForm({
+                'country': band.country.code,
+                'currency': band.currency.pk,
+                'size': band.size.pk,
+                'level': band.level.pk,
+            })
+            form.is_valid()
+            return form.save(commit=False)
+
+        return {
+            'supporters': scale,
+            'seed_seconds': round(seed_seconds, 6),
+            'entry_points': {
+                'band_calculate_fee': self.measure(
+                    lambda band: band.calculate_fee(),
+                    bands,
+                ),
+                'base_band_form_save': self.measure(form_save, bands),
+                'get_base_band': self.measure(
+                    lambda band: logic.get_base_band(
+                        level=band.level,
+                        country=band.country,
+                    ),
+                    bands,
+                ),
+                'get_display_bands': self.measure(
+                    lambda _none: logic.get_display_bands(),
+                    [None],
+                ),
+                # The fallback for data fetched before
+                # observations were stored separately
+                'open_saved_indicator_values': self.measure(
+                    lambda dataset: utils.open_saved_indicator_values(*dataset),
+                    self.seeded_datasets,
+                ),
+            },
+        }
+
+    @staticmethod
+    def measure(function, args):
+        """
+        Calls function once per arg, starting from an empty indicator cache
+        :return: dict of timings and counts
+        """
+        utils.indicator_cache.clear()
+        counters_before = utils.io_counters.copy()
+        queries = costs.QueryCounter()
+        with connection.execute_wrapper(queries):
+            start = time.perf_counter()
+            for arg in args:
+                function(arg)
+            seconds = time.perf_counter() - start
+        counters = utils.io_counters - counters_before
+        calls = len(args) or 1
+        return {
+            'calls': len(args),
+            'seconds': round(seconds, 6),
+            'seconds_per_call': round(seconds / calls, 6),
+            'queries': queries.count,
+            'queries_per_call': round(queries.count / calls, 3),
+            'media_file_opens': counters['media_file_opens'],
+            'snapshot_opens': counters['snapshot_opens'],
+            'json_parses': counters['json_parses'],
+        }
+
+    @staticmethod
+    def indicator_files():
+        return cms_models.MediaFile.objects.filter(
+            label__startswith=f'{plugin_settings.SHORT_NAME}/',
+        )
+
+    def seed_world_bank_file(self, indicator, year, values):
+        records = [
+            {
+                'indicator': {'id': indicator},
+                'countryiso3code': country,
+                'date': str(year),
+                'value': float(value) if value is not None else None,
+            } for country, value in values.items()
+        ]
+        metadata = {'page': 1, 'pages': 1, 'total': len(records)}
+        label = os.path.join(
+            plugin_settings.SHORT_NAME,
+            f'{indicator}_{year}.json',
+        )
+        media_file, created = cms_models.MediaFile.objects.get_or_create(
+            label=label,
+        )
+        if not created:
+            # With --force, a file from before the run is left as it is
+            return
+        media_file.file.save(
+            label,
+            ContentFile(json.dumps([metadata, records]).encode()),
+            save=True,
+        )
+        self.created_files.append(media_file.file.name)
+        self.seeded_datasets.append((indicator, year))
+
+    def seed_data(self, scale, rng):
+        # The surrounding transaction is rolled back afterwards
+        level_standard = models.SupportLevel.objects.create(
+            name='Standard',
+            order=2,
+            default=True,
+        )
+        level_silver = models.SupportLevel.objects.create(
+            name='Silver',
+            order=1,
+        )
+        levels = [level_standard, level_silver]
+        models.SupporterSize.objects.bulk_create([
+            models.SupporterSize(name='Large', multiplier=decimal.Decimal('1')),
+            models.SupporterSize(name='Medium', multiplier=decimal.Decimal('0.5')),
+            models.SupporterSize(name='Small', multiplier=decimal.Decimal('0.2')),
+        ])
+        sizes = list(models.SupporterSize.objects.all())
+        models.Currency.objects.bulk_create([
+            models.Currency(code='EUR', region='EMU'),
+            models.Currency(code='GBP', region='GBR'),
+            models.Currency(code='USD', region='USA'),
+        ])
+        currencies = {
+            currency.code: currency
+            for currency in models.Currency.objects.all()
+        }
+        agent_default = models.BillingAgent.objects.create(
+            name='Benchmark default agent',
+            default=True,
+        )
+        agent_gb = models.BillingAgent.objects.create(
+            name='Benchmark GB agent',
+            country='GB',
+        )
+
+        # Base bands for each level, plus one set for the country agent
+        base_bands = []
+        for level, fee in [(level_standard, 1000), (level_silver, 3000)]:
+            base_bands.append(models.Band(
+                size=sizes[0],
+                country='DE',
+                currency=currencies['EUR'],
+                level=level,
+                fee=fee,
+                billing_agent=agent_default,
+                category='base',
+            ))
+            base_bands.append(models.Band(
+                size=sizes[0],
+                country='GB',
+                currency=currencies['GBP'],
+                level=level,
+                fee=fee,
+                billing_agent=agent_gb,
+                category='base',
+            ))
+        models.Band.objects.bulk_create(base_bands)
+
+        # World Bank data for every country and currency region,
+        # with some gaps so that the fallback years are exercised,
+        # saved as the API responses as well as observations
+        country_codes = [code for code, _name in countries]
+        observations = []
+        for year in logic.last_five_years():
+            values = {}
+            for code in country_codes:
+                value = None
+                if rng.random() > 0.05:
+                    value = decimal.Decimal(rng.randint(500, 100000))
+                values[countries.alpha3(code)] = value
+            self.seed_world_bank_file(
+                plugin_settings.DISPARITY_INDICATOR,
+                year,
+                values,
+            )
+            rates = {
+                region: decimal.Decimal(rng.randint(500, 1500)) / 1000
+                for region in ['EMU', 'GBR', 'USA']
+            }
+            self.seed_world_bank_file(
+                plugin_settings.RATE_INDICATOR,
+                year,
+                rates,
+            )
+            for indicator, indicator_values in [
+                (plugin_settings.DISPARITY_INDICATOR, values),
+                (plugin_settings.RATE_INDICATOR, rates),
+            ]:
+                observations.extend(
+                    models.IndicatorObservation(
+                        indicator=indicator,
+                        country=country,
+                        year=year,
+                        value=value,
+                    ) for country, value in indicator_values.items()
+                )
+        models.IndicatorObservation.objects.bulk_create(
+            observations,
+            batch_size=1000,
+        )
+        for indicator in [
+            plugin_settings.DISPARITY_INDICATOR,
+            plugin_settings.RATE_INDICATOR,
+        ]:
+            utils.rebuild_latest_indicator_values(indicator)
+        utils.write_indicator_snapshot()
+
+        # One calculated band per supporter
+        fingerprints = set()
+
+        def calculated_band():
+            band = models.Band(
+                size=rng.choice(sizes),
+                country=rng.choice(country_codes),
+                currency=rng.choice(list(currencies.values())),
+                level=rng.choice(levels),
+                fee=rng.randint(10, 500) * 10,
+                billing_agent=agent_default,
+                category='calculated',
+            )
+            # bulk_create skips Band.save, which sets the lookup fields.
+            # Fingerprints are unique, so repeats are left without one.
+            band.set_lookup_fields()
+            if band.fingerprint in fingerprints:
+                band.fingerprint = None
+            fingerprints.add(band.fingerprint)
+            return band
+
+        models.Band.objects.bulk_create(
+            (calculated_band() for _num in range(scale)),
+            batch_size=1000,
+        )
+        band_ids = models.Band.objects.filter(
+            category='calculated',
+        ).values_list('pk', flat=True)
+        models.Supporter.objects.bulk_create(
+            (
+                models.Supporter(
+                    name=f'Benchmark supporter {num}',
+                    band_id=band_id,
+                    active=True,
+                ) for num, band_id in enumerate(list(band_ids))
+            ),
+            batch_size=1000,
+        )
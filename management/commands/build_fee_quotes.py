@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from plugins.consortial_billing import logic
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = """
+           Rebuilds the grid of precomputed fees used for signup
+           calculations, for every size, level, country and currency.
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fixed-point',
+            action='store_true',
+            help='Calculate fees with fixed-point integer arithmetic',
+        )
+        parser.add_argument(
+            '--if-stale',
+            action='store_true',
+            help='Only rebuild if the configuration has changed since '
+                 'the grid was built. Run it on a schedule so that '
+                 'requests never wait for a rebuild.',
+        )
+
+    def handle(self, *args, **options):
+        if options['if_stale'] and logic.current_fee_quotes().exists():
+            logger.info('Fee quotes are up to date')
+            return
+        quotes = logic.build_fee_quotes(fixed_point=options['fixed_point'])
+        if quotes:
+            logger.info(
+                self.style.SUCCESS(f'Built {quotes} fee quotes')
+            )
+        else:
+            logger.warning(
+                self.style.WARNING('No fee quotes could be built')
+            )
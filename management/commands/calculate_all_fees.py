@@ -1,7 +1,13 @@
-from django.core.management.base import BaseCommand
+import collections
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
 
-from plugins.consortial_billing import models, forms
+from plugins.consortial_billing import models, forms, logic, memo, costs
 
 from utils.logger import get_logger
 
@@ -13,39 +19,323 @@ class Command(BaseCommand):
     help = """
            Calculates new supporter fees based on current data.
            Only saves if --save is passed.
+           Each run is recorded, and can be resumed with --resume.
+           With --dry-run, nothing is written to the database.
            """
 
+    REPORT_FIELDS = [
+        'supporter_id',
+        'supporter',
+        'old_fee',
+        'new_fee',
+        'currency',
+        'delta',
+        'warnings',
+    ]
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--save',
             action='store_true',
             help='Save the new fee, replacing the old'
         )
+        parser.add_argument(
+            '--fixed-point',
+            action='store_true',
+            help='Calculate fees with fixed-point integer arithmetic',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Calculate fees in this many processes. '
+                 'Bands and supporters are still saved by this one.',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Skip supporters whose band was calculated from '
+                 'the same base band, data, settings and routing',
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Calculate the fees for each batch of supporters first, '
+                 'then write the bands, history and supporters together',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Supporters per committed batch, '
+                 'and rows per query in --bulk mode',
+        )
+        parser.add_argument(
+            '--resume',
+            type=int,
+            metavar='RUN_ID',
+            help='Continue an interrupted run from its last committed batch, '
+                 'with the options it was started with',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Write a report of the fees that would change, '
+                 'without writing to the database',
+        )
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'jsonl'],
+            default='csv',
+            help='Format of the --dry-run report. '
+                 'In CSV, the totals are logged rather than written.',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the --dry-run report to this file instead of stdout',
+        )
 
     def handle(self, *args, **options):
-        for supporter in models.Supporter.objects.filter(
-            active=True,
+        if options['dry_run'] and (
+            options['save'] or options['bulk'] or options['resume']
         ):
+            raise CommandError(
+                '--dry-run cannot be used with --save, --bulk or --resume'
+            )
+        with memo.memo_context(), costs.cost_context('calculate_all_fees'):
+            if options['dry_run']:
+                if options['output']:
+                    with open(options['output'], 'w', newline='') as file_ref:
+                        self.report_fee_changes(file_ref, options)
+                else:
+                    self.report_fee_changes(self.stdout, options)
+            else:
+                run = self.start_run(options)
+                try:
+                    if options['bulk']:
+                        self.calculate_all_fees_in_bulk(options, run)
+                    else:
+                        self.calculate_all_fees(options, run)
+                except Exception as error:
+                    run.finish('failed', error=repr(error))
+                    raise
+                run.finish('complete')
+
+    def start_run(self, options):
+        """
+        Records a new run, or picks up the one being resumed,
+        whose options replace those passed in
+        """
+        if options['resume']:
             try:
-                old_band = supporter.band
-                new_band_form = forms.BandForm({
+                run = models.RecalculationRun.objects.get(pk=options['resume'])
+            except models.RecalculationRun.DoesNotExist:
+                raise CommandError(
+                    f'Recalculation run {options["resume"]} does not exist'
+                )
+            if run.status == 'complete':
+                raise CommandError(
+                    f'Recalculation run {run.pk} is already complete'
+                )
+            options.update(run.get_options())
+            run.status = 'running'
+            run.error = ''
+            run.save()
+            status = f'Resuming recalculation run {run.pk} after supporter ' \
+                     f'{run.last_supporter_id or 0}'
+        else:
+            run = models.RecalculationRun.objects.create(
+                save_fees=options['save'],
+                fixed_point=options['fixed_point'],
+                incremental=options['incremental'],
+                bulk=options['bulk'],
+                total=models.Supporter.objects.filter(active=True).count(),
+            )
+            status = f'Started recalculation run {run.pk}'
+        if options['verbosity'] > 0:
+            logger.info(self.style.SUCCESS(status))
+        return run
+
+    @staticmethod
+    def supporter_batches(run, batch_size):
+        """
+        Yields active supporters in order of id after the run's cursor.
+        Each batch should be committed, with the cursor,
+        before the next is asked for.
+        """
+        while True:
+            supporters = models.Supporter.objects.filter(
+                active=True,
+            ).order_by('pk')
+            if run.last_supporter_id:
+                supporters = supporters.filter(pk__gt=run.last_supporter_id)
+            batch = list(
+                supporters.select_related(
+                    'band__size', 'band__level', 'band__currency',
+                )[:batch_size]
+            )
+            if not batch:
+                return
+            yield batch
+
+    def calculate_all_fees(self, options, run):
+        fee_calculator = logic.FeeCalculator(
+            fixed_point=options['fixed_point'],
+        )
+        if options['workers'] > 1:
+            self.calculate_in_processes(fee_calculator, options['workers'])
+        skipped = 0
+        # Supporters with the same size, level, country and currency
+        # share the band made for the first of them
+        bands = {}
+        for supporters in self.supporter_batches(run, options['batch_size']):
+            with transaction.atomic():
+                for supporter in supporters:
+                    if options['incremental'] and self.is_up_to_date(
+                        supporter.band,
+                        fee_calculator,
+                    ):
+                        skipped += 1
+                    else:
+                        self.recalculate_supporter(
+                            supporter,
+                            fee_calculator,
+                            options,
+                            bands,
+                        )
+                run.checkpoint(supporters)
+        self.log_skipped(skipped, options)
+
+    @staticmethod
+    def get_new_band(old_band, fee_calculator, options, bands):
+        """
+        Makes the band for the old band's inputs with BandForm,
+        once per distinct size, level, country and currency
+        :bands: dict of FeeCalculator keys and bands made so far
+        :return: the band, and whether it has been saved in this run
+        """
+        key = fee_calculator.key(
+            old_band.size,
+            old_band.level,
+            old_band.country,
+            old_band.currency,
+        )
+        if key not in bands:
+            new_band_form = forms.BandForm(
+                {
                     'size': old_band.size,
                     'level': old_band.level,
                     'country': old_band.country,
                     'currency': old_band.currency,
                     'category': 'calculated',
-                })
-                if new_band_form.is_valid():
-                    new_band = new_band_form.save(commit=options['save'])
-                    if old_band.fee == new_band.fee:
-                        supporter.prospective_band = None
-                        supporter.save()
-                        continue
-                    else:
-                        new_band.save()
-                else:
-                    raise AttributeError
-            except AttributeError:
+                },
+                fee_calculator=fee_calculator,
+            )
+            if not new_band_form.is_valid():
+                raise AttributeError
+            bands[key] = [
+                new_band_form.save(commit=options['save']),
+                options['save'],
+            ]
+        return bands[key]
+
+    def recalculate_supporter(self, supporter, fee_calculator, options, bands):
+        try:
+            old_band = supporter.band
+            group = self.get_new_band(old_band, fee_calculator, options, bands)
+            new_band, saved = group
+            if old_band.fee == new_band.fee:
+                self.mark_up_to_date(old_band, new_band)
+                supporter.prospective_band = None
+                supporter.save()
+                return
+            elif not saved:
+                new_band.save()
+                group[1] = True
+        except AttributeError:
+            logger.warning(
+                self.style.WARNING(
+                    'Not enough data to recalculate band for '
+                    f'{str(supporter.id).rjust(3)} - {supporter.name}'
+                )
+            )
+            return
+        try:
+            if options['save']:
+                models.OldBand.objects.get_or_create(supporter=supporter, band=old_band)
+                supporter.band = new_band
+                supporter.prospective_band = None
+                supporter.save()
+                status = 'Saved new fee: '
+            else:
+                supporter.prospective_band = new_band
+                supporter.save()
+                status = 'New fee (not saved): '
+            if options['verbosity'] > 0:
+                logger.info(
+                    self.style.SUCCESS(
+                        status +
+                        f'{str(old_band.fee).rjust(5)} {old_band.currency} -> '
+                        f'{str(new_band.fee).rjust(5)} {new_band.currency} '
+                        f'for {supporter.name}.'
+                    )
+                )
+            if new_band.warnings:
+                logger.warning(
+                    self.style.WARNING(
+                        f'{str(supporter.id).rjust(3)} - {supporter.name}:'
+                        + new_band.warnings,
+                    )
+                )
+        except ValidationError:
+            logger.warning(
+                self.style.WARNING(
+                    'Could not calculate fee for '
+                    f'{str(supporter.id).rjust(3)} - {supporter.name}'
+                )
+            )
+
+    def report_fee_changes(self, output, options):
+        """
+        Streams a row for each supporter whose fee would change,
+        followed by the totals. Only reads from the database.
+        """
+        fee_calculator = logic.FeeCalculator(
+            fixed_point=options['fixed_point'],
+        )
+        if options['workers'] > 1:
+            self.calculate_in_processes(fee_calculator, options['workers'])
+        if options['format'] == 'csv':
+            writer = csv.DictWriter(output, fieldnames=self.REPORT_FIELDS)
+            writer.writeheader()
+            write_row = writer.writerow
+        else:
+            def write_row(row):
+                output.write(json.dumps(row) + '\n')
+
+        totals = collections.Counter()
+        revenue_deltas = collections.Counter()
+        for supporter in models.Supporter.objects.filter(
+            active=True,
+        ).select_related(
+            'band__size', 'band__level', 'band__currency',
+        ).iterator(chunk_size=options['batch_size']):
+            totals['checked'] += 1
+            old_band = supporter.band
+            if options['incremental'] and self.is_up_to_date(
+                old_band,
+                fee_calculator,
+            ):
+                totals['skipped'] += 1
+                continue
+            if not old_band or not all([
+                old_band.size,
+                old_band.level,
+                old_band.country,
+                old_band.currency,
+            ]):
+                totals['failed'] += 1
                 logger.warning(
                     self.style.WARNING(
                         'Not enough data to recalculate band for '
@@ -54,16 +344,236 @@ class Command(BaseCommand):
                 )
                 continue
             try:
+                fee, warnings = fee_calculator.calculate(
+                    old_band.size,
+                    old_band.level,
+                    old_band.country,
+                    old_band.currency,
+                )
+            except ValidationError:
+                totals['failed'] += 1
+                logger.warning(
+                    self.style.WARNING(
+                        'Could not calculate fee for '
+                        f'{str(supporter.id).rjust(3)} - {supporter.name}'
+                    )
+                )
+                continue
+            if fee == old_band.fee:
+                totals['unchanged'] += 1
+                continue
+            totals['changed'] += 1
+            delta = fee - old_band.fee if old_band.fee is not None else None
+            if delta is not None:
+                revenue_deltas[old_band.currency.code] += delta
+            write_row({
+                'supporter_id': supporter.pk,
+                'supporter': supporter.name,
+                'old_fee': old_band.fee,
+                'new_fee': fee,
+                'currency': old_band.currency.code,
+                'delta': delta,
+                'warnings': warnings,
+            })
+
+        summary = {
+            'checked': totals['checked'],
+            'changed': totals['changed'],
+            'unchanged': totals['unchanged'],
+            'skipped': totals['skipped'],
+            'failed': totals['failed'],
+            'revenue_delta': dict(sorted(revenue_deltas.items())),
+        }
+        if options['format'] == 'jsonl':
+            output.write(json.dumps({'summary': summary}) + '\n')
+        if options['verbosity'] > 0:
+            # Logged rather than written, so that a CSV report stays parseable
+            logger.info(
+                self.style.SUCCESS(
+                    f'{summary["changed"]} of {summary["checked"]} fees '
+                    f'would change. Revenue delta: '
+                    + (', '.join(
+                        f'{delta:+} {code}'
+                        for code, delta in summary['revenue_delta'].items()
+                    ) or 'none')
+                )
+            )
+
+    @staticmethod
+    def is_up_to_date(band, fee_calculator):
+        """
+        Checks whether a calculated band's dependency fingerprint
+        still matches what its fee would be calculated from now
+        """
+        if not band or band.category != 'calculated' or \
+                not band.dependency_fingerprint:
+            return False
+        try:
+            return band.dependency_fingerprint == \
+                fee_calculator.dependency_fingerprint(
+                    band.size,
+                    band.level,
+                    band.country,
+                    band.currency,
+                )
+        except (AttributeError, TypeError, ValidationError):
+            return False
+
+    @staticmethod
+    def mark_up_to_date(old_band, new_band):
+        # The old band is what would be calculated now,
+        # so record that it was calculated from the current inputs
+        if not new_band.dependency_fingerprint or \
+                old_band.dependency_fingerprint == \
+                new_band.dependency_fingerprint or \
+                old_band.get_fingerprint() != new_band.get_fingerprint():
+            return
+        old_band.dependency_fingerprint = new_band.dependency_fingerprint
+        models.Band.objects.filter(pk=old_band.pk).update(
+            dependency_fingerprint=new_band.dependency_fingerprint,
+        )
+
+    def log_skipped(self, skipped, options):
+        if options['incremental'] and options['verbosity'] > 0:
+            logger.info(
+                self.style.SUCCESS(
+                    f'Skipped {skipped} supporters whose fees are up to date'
+                )
+            )
+
+    def calculate_in_processes(self, fee_calculator, workers):
+        # Fills in the calculator's results up front, so that the loop
+        # above saves exactly what it would have done on its own
+        band_tuples = [
+            (band.size, band.level, band.country, band.currency)
+            for band in models.Band.objects.filter(
+                current_supporter__active=True,
+            ).select_related(
+                'size', 'level', 'currency',
+            ).distinct()
+        ]
+        filled = fee_calculator.calculate_in_processes(band_tuples, workers)
+        logger.info(
+            self.style.SUCCESS(
+                f'Calculated {filled} distinct fees in {workers} processes'
+            )
+        )
+
+    def calculate_all_fees_in_bulk(self, options, run):
+        fee_calculator = logic.FeeCalculator(
+            fixed_point=options['fixed_point'],
+        )
+        if options['workers'] > 1:
+            self.calculate_in_processes(fee_calculator, options['workers'])
+        skipped = 0
+        bands = {}
+        for supporters in self.supporter_batches(run, options['batch_size']):
+            skipped += self.recalculate_batch_in_bulk(
+                supporters,
+                fee_calculator,
+                options,
+                run,
+                bands,
+            )
+        self.log_skipped(skipped, options)
+
+    def recalculate_batch_in_bulk(
+        self,
+        supporters,
+        fee_calculator,
+        options,
+        run,
+        bands,
+    ):
+        """
+        :bands: dict of FeeCalculator keys and the band for each,
+                or None if the fee could not be calculated,
+                shared between batches
+        :return: the number of supporters skipped as up to date
+        """
+        batch_size = options['batch_size']
+        now = timezone.now()
+        year = timezone.localtime(now).year
+
+        # Calculate the whole batch first, with one new band per distinct result
+        new_bands = {}
+        changes = []
+        supporters_to_update = []
+        bands_to_mark = {}
+        skipped = 0
+        for supporter in supporters:
+            old_band = supporter.band
+            if options['incremental'] and self.is_up_to_date(
+                old_band,
+                fee_calculator,
+            ):
+                skipped += 1
+                continue
+            if not old_band or not all([
+                old_band.size,
+                old_band.level,
+                old_band.country,
+                old_band.currency,
+            ]):
+                logger.warning(
+                    self.style.WARNING(
+                        'Not enough data to recalculate band for '
+                        f'{str(supporter.id).rjust(3)} - {supporter.name}'
+                    )
+                )
+                continue
+            key = fee_calculator.key(
+                old_band.size,
+                old_band.level,
+                old_band.country,
+                old_band.currency,
+            )
+            if key not in bands:
+                bands[key] = self.make_band(old_band, fee_calculator, now)
+            new_band = bands[key]
+            if not new_band:
+                logger.warning(
+                    self.style.WARNING(
+                        'Could not calculate fee for '
+                        f'{str(supporter.id).rjust(3)} - {supporter.name}'
+                    )
+                )
+                continue
+            if new_band.fee == old_band.fee:
+                if old_band.category == 'calculated' and \
+                        old_band.dependency_fingerprint != \
+                        new_band.dependency_fingerprint and \
+                        old_band.get_fingerprint() == new_band.fingerprint:
+                    old_band.dependency_fingerprint = \
+                        new_band.dependency_fingerprint
+                    bands_to_mark[old_band.pk] = old_band
+                if supporter.prospective_band_id:
+                    supporter.prospective_band = None
+                    supporters_to_update.append(supporter)
+                continue
+            new_band = new_bands.setdefault(new_band.fingerprint, new_band)
+            changes.append((supporter, old_band, new_band))
+
+        with transaction.atomic():
+            self.save_bands_in_bulk(new_bands, year, batch_size)
+            models.Band.objects.bulk_update(
+                list(bands_to_mark.values()),
+                ['dependency_fingerprint'],
+                batch_size=batch_size,
+            )
+            old_bands = []
+            for supporter, old_band, new_band in changes:
                 if options['save']:
-                    models.OldBand.objects.get_or_create(supporter=supporter, band=old_band)
+                    old_bands.append(
+                        models.OldBand(supporter=supporter, band=old_band)
+                    )
                     supporter.band = new_band
                     supporter.prospective_band = None
-                    supporter.save()
                     status = 'Saved new fee: '
                 else:
                     supporter.prospective_band = new_band
-                    supporter.save()
                     status = 'New fee (not saved): '
+                supporters_to_update.append(supporter)
                 if options['verbosity'] > 0:
                     logger.info(
                         self.style.SUCCESS(
@@ -80,10 +590,118 @@ class Command(BaseCommand):
                             + new_band.warnings,
                         )
                     )
-            except ValidationError:
-                logger.warning(
-                    self.style.WARNING(
-                        'Could not calculate fee for '
-                        f'{str(supporter.id).rjust(3)} - {supporter.name}'
-                    )
-                )
+            self.save_old_bands_in_bulk(old_bands, batch_size)
+            models.Supporter.objects.bulk_update(
+                supporters_to_update,
+                ['band', 'prospective_band'],
+                batch_size=batch_size,
+            )
+            run.checkpoint(supporters)
+        return skipped
+
+    @staticmethod
+    def make_band(old_band, fee_calculator, now):
+        """
+        :return: an unsaved band with the current fee for the
+                 old band's inputs, or None if it cannot be calculated
+        """
+        try:
+            fee, warnings = fee_calculator.calculate(
+                old_band.size,
+                old_band.level,
+                old_band.country,
+                old_band.currency,
+            )
+            dependency_fingerprint = fee_calculator.dependency_fingerprint(
+                old_band.size,
+                old_band.level,
+                old_band.country,
+                old_band.currency,
+            )
+        except (AttributeError, ValidationError):
+            # As in the serial path, e.g. when there is no base band
+            return None
+        new_band = models.Band(
+            size=old_band.size,
+            level=old_band.level,
+            country=old_band.country,
+            currency=old_band.currency,
+            category='calculated',
+            fee=fee,
+            warnings=warnings,
+            billing_agent=logic.determine_billing_agent(old_band.country),
+            datetime=now,
+            dependency_fingerprint=dependency_fingerprint,
+        )
+        # bulk_create skips Band.save, which sets the lookup fields
+        new_band.set_lookup_fields()
+        return new_band
+
+    @staticmethod
+    def save_bands_in_bulk(new_bands, year, batch_size):
+        """
+        Reuses matching bands from this year, as BandForm does,
+        and creates the rest
+        :new_bands: dict of fingerprints and unsaved bands,
+                    which are given primary keys
+        """
+        fingerprints = list(new_bands)
+        existing = {}
+        for start in range(0, len(fingerprints), batch_size):
+            for band in models.Band.objects.filter(
+                category='calculated',
+                year=year,
+                fingerprint__in=fingerprints[start:start + batch_size],
+            ).order_by('datetime', 'pk'):
+                # Later bands replace earlier ones, leaving the latest
+                existing[band.fingerprint] = band
+        reused = []
+        for fingerprint, band in existing.items():
+            new_bands[fingerprint].pk = band.pk
+            new_bands[fingerprint].datetime = band.datetime
+            if band.dependency_fingerprint != \
+                    new_bands[fingerprint].dependency_fingerprint:
+                reused.append(new_bands[fingerprint])
+        models.Band.objects.bulk_update(
+            reused,
+            ['dependency_fingerprint'],
+            batch_size=batch_size,
+        )
+
+        to_create = [band for band in new_bands.values() if not band.pk]
+        # A band saved by a signup since the lookup above is left
+        # in place by the unique constraint, and picked up below
+        models.Band.objects.bulk_create(
+            to_create,
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+
+        # Primary keys are not returned when conflicts are ignored
+        missing = [band.fingerprint for band in to_create if not band.pk]
+        for start in range(0, len(missing), batch_size):
+            for pk, fingerprint in models.Band.objects.filter(
+                category='calculated',
+                year=year,
+                fingerprint__in=missing[start:start + batch_size],
+            ).values_list('pk', 'fingerprint'):
+                new_bands[fingerprint].pk = pk
+
+    @staticmethod
+    def save_old_bands_in_bulk(old_bands, batch_size):
+        # Skips history rows that already exist, as get_or_create would
+        supporter_ids = [old_band.supporter.pk for old_band in old_bands]
+        existing = set()
+        for start in range(0, len(supporter_ids), batch_size):
+            existing.update(
+                models.OldBand.objects.filter(
+                    supporter_id__in=supporter_ids[start:start + batch_size],
+                ).values_list('supporter_id', 'band_id')
+            )
+        models.OldBand.objects.bulk_create(
+            [
+                old_band for old_band in old_bands
+                if (old_band.supporter.pk, old_band.band.pk) not in existing
+            ],
+            batch_size=batch_size,
+        )
@@ -1,3 +1,5 @@
+import os
+
 from django.core.management.base import BaseCommand
 
 from plugins.consortial_billing import utils, logic
@@ -11,25 +13,84 @@ class Command(BaseCommand):
 
     help = """
            Gets data from the World Bank API.
-           Takes an indicator code such as NY.GNP.PCAP.CD or PA.NUS.FCRF
+           Takes one or more indicator codes such as NY.GNP.PCAP.CD or PA.NUS.FCRF
            """
 
     def add_arguments(self, parser):
-        parser.add_argument('indicator', type=str)
+        parser.add_argument('indicators', nargs='+', type=str)
+        parser.add_argument(
+            '--parallel',
+            action='store_true',
+            help='Fetch all years and indicators at once '
+                 'over a pooled connection, retrying failures',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=utils.FETCH_WORKERS,
+            help='How many requests to make at once with --parallel',
+        )
 
     def handle(self, *args, **options):
-        indicator = options['indicator']
-        for year in logic.last_five_years():
-            status_code = utils.fetch_world_bank_data(indicator, year)
-            if status_code == 200:
+        indicators = options['indicators']
+        years = logic.last_five_years()
+        changes = {}
+        if options['parallel']:
+            status_codes = utils.fetch_world_bank_datasets(
+                indicators,
+                years,
+                workers=options['workers'],
+                changes=changes,
+            )
+        else:
+            status_codes = {
+                (indicator, year): utils.fetch_world_bank_data(
+                    indicator,
+                    year,
+                    changes=changes,
+                )
+                for indicator in indicators for year in years
+            }
+        for (indicator, year), status_code in sorted(status_codes.items()):
+            if status_code != 200:
+                logger.warning(
+                    self.style.WARNING(
+                        f'Could not get {indicator} {year} data'
+                    )
+                )
+            elif changes.get((indicator, year)):
+                changed = changes[(indicator, year)]
                 logger.info(
                     self.style.SUCCESS(
-                        f'Got new {year} data'
+                        f'Got new {indicator} {year} data '
+                        f'for {len(changed)} countries'
                     )
                 )
             else:
-                logger.warning(
-                    self.style.WARNING(
-                        f'Could not get {year} data'
-                    )
+                logger.info(f'{indicator} {year} data is unchanged')
+        for indicator in indicators:
+            if not any(
+                changed for (changed_indicator, _year), changed
+                in changes.items() if changed_indicator == indicator
+            ):
+                logger.info(f'No changes to {indicator} data')
+                continue
+            indexed = utils.rebuild_latest_indicator_values(indicator)
+            logger.info(
+                self.style.SUCCESS(
+                    f'Indexed latest {indicator} data for {indexed} countries'
+                )
+            )
+        if any(changes.values()) or \
+                not os.path.exists(utils.indicator_snapshot_path()):
+            datasets = utils.write_indicator_snapshot()
+            logger.info(
+                self.style.SUCCESS(
+                    f'Wrote indicator snapshot with {datasets} datasets'
                 )
+            )
+        quotes = logic.rebuild_stale_fee_quotes()
+        if quotes:
+            logger.info(
+                self.style.SUCCESS(f'Built {quotes} fee quotes')
+            )
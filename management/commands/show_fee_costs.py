@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from plugins.consortial_billing import costs
+
+
+class Command(BaseCommand):
+
+    help = """
+           Shows the database queries, media file opens, JSON parses
+           and milliseconds that fee calculations have cost,
+           for each endpoint, averaged per call.
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Clear the recorded costs after showing them',
+        )
+
+    def handle(self, *args, **options):
+        rows = costs.get_cost_summary()
+        if not rows:
+            self.stdout.write('No fee calculation costs recorded')
+        for row in rows:
+            self.stdout.write(
+                f"{row['endpoint']} {row['operation']}: "
+                f"{row['calls']} calls, "
+                f"{row['queries_per_call']} queries, "
+                f"{row['media_file_opens_per_call']} media file opens, "
+                f"{row['json_parses_per_call']} JSON parses, "
+                f"{row['ms_per_call']} ms per call "
+                f"(max {row['max_ms']} ms)"
+            )
+        if options['reset']:
+            costs.clear_costs()
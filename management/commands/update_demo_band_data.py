@@ -13,9 +13,18 @@ class Command(BaseCommand):
            Creates demo bands for display
            """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fixed-point',
+            action='store_true',
+            help='Calculate fees with fixed-point integer arithmetic',
+        )
+
     def handle(self, *args, **options):
 
-        saved_file = supporter_utils.update_demo_band_data()
+        saved_file = supporter_utils.update_demo_band_data(
+            fixed_point=options['fixed_point'],
+        )
         logger.info(
             self.style.SUCCESS(
                 f'Saved demo band data:\n{saved_file}'
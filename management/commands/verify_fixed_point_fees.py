@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from plugins.consortial_billing import logic
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = """
+           Checks that the fixed-point fee path gives the same fees
+           and warnings as the Decimal path, for every size, level,
+           country and currency. Fails if any fee differs.
+           """
+
+    def handle(self, *args, **options):
+        checked, fallbacks, mismatches = logic.verify_fixed_point_fees()
+        for (size, level, code, currency), expected, result in mismatches:
+            logger.warning(
+                self.style.WARNING(
+                    f'{size}, {level}, {code}, {currency}: '
+                    f'Decimal gave {expected}, fixed point gave {result}'
+                )
+            )
+        if mismatches:
+            raise CommandError(
+                f'{len(mismatches)} of {checked} fixed-point fees differ'
+            )
+        logger.info(
+            self.style.SUCCESS(
+                f'All {checked} fixed-point fees match '
+                f'({fallbacks} worked out with Decimal)'
+            )
+        )
@@ -0,0 +1,68 @@
+__copyright__ = "Copyright 2023 Birkbeck, University of London"
+__author__ = "Open Library of Humanities"
+__license__ = "AGPL v3"
+__maintainer__ = "Open Library of Humanities"
+
+import contextlib
+import contextvars
+import functools
+
+
+memo_scope = contextvars.ContextVar('consortial_billing_memo', default=None)
+
+
+@contextlib.contextmanager
+def memo_context():
+    """
+    Within this context, functions decorated with memoize
+    compute each result once. Use it around a request or a
+    management command; it also works as a view decorator.
+    A nested context shares the memo of the outer one.
+    """
+    if memo_scope.get() is not None:
+        yield
+        return
+    token = memo_scope.set({})
+    try:
+        yield
+    finally:
+        memo_scope.reset(token)
+
+
+def memoize(function):
+    """
+    Caches results for the current memo_context by arguments.
+    Outside a memo context, the function is called as normal.
+    Callers should not mutate the results.
+    """
+    name = (
+        getattr(function, '__module__', None),
+        getattr(function, '__qualname__', repr(function)),
+    )
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        results = memo_scope.get()
+        if results is None:
+            return function(*args, **kwargs)
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            if key in results:
+                return results[key]
+        except TypeError:
+            # Unhashable arguments
+            return function(*args, **kwargs)
+        results[key] = function(*args, **kwargs)
+        return results[key]
+
+    def cache_clear():
+        """
+        Forgets this function's results in the current memo context
+        """
+        results = memo_scope.get()
+        if results:
+            for key in [key for key in results if key[0] == name]:
+                del results[key]
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0057_alter_supporter_internal_notes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndicatorObservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('indicator', models.CharField(help_text='World Bank indicator code, e.g. PA.NUS.FCRF', max_length=30)),
+                ('country', models.CharField(help_text='Three-letter country or region code in World Bank data, e.g. GBR', max_length=3)),
+                ('year', models.IntegerField()),
+                ('value', models.DecimalField(blank=True, decimal_places=17, max_digits=32, null=True)),
+            ],
+            options={
+                'ordering': ('indicator', 'year', 'country'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='indicatorobservation',
+            constraint=models.UniqueConstraint(fields=('indicator', 'year', 'country'), name='unique_indicator_observation'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.16 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0058_indicatorobservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestIndicatorValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('indicator', models.CharField(help_text='World Bank indicator code, e.g. PA.NUS.FCRF', max_length=30)),
+                ('country', models.CharField(help_text='Three-letter country or region code in World Bank data, e.g. GBR', max_length=3)),
+                ('year', models.IntegerField(help_text='The year the value comes from')),
+                ('value', models.DecimalField(decimal_places=17, max_digits=32)),
+            ],
+            options={
+                'ordering': ('indicator', 'country'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='latestindicatorvalue',
+            constraint=models.UniqueConstraint(fields=('indicator', 'country'), name='unique_latest_indicator_value'),
+        ),
+    ]
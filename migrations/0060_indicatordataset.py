@@ -0,0 +1,32 @@
+# Generated by Django 4.2.16 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0059_latestindicatorvalue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndicatorDataset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('indicator', models.CharField(help_text='World Bank indicator code, e.g. PA.NUS.FCRF', max_length=30)),
+                ('year', models.IntegerField()),
+                ('content_hash', models.CharField(help_text='SHA-256 of the saved API response', max_length=64)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now, help_text='When the saved content last changed')),
+                ('checked', models.DateTimeField(default=django.utils.timezone.now, help_text='When the content was last fetched')),
+            ],
+            options={
+                'ordering': ('indicator', 'year'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='indicatordataset',
+            constraint=models.UniqueConstraint(fields=('indicator', 'year'), name='unique_indicator_dataset'),
+        ),
+    ]
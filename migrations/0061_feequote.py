@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import django_countries.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0060_indicatordataset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeeQuote',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', django_countries.fields.CountryField(max_length=2)),
+                ('fee', models.IntegerField()),
+                ('warnings', models.CharField(blank=True, max_length=255)),
+                ('built', models.DateTimeField(default=django.utils.timezone.now)),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='consortial_billing.currency')),
+                ('level', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='consortial_billing.supportlevel')),
+                ('size', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='consortial_billing.supportersize')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='feequote',
+            constraint=models.UniqueConstraint(fields=('size', 'level', 'country', 'currency'), name='unique_fee_quote'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.16 on 2026-10-18 14:05
+
+import hashlib
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_band_lookup_fields(apps, schema_editor):
+    # Mirrors Band.get_fingerprint, which is not available
+    # on the historical model
+    Band = apps.get_model('consortial_billing', 'Band')
+    for band in Band.objects.all().iterator():
+        values = [
+            band.level_id,
+            band.size_id,
+            getattr(band.country, 'code', band.country),
+            band.currency_id,
+            band.billing_agent_id,
+            band.category,
+            band.fee,
+            band.warnings,
+        ]
+        key = '|'.join(str(value) for value in values)
+        band.year = timezone.localtime(band.datetime).year
+        band.fingerprint = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        band.save(update_fields=['year', 'fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0061_feequote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='band',
+            name='year',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='The year the band was created, for looking up duplicates', null=True),
+        ),
+        migrations.AddField(
+            model_name='band',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='A hash of the fields that make two bands interchangeable', max_length=64),
+        ),
+        migrations.RunPython(
+            fill_band_lookup_fields,
+            reverse_code=migrations.RunPython.noop,
+        ),
+        migrations.AddIndex(
+            model_name='band',
+            index=models.Index(fields=['category', 'year', 'fingerprint'], name='band_lookup_idx'),
+        ),
+    ]
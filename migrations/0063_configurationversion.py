@@ -0,0 +1,27 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0062_band_lookup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigurationVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='feequote',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, help_text='The configuration version the quote was built from'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0063_configurationversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='band',
+            name='dependency_fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='A hash of everything the fee was calculated from, so that incremental recalculation can skip it', max_length=64),
+        ),
+    ]
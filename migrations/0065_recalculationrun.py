@@ -0,0 +1,32 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0064_band_dependency_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecalculationRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('complete', 'Complete'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('save_fees', models.BooleanField(default=False, help_text='Whether new fees replace old ones, rather than being proposed')),
+                ('fixed_point', models.BooleanField(default=False)),
+                ('incremental', models.BooleanField(default=False)),
+                ('bulk', models.BooleanField(default=False)),
+                ('total', models.PositiveIntegerField(default=0, help_text='The number of active supporters when the run started')),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('last_supporter_id', models.PositiveIntegerField(blank=True, help_text='Supporters up to this id have been processed', null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+    ]
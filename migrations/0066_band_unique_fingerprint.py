@@ -0,0 +1,52 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+def clear_unmatched_fingerprints(apps, schema_editor):
+    # Only calculated bands are matched, and only the latest of
+    # any duplicates made before the constraint keeps its fingerprint
+    Band = apps.get_model('consortial_billing', 'Band')
+    Band.objects.exclude(category='calculated').update(fingerprint=None)
+    Band.objects.filter(fingerprint='').update(fingerprint=None)
+    seen = set()
+    duplicates = []
+    for pk, year, fingerprint in Band.objects.filter(
+        fingerprint__isnull=False,
+    ).order_by(
+        '-datetime', '-pk',
+    ).values_list('pk', 'year', 'fingerprint').iterator():
+        if (year, fingerprint) in seen:
+            duplicates.append(pk)
+        seen.add((year, fingerprint))
+    for start in range(0, len(duplicates), 500):
+        Band.objects.filter(
+            pk__in=duplicates[start:start + 500],
+        ).update(fingerprint=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('consortial_billing', '0065_recalculationrun'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='band',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='A hash of the fields that make two calculated bands interchangeable. Unique within a year.', max_length=64, null=True),
+        ),
+        migrations.RunPython(
+            clear_unmatched_fingerprints,
+            reverse_code=migrations.RunPython.noop,
+        ),
+        migrations.RemoveIndex(
+            model_name='band',
+            name='band_lookup_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='band',
+            constraint=models.UniqueConstraint(fields=('year', 'fingerprint'), name='unique_calculated_band'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 import uuid
+import hashlib
 import os
 import re
 import decimal
@@ -10,12 +11,16 @@ from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.core.exceptions import ValidationError
 from django.shortcuts import reverse
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 
 from django_countries.fields import CountryField
 
-from plugins.consortial_billing import utils, logic, plugin_settings
+from plugins.consortial_billing import utils, logic, plugin_settings, costs
 
 from core.model_utils import JanewayBleachField
+from core.models import Setting, SettingValue
+from cms.models import MediaFile
 from utils.logger import get_logger
 logger = get_logger(__name__)
 
@@ -36,6 +41,112 @@ BAND_CATEGORY_CHOICES = [
 ]
 
 
+RECALCULATION_STATUS_CHOICES = [
+    ('running', 'Running'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+]
+
+
+class ConfigurationQuerySet(models.QuerySet):
+    """
+    Announces configuration changes made by queryset writes,
+    which skip Model.save and the post_save signal.
+    Deletes send post_delete for each object, so they are
+    picked up by the receivers at the end of this module.
+    """
+
+    def changes_configuration(self, fields, objs=None):
+        return True
+
+    def update(self, **kwargs):
+        changes = self.changes_configuration(kwargs)
+        rows = super().update(**kwargs)
+        if rows and changes:
+            logic.configuration_changed()
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        if objs and self.changes_configuration([], objs):
+            logic.configuration_changed()
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        if rows and self.changes_configuration(fields, objs):
+            logic.configuration_changed()
+        return rows
+
+
+class BandQuerySet(ConfigurationQuerySet):
+    """
+    Only base bands are configuration, so writes that
+    touch calculated or special bands alone are not announced
+    """
+
+    def changes_configuration(self, fields, objs=None):
+        if 'category' in fields:
+            return True
+        if objs is not None:
+            return any(band.category == 'base' for band in objs)
+        return self.filter(category='base').exists()
+
+    def update(self, **kwargs):
+        # Keep the lookup fields in step, since Band.save is skipped
+        if not Band.LOOKUP_INPUTS.intersection(kwargs):
+            return super().update(**kwargs)
+        pks = list(self.values_list('pk', flat=True))
+        rows = super().update(**kwargs)
+        Band.objects.filter(pk__in=pks).refresh_lookup_fields()
+        return rows
+
+    def refresh_lookup_fields(self):
+        """
+        Recalculates the year and fingerprint of each band.
+        Where a fingerprint is already taken, the band is left
+        without one, so it is not matched.
+        """
+        bands = list(self)
+        pks = [band.pk for band in bands]
+        for band in bands:
+            band.set_lookup_fields()
+        taken = set(
+            Band.objects.exclude(
+                pk__in=pks,
+            ).filter(
+                fingerprint__in=[band.fingerprint for band in bands],
+            ).values_list('year', 'fingerprint')
+        )
+        for band in bands:
+            if band.fingerprint:
+                if (band.year, band.fingerprint) in taken:
+                    band.fingerprint = None
+                taken.add((band.year, band.fingerprint))
+        # Clear the old values first, so that bands swapping
+        # fingerprints do not collide part way through
+        Band.objects.filter(pk__in=pks).update(fingerprint=None)
+        Band.objects.bulk_update(bands, ['year', 'fingerprint'])
+
+
+class ConfigurationVersion(models.Model):
+    """
+    A counter that goes up whenever the billing configuration
+    or indicator data changes. Plugin caches key on it,
+    so that they can be long-lived and still correct.
+    """
+    version = models.PositiveBigIntegerField(
+        default=0,
+    )
+    updated = models.DateTimeField(
+        default=timezone.now,
+    )
+
+    def __str__(self):
+        return f'Configuration version {self.version}'
+
+
 class BillingAgent(models.Model):
     name = models.CharField(
         max_length=255,
@@ -56,6 +167,8 @@ class BillingAgent(models.Model):
                   'to complete the sign-up process',
     )
 
+    objects = ConfigurationQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         if self.default:
             self.country = None
@@ -115,6 +228,8 @@ class SupporterSize(models.Model):
                   "for when it needs updating next",
     )
 
+    objects = ConfigurationQuerySet.as_manager()
+
     def __str__(self):
         if self.description:
             return f'{self.name} ({self.description})'
@@ -156,6 +271,8 @@ class SupportLevel(models.Model):
                   "for when it needs updating next",
     )
 
+    objects = ConfigurationQuerySet.as_manager()
+
     class Meta:
         ordering = ('order', 'name')
 
@@ -194,6 +311,8 @@ class Currency(models.Model):
                   "for when it needs updating next",
     )
 
+    objects = ConfigurationQuerySet.as_manager()
+
     def exchange_rate(self, base_band=None) -> Tuple[decimal.Decimal, str]:
         """
         Gets most up-to-date multiplier for exchange rate
@@ -223,12 +342,21 @@ class Currency(models.Model):
     def convert_from(self, value, origin_currency):
         if not isinstance(origin_currency, Currency):
             try:
-                currency = Currency.objects.get(code=origin_currency)
+                origin_currency = Currency.objects.get(code=origin_currency)
             except Currency.DoesNotExist:
                 logger.error(f'{origin_currency} is not a recognized currency code.')
-        target_exchange_rate, _warnings = self.exchange_rate()
-        origin_exchange_rate, _warnings = origin_currency.exchange_rate()
-        return value * (target_exchange_rate / origin_exchange_rate)
+                return value
+        try:
+            return logic.get_exchange_rate_matrix().convert(
+                value,
+                origin_currency,
+                self,
+            )
+        except KeyError:
+            # The currency is not saved yet, so it is not in the matrix
+            target_exchange_rate, _warnings = self.exchange_rate()
+            origin_exchange_rate, _warnings = origin_currency.exchange_rate()
+            return value * (target_exchange_rate / origin_exchange_rate)
 
     def __str__(self):
         return self.code
@@ -292,6 +420,42 @@ class Band(models.Model):
                   'or result of fee calculation, or as a special band '
                   'for one supporter with a manually set fee.',
     )
+    year = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+        help_text='The year the band was created, for looking up duplicates',
+    )
+    fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        editable=False,
+        help_text='A hash of the fields that make two calculated bands '
+                  'interchangeable. Unique within a year.',
+    )
+    dependency_fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        editable=False,
+        help_text='A hash of everything the fee was calculated from, '
+                  'so that incremental recalculation can skip it',
+    )
+
+    objects = BandQuerySet.as_manager()
+
+    # Fields that the year and fingerprint are worked out from
+    LOOKUP_INPUTS = {
+        'level', 'level_id',
+        'size', 'size_id',
+        'country',
+        'currency', 'currency_id',
+        'billing_agent', 'billing_agent_id',
+        'category',
+        'fee',
+        'warnings',
+        'datetime',
+    }
 
     @property
     def economic_disparity(self) -> Tuple[decimal.Decimal, str]:
@@ -302,6 +466,12 @@ class Band(models.Model):
                  matching country data could not be found
         """
         base_band = logic.get_base_band(level=self.level, country=self.country)
+        return self.economic_disparity_from(base_band)
+
+    def economic_disparity_from(self, base_band) -> Tuple[decimal.Decimal, str]:
+        """
+        :base_band: the base band for this band's level and country
+        """
         base_key = base_band.country.alpha3
         warning = utils.setting('missing_data_economic_disparity')
 
@@ -320,8 +490,13 @@ class Band(models.Model):
         and the base band institution size
         :return: decimal.Decimal
         """
-        base_band = logic.get_base_band(self.level)
         base_band = logic.get_base_band(level=self.level, country=self.country)
+        return self.size_difference_from(base_band)
+
+    def size_difference_from(self, base_band) -> decimal.Decimal:
+        """
+        :base_band: the base band for this band's level and country
+        """
         return self.size.multiplier / base_band.size.multiplier
 
     @property
@@ -333,6 +508,12 @@ class Band(models.Model):
         and a string warning if no data
         """
         base_band = logic.get_base_band(level=self.level, country=self.country)
+        return self.exchange_rate_from(base_band)
+
+    def exchange_rate_from(self, base_band) -> Tuple[decimal.Decimal, str]:
+        """
+        :base_band: the base band for this band's level and country
+        """
         return self.currency.exchange_rate(base_band=base_band)
 
     def fee_in_currency(self, currency):
@@ -341,11 +522,11 @@ class Band(models.Model):
                 currency = Currency.objects.get(code=currency)
             except Currency.DoesNotExist:
                 logger.error(f'{currency} is not a recognized currency code.')
+                return self.fee
 
-        target_exchange_rate, _warnings = currency.exchange_rate()
-        origin_exchange_rate, _warnings = self.exchange_rate
-        return self.fee * (target_exchange_rate / origin_exchange_rate)
+        return currency.convert_from(self.fee, self.currency)
 
+    @costs.measure('band_calculate_fee')
     def calculate_fee(self) -> Tuple[int, str]:
         """
         Given institution size, supporter level, country,
@@ -366,10 +547,10 @@ class Band(models.Model):
 
         warnings = ''
 
-        if self.country in logic.countries_with_billing_agents():
-            fee = logic.get_base_band(level=self.level, country=self.country).fee
-        else:
-            fee = logic.get_base_band(level=self.level).fee
+        # Outside billing agent countries this is the same band
+        # as the base band for the level alone
+        base_band = logic.get_base_band(level=self.level, country=self.country)
+        fee = base_band.fee
         if fee is None:
             logger.error(
                 'No fee has been set on base band'
@@ -379,15 +560,15 @@ class Band(models.Model):
         # but only for standard (default) support levels,
         # not for higher supporters
         if self.level.default:
-            fee *= self.size_difference
+            fee *= self.size_difference_from(base_band)
 
         # Account for country
-        disparity, warning = self.economic_disparity
+        disparity, warning = self.economic_disparity_from(base_band)
         fee *= disparity
         warnings += warning
 
         # Convert into preferred currency
-        rate, warning = self.exchange_rate
+        rate, warning = self.exchange_rate_from(base_band)
         fee *= rate
         warnings += warning
 
@@ -402,7 +583,43 @@ class Band(models.Model):
     def determine_billing_agent(self):
         return logic.determine_billing_agent(self.country)
 
-    def save(self, *args, **kwargs):
+    def get_fingerprint(self) -> str:
+        """
+        Hashes the inputs and result of the fee calculation,
+        so that matching bands can be found with one indexed lookup
+        :return: a hex digest
+        """
+        values = [
+            self.level_id,
+            self.size_id,
+            getattr(self.country, 'code', self.country),
+            self.currency_id,
+            self.billing_agent_id,
+            self.category,
+            self.fee,
+            self.warnings,
+        ]
+        key = '|'.join(str(value) for value in values)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def set_lookup_fields(self):
+        """
+        Sets the year and, for calculated bands, the fingerprint.
+        Other bands are never matched, so they have none.
+        """
+        self.year = timezone.localtime(self.datetime).year
+        if self.category == 'calculated':
+            self.fingerprint = self.get_fingerprint()
+        else:
+            self.fingerprint = None
+
+    def save(self, *args, claim_fingerprint=False, **kwargs):
+        """
+        :claim_fingerprint: whether to let the unique constraint raise
+            IntegrityError when a matching band already exists, rather
+            than saving this one without a fingerprint. BaseBandForm
+            uses it to tell when it has lost a race.
+        """
         # Calculate fee if appropriate
         if not self.fee and self.category == 'calculated':
             self.fee, self.warnings = self.calculate_fee()
@@ -419,6 +636,15 @@ class Band(models.Model):
         # to do: change the type if the fee entered is
         # different than the calculated one
 
+        self.set_lookup_fields()
+        if self.fingerprint and not claim_fingerprint and Band.objects.filter(
+            year=self.year,
+            fingerprint=self.fingerprint,
+        ).exclude(pk=self.pk).exists():
+            # This band is the same as another one, so it is saved
+            # as a duplicate that lookups will not find
+            self.fingerprint = None
+
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -432,6 +658,12 @@ class Band(models.Model):
 
     class Meta:
         get_latest_by = 'datetime'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['year', 'fingerprint'],
+                name='unique_calculated_band',
+            ),
+        ]
 
 
 class OldBand(models.Model):
@@ -602,6 +834,250 @@ class SupporterContact(models.Model):
         return f'{self.account} <{self.email}>'
 
 
+class IndicatorObservation(models.Model):
+    """
+    One value from a World Bank dataset, stored so that the fee
+    calculator can look up values without opening the saved JSON files
+    """
+    indicator = models.CharField(
+        max_length=30,
+        help_text='World Bank indicator code, e.g. PA.NUS.FCRF',
+    )
+    country = models.CharField(
+        max_length=3,
+        help_text='Three-letter country or region code '
+                  'in World Bank data, e.g. GBR',
+    )
+    year = models.IntegerField()
+    value = models.DecimalField(
+        blank=True,
+        null=True,
+        max_digits=32,
+        decimal_places=17,
+    )
+
+    def __str__(self):
+        return f'{self.indicator} {self.country} {self.year}: {self.value}'
+
+    class Meta:
+        ordering = ('indicator', 'year', 'country')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['indicator', 'year', 'country'],
+                name='unique_indicator_observation',
+            ),
+        ]
+
+
+class LatestIndicatorValue(models.Model):
+    """
+    The latest non-empty value of an indicator for a country,
+    rebuilt from IndicatorObservation whenever new data is fetched
+    """
+    indicator = models.CharField(
+        max_length=30,
+        help_text='World Bank indicator code, e.g. PA.NUS.FCRF',
+    )
+    country = models.CharField(
+        max_length=3,
+        help_text='Three-letter country or region code '
+                  'in World Bank data, e.g. GBR',
+    )
+    year = models.IntegerField(
+        help_text='The year the value comes from',
+    )
+    value = models.DecimalField(
+        max_digits=32,
+        decimal_places=17,
+    )
+
+    def __str__(self):
+        return f'{self.indicator} {self.country}: {self.value} ({self.year})'
+
+    class Meta:
+        ordering = ('indicator', 'country')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['indicator', 'country'],
+                name='unique_latest_indicator_value',
+            ),
+        ]
+
+
+class IndicatorDataset(models.Model):
+    """
+    A record of the World Bank dataset saved for an indicator and year,
+    with a hash of its content so that unchanged re-fetches can be skipped
+    """
+    indicator = models.CharField(
+        max_length=30,
+        help_text='World Bank indicator code, e.g. PA.NUS.FCRF',
+    )
+    year = models.IntegerField()
+    content_hash = models.CharField(
+        max_length=64,
+        help_text='SHA-256 of the saved API response',
+    )
+    updated = models.DateTimeField(
+        default=timezone.now,
+        help_text='When the saved content last changed',
+    )
+    checked = models.DateTimeField(
+        default=timezone.now,
+        help_text='When the content was last fetched',
+    )
+
+    def __str__(self):
+        return f'{self.indicator} {self.year}'
+
+    class Meta:
+        ordering = ('indicator', 'year')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['indicator', 'year'],
+                name='unique_indicator_dataset',
+            ),
+        ]
+
+
+class FeeQuote(models.Model):
+    """
+    A precomputed fee for one combination of size, level, country
+    and currency, so that signup calculations can be looked up.
+    The grid is cleared and rebuilt when the configuration
+    or the indicator data it was built from changes, and quotes
+    from an older configuration version are never used.
+    """
+    size = models.ForeignKey(
+        SupporterSize,
+        on_delete=models.CASCADE,
+    )
+    level = models.ForeignKey(
+        SupportLevel,
+        on_delete=models.CASCADE,
+    )
+    country = CountryField()
+    currency = models.ForeignKey(
+        Currency,
+        on_delete=models.CASCADE,
+    )
+    fee = models.IntegerField()
+    warnings = models.CharField(
+        max_length=255,
+        blank=True,
+    )
+    built = models.DateTimeField(
+        default=timezone.now,
+    )
+    version = models.PositiveBigIntegerField(
+        default=0,
+        help_text='The configuration version the quote was built from',
+    )
+
+    def __str__(self):
+        return f'{self.size}, {self.level}, {self.country}, ' \
+               f'{self.currency}: {self.fee}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['size', 'level', 'country', 'currency'],
+                name='unique_fee_quote',
+            ),
+        ]
+
+
+class RecalculationRun(models.Model):
+    """
+    One run of calculate_all_fees. Supporters are processed in order
+    of id, and the cursor is saved in the same transaction as each
+    batch, so a run that is interrupted can be resumed from the last
+    batch that was committed.
+    """
+    started = models.DateTimeField(
+        default=timezone.now,
+    )
+    updated = models.DateTimeField(
+        default=timezone.now,
+    )
+    finished = models.DateTimeField(
+        blank=True,
+        null=True,
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=RECALCULATION_STATUS_CHOICES,
+        default='running',
+    )
+    save_fees = models.BooleanField(
+        default=False,
+        help_text='Whether new fees replace old ones, '
+                  'rather than being proposed',
+    )
+    fixed_point = models.BooleanField(
+        default=False,
+    )
+    incremental = models.BooleanField(
+        default=False,
+    )
+    bulk = models.BooleanField(
+        default=False,
+    )
+    total = models.PositiveIntegerField(
+        default=0,
+        help_text='The number of active supporters when the run started',
+    )
+    processed = models.PositiveIntegerField(
+        default=0,
+    )
+    last_supporter_id = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text='Supporters up to this id have been processed',
+    )
+    error = models.TextField(
+        blank=True,
+    )
+
+    def __str__(self):
+        return f'Recalculation run {self.pk} ({self.status})'
+
+    @property
+    def percent_complete(self):
+        if not self.total:
+            return 100 if self.status == 'complete' else 0
+        return min(100, self.processed * 100 // self.total)
+
+    def get_options(self):
+        """
+        :return: the calculate_all_fees options the run was started with
+        """
+        return {
+            'save': self.save_fees,
+            'fixed_point': self.fixed_point,
+            'incremental': self.incremental,
+            'bulk': self.bulk,
+        }
+
+    def checkpoint(self, supporters):
+        """
+        Moves the cursor past a batch of supporters.
+        Call it inside the transaction that saves the batch.
+        """
+        self.last_supporter_id = supporters[-1].pk
+        self.processed += len(supporters)
+        self.updated = timezone.now()
+        self.save(
+            update_fields=['last_supporter_id', 'processed', 'updated'],
+        )
+
+    def finish(self, status, error=''):
+        self.status = status
+        self.error = error
+        self.updated = self.finished = timezone.now()
+        self.save()
+
+
 # Keep this for old migrations
 def file_upload_path(instance, filename):
     try:
@@ -611,3 +1087,64 @@ def file_upload_path(instance, filename):
 
     path = "plugins/{0}/".format(plugin_settings.SHORT_NAME)
     return os.path.join(path, filename)
+
+
+# Announce every change to what fees and display tables depend on
+
+FEE_SETTING_NAMES = {
+    'minimum_fee',
+    'missing_data_economic_disparity',
+    'missing_data_exchange_rate',
+}
+
+
+@receiver(post_save, sender=BillingAgent)
+@receiver(post_delete, sender=BillingAgent)
+@receiver(post_save, sender=SupporterSize)
+@receiver(post_delete, sender=SupporterSize)
+@receiver(post_save, sender=SupportLevel)
+@receiver(post_delete, sender=SupportLevel)
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+def fee_configuration_changed(sender, instance, **kwargs):
+    logic.configuration_changed()
+
+
+@receiver(pre_save, sender=Band)
+def remember_base_band(sender, instance, **kwargs):
+    instance._was_base = bool(
+        instance.pk
+        and instance.category != 'base'
+        and Band.objects.filter(pk=instance.pk, category='base').exists()
+    )
+
+
+@receiver(post_save, sender=Band)
+@receiver(post_delete, sender=Band)
+def base_band_changed(sender, instance, **kwargs):
+    if instance.category == 'base' or getattr(instance, '_was_base', False):
+        logic.configuration_changed()
+
+
+@receiver(post_save, sender=SettingValue)
+def fee_setting_changed(sender, instance, **kwargs):
+    # Most setting saves belong to Janeway or other plugins,
+    # so return before doing anything else for them
+    if SettingValue.setting.is_cached(instance) \
+            and instance.setting.name not in FEE_SETTING_NAMES:
+        return
+    if Setting.objects.filter(
+        pk=instance.setting_id,
+        group__name='plugin:consortial_billing',
+        name__in=FEE_SETTING_NAMES,
+    ).exists():
+        logic.configuration_changed()
+
+
+@receiver(post_save, sender=MediaFile)
+@receiver(post_delete, sender=MediaFile)
+def indicator_file_changed(sender, instance, **kwargs):
+    # Only World Bank datasets feed into fees, not the demo data
+    if instance.label and \
+            utils.INDICATOR_DATASET_LABEL.fullmatch(instance.label):
+        logic.configuration_changed()
@@ -42,8 +42,12 @@ def install(fetch_data=False):
         file_path=f'plugins/{SHORT_NAME}/install/settings.json'
     )
     if fetch_data and not settings.IN_TEST_RUNNER:
-        call_command('fetch_world_bank_data', RATE_INDICATOR)
-        call_command('fetch_world_bank_data', DISPARITY_INDICATOR)
+        call_command(
+            'fetch_world_bank_data',
+            RATE_INDICATOR,
+            DISPARITY_INDICATOR,
+            parallel=True,
+        )
 
 
 def hook_registry():
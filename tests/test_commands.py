@@ -4,10 +4,17 @@ __license__ = "AGPL v3"
 __maintainer__ = "Open Library of Humanities"
 
 from unittest.mock import patch
+import io
+import json
+import tempfile
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import transaction
+from django.test import override_settings
 
+from plugins.consortial_billing import logic, models, plugin_settings, \
+    utils
 from plugins.consortial_billing.tests import test_models
 
 CB = 'plugins.consortial_billing'
@@ -27,6 +34,195 @@ class CommandTests(test_models.TestCaseWithData):
         self.assertIn(self.fake_indicator, utils_fetch.call_args.args)
         info.assert_called()
 
+    @patch(f'{CB}.utils.save_media_file')
+    @patch(f'{CB}.management.commands.fetch_world_bank_data.logger.warning')
+    def test_fetch_world_bank_data_parallel(self, warning, save_media_file):
+        indicators = [self.fake_indicator, 'JKL.MNO.PQR']
+        with test_models.WorldBankStub({'NLD': 123}, failures=1) as stub:
+            call_command(
+                'fetch_world_bank_data',
+                *indicators,
+                '--parallel',
+                '--workers', '2',
+            )
+        warning.assert_not_called()
+
+        # One range request per indicator, failed once and retried
+        self.assertEqual(len(stub.requests), 4)
+        self.assertEqual(save_media_file.call_count, 10)
+        for indicator in indicators:
+            self.assertEqual(
+                models.IndicatorObservation.objects.filter(
+                    indicator=indicator,
+                    country='NLD',
+                ).count(),
+                5,
+            )
+            self.assertTrue(
+                models.LatestIndicatorValue.objects.filter(
+                    indicator=indicator,
+                    country='NLD',
+                ).exists()
+            )
+
+    @patch(f'{CB}.utils.FETCH_BACKOFF', 0)
+    @patch(f'{CB}.utils.save_media_file')
+    @patch(f'{CB}.management.commands.fetch_world_bank_data.logger.warning')
+    def test_fetch_world_bank_data_parallel_gives_up(
+        self,
+        warning,
+        save_media_file,
+    ):
+        with test_models.WorldBankStub({'NLD': 123}, failures=10):
+            call_command(
+                'fetch_world_bank_data',
+                self.fake_indicator,
+                '--parallel',
+            )
+        save_media_file.assert_not_called()
+        self.assertEqual(warning.call_count, 5)
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate', return_value=(1230, ''))
+    @patch(f'{CB}.management.commands.fetch_world_bank_data.logger')
+    def test_fetch_unchanged_world_bank_data(self, _logger, _calculate):
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            with test_models.WorldBankStub({'NLD': 123}):
+                call_command(
+                    'fetch_world_bank_data',
+                    self.fake_indicator,
+                    '--parallel',
+                )
+            version = utils.get_configuration_version()
+            built = logic.fee_quotes_built()
+            self.assertIsNotNone(built)
+
+            with test_models.WorldBankStub({'NLD': 123}):
+                call_command(
+                    'fetch_world_bank_data',
+                    self.fake_indicator,
+                    '--parallel',
+                )
+        self.assertEqual(utils.get_configuration_version(), version)
+        self.assertEqual(logic.fee_quotes_built(), built)
+        self.assertEqual(
+            logic.get_fee_quote(
+                self.size_large,
+                self.level_standard,
+                'NL',
+                self.currency_eur,
+            ),
+            (1230, ''),
+        )
+
+    @patch(f'{CB}.logic.build_fee_quotes')
+    @patch(f'{CB}.management.commands.build_fee_quotes.logger.info')
+    def test_build_fee_quotes(self, info, build_fee_quotes):
+        build_fee_quotes.return_value = 4500
+        call_command('build_fee_quotes')
+        build_fee_quotes.assert_called_once()
+        self.assertIn('Built 4500 fee quotes', info.call_args.args[0])
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    def test_build_fee_quotes_if_stale(self, calculate):
+        calculate.return_value = (1230, '')
+        call_command('build_fee_quotes', '--if-stale')
+        self.assertIsNotNone(logic.fee_quotes_built())
+        with patch(f'{CB}.logic.build_fee_quotes') as build_fee_quotes:
+            call_command('build_fee_quotes', '--if-stale')
+            build_fee_quotes.assert_not_called()
+
+    @patch(f'{CB}.logic.verify_fixed_point_fees')
+    @patch(f'{CB}.management.commands.verify_fixed_point_fees.logger.info')
+    def test_verify_fixed_point_fees(self, info, verify):
+        verify.return_value = (4500, 2, [])
+        call_command('verify_fixed_point_fees')
+        self.assertIn('All 4500 fixed-point fees match', info.call_args.args[0])
+
+        band_tuple = (
+            self.size_large,
+            self.level_standard,
+            'GB',
+            self.currency_gbp,
+        )
+        verify.return_value = (4500, 2, [(band_tuple, (1500, ''), (1510, ''))])
+        with self.assertRaises(CommandError):
+            call_command('verify_fixed_point_fees')
+
+    def test_benchmark_fees_needs_empty_database(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_fees', '--scales', '20')
+
+    def test_benchmark_fees(self):
+        supporters_before = models.Supporter.objects.count()
+        output = io.StringIO()
+        call_command(
+            'benchmark_fees',
+            '--scales', '20',
+            '--sample', '3',
+            '--force',
+            stdout=output,
+        )
+        results = json.loads(output.getvalue())
+        scale = results['scales'][0]
+        self.assertEqual(scale['supporters'], 20)
+        for entry_point in [
+            'band_calculate_fee',
+            'base_band_form_save',
+            'get_base_band',
+            'get_display_bands',
+        ]:
+            self.assertIn('queries', scale['entry_points'][entry_point])
+        self.assertEqual(
+            scale['entry_points']['band_calculate_fee']['calls'],
+            3,
+        )
+        self.assertEqual(
+            scale['entry_points']['open_saved_indicator_values'][
+                'media_file_opens'
+            ],
+            10,
+        )
+
+        # The seeded data is rolled back
+        self.assertEqual(models.Supporter.objects.count(), supporters_before)
+        self.assertTrue(
+            models.Band.objects.filter(pk=self.band_base_standard_de.pk).exists()
+        )
+
+    def test_benchmark_fees_keeps_existing_indicator_files(self):
+        year = logic.last_five_years()[0]
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            content = test_models.make_world_bank_content(
+                plugin_settings.DISPARITY_INDICATOR,
+                year,
+                {'NLD': 123},
+            )
+            media_file = utils.save_media_file(
+                f'{plugin_settings.SHORT_NAME}/'
+                f'{plugin_settings.DISPARITY_INDICATOR}_{year}.json',
+                content,
+            )
+            output = io.StringIO()
+            call_command(
+                'benchmark_fees',
+                '--scales', '20',
+                '--sample', '3',
+                '--force',
+                stdout=output,
+            )
+            results = json.loads(output.getvalue())
+            self.assertEqual(
+                results['scales'][0]['entry_points'][
+                    'open_saved_indicator_values'
+                ]['calls'],
+                9,
+            )
+            media_file.refresh_from_db()
+            with media_file.file.open('rb') as file_ref:
+                self.assertEqual(file_ref.read(), content)
+
     @patch(f'{CB}.models.Band.save')
     @patch(f'{CB}.forms.BandForm.save')
     @patch(f'{CB}.management.commands.calculate_all_fees.logger.info')
@@ -45,6 +241,263 @@ class CommandTests(test_models.TestCaseWithData):
         info.assert_called()
         warning.assert_not_called()
 
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_bulk_matches_serial(self, _logger, calculate):
+        calculate.return_value = (9990, '')
+
+        def recalculate(*args):
+            with transaction.atomic():
+                call_command('calculate_all_fees', '--save', *args)
+                results = {
+                    supporter.pk: (
+                        supporter.band.fee,
+                        supporter.band.currency,
+                        supporter.band.billing_agent,
+                        models.OldBand.objects.filter(
+                            supporter=supporter,
+                        ).count(),
+                    ) for supporter in models.Supporter.objects.filter(
+                        active=True,
+                    )
+                }
+                transaction.set_rollback(True)
+            return results
+
+        serial = recalculate()
+        bulk = recalculate('--bulk', '--batch-size', '1')
+        self.assertDictEqual(serial, bulk)
+        for fee, _currency, _agent, old_bands in bulk.values():
+            self.assertEqual(fee, 9990)
+            self.assertEqual(old_bands, 1)
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_dry_run(self, _logger, calculate):
+        calculate.return_value = (9990, '')
+        supporters = models.Supporter.objects.filter(
+            active=True,
+        ).select_related('band__currency')
+        prospective_bands = {
+            supporter.pk: supporter.prospective_band_id
+            for supporter in supporters
+        }
+        bands_before = models.Band.objects.count()
+        out = io.StringIO()
+        call_command(
+            'calculate_all_fees',
+            '--dry-run',
+            '--format',
+            'jsonl',
+            stdout=out,
+        )
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        rows, summary = lines[:-1], lines[-1]['summary']
+        self.assertEqual(len(rows), summary['changed'])
+        self.assertEqual(summary['checked'], supporters.count())
+        for row in rows:
+            self.assertEqual(row['new_fee'], 9990)
+            self.assertEqual(row['delta'], 9990 - row['old_fee'])
+        expected_deltas = {}
+        for supporter in supporters:
+            if supporter.band.fee != 9990:
+                code = supporter.band.currency.code
+                expected_deltas[code] = expected_deltas.get(code, 0) \
+                    + 9990 - supporter.band.fee
+        self.assertDictEqual(summary['revenue_delta'], expected_deltas)
+
+        # Nothing was written
+        self.assertEqual(models.Band.objects.count(), bands_before)
+        self.assertDictEqual(
+            {
+                supporter.pk: supporter.prospective_band_id
+                for supporter in supporters.all()
+            },
+            prospective_bands,
+        )
+
+    @patch(f'{CB}.management.commands.calculate_all_fees.Command.recalculate_supporter')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_records_run(self, _logger, recalculate):
+        call_command('calculate_all_fees', '--batch-size', '2')
+        run = models.RecalculationRun.objects.get()
+        active = models.Supporter.objects.filter(active=True)
+        self.assertEqual(run.status, 'complete')
+        self.assertEqual(run.total, active.count())
+        self.assertEqual(run.processed, active.count())
+        self.assertEqual(run.percent_complete, 100)
+        self.assertEqual(
+            run.last_supporter_id,
+            active.order_by('pk').last().pk,
+        )
+
+    @patch(f'{CB}.management.commands.calculate_all_fees.Command.recalculate_supporter')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_resume(self, _logger, recalculate):
+        active_ids = list(
+            models.Supporter.objects.filter(
+                active=True,
+            ).order_by('pk').values_list('pk', flat=True)
+        )
+        run = models.RecalculationRun.objects.create(
+            status='failed',
+            save_fees=True,
+            total=len(active_ids),
+            processed=1,
+            last_supporter_id=active_ids[0],
+        )
+        call_command('calculate_all_fees', '--resume', str(run.pk))
+        self.assertListEqual(
+            [call.args[0].pk for call in recalculate.call_args_list],
+            active_ids[1:],
+        )
+        # The run's own options are used
+        self.assertTrue(recalculate.call_args.args[2]['save'])
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'complete')
+        self.assertEqual(run.processed, len(active_ids))
+
+    @patch(f'{CB}.management.commands.calculate_all_fees.Command.recalculate_supporter')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_failed_run(self, _logger, recalculate):
+        recalculate.side_effect = RuntimeError
+        with self.assertRaises(RuntimeError):
+            call_command('calculate_all_fees')
+        run = models.RecalculationRun.objects.get()
+        self.assertEqual(run.status, 'failed')
+        self.assertIsNone(run.last_supporter_id)
+
+        run.status = 'complete'
+        run.save()
+        with self.assertRaises(CommandError):
+            call_command('calculate_all_fees', '--resume', str(run.pk))
+
+    def test_calculate_all_fees_dry_run_not_with_save(self):
+        with self.assertRaises(CommandError):
+            call_command('calculate_all_fees', '--dry-run', '--save')
+
+    @patch(f'{CB}.logic.FeeCalculator.dependency_fingerprint')
+    @patch(f'{CB}.forms.BandForm.save')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_incremental(
+        self,
+        _logger,
+        band_form_save,
+        dependency_fingerprint,
+    ):
+        dependency_fingerprint.return_value = 'unchanged'
+        models.Band.objects.filter(
+            current_supporter__active=True,
+        ).update(
+            category='calculated',
+            dependency_fingerprint='unchanged',
+        )
+        call_command('calculate_all_fees', '--incremental')
+        band_form_save.assert_not_called()
+
+    @patch(f'{CB}.models.Band.save')
+    @patch(f'{CB}.forms.BandForm.save')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_once_per_band_tuple(
+        self,
+        _logger,
+        band_form_save,
+        band_save,
+    ):
+        models.Supporter.objects.filter(active=True).update(
+            band=self.band_calc_standard_gb_large,
+        )
+        band_form_save.return_value = self.band_calc_silver_gb_large
+        call_command('calculate_all_fees')
+        band_form_save.assert_called_once_with(commit=False)
+        band_save.assert_called_once()
+        for supporter in models.Supporter.objects.filter(active=True):
+            self.assertEqual(
+                supporter.prospective_band,
+                self.band_calc_silver_gb_large,
+            )
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_bulk_once_per_band_tuple(
+        self,
+        _logger,
+        calculate,
+    ):
+        calculate.return_value = (9990, '')
+        models.Supporter.objects.filter(active=True).update(
+            band=self.band_calc_standard_gb_large,
+        )
+        call_command(
+            'calculate_all_fees',
+            '--bulk',
+            '--save',
+            '--batch-size',
+            '1',
+        )
+        calculate.assert_called_once()
+        new_bands = set(
+            models.Supporter.objects.filter(
+                active=True,
+            ).values_list('band', flat=True)
+        )
+        self.assertEqual(len(new_bands), 1)
+        self.assertEqual(models.Band.objects.get(pk=new_bands.pop()).fee, 9990)
+
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger')
+    def test_calculate_all_fees_bulk_without_base_band(self, logger):
+        models.Band.objects.filter(category='base').delete()
+        bands = dict(
+            models.Supporter.objects.filter(
+                active=True,
+            ).values_list('pk', 'band'),
+        )
+        call_command('calculate_all_fees', '--bulk', '--save')
+        logger.warning.assert_called()
+        self.assertEqual(
+            models.RecalculationRun.objects.get().status,
+            'complete',
+        )
+        self.assertDictEqual(
+            dict(
+                models.Supporter.objects.filter(
+                    active=True,
+                ).values_list('pk', 'band'),
+            ),
+            bands,
+        )
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate_in_processes')
+    @patch(f'{CB}.models.Band.save')
+    @patch(f'{CB}.forms.BandForm.save')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger.info')
+    @patch(f'{CB}.management.commands.calculate_all_fees.logger.warning')
+    def test_calculate_all_fees_workers(
+        self,
+        warning,
+        info,
+        band_form_save,
+        band_save,
+        calculate_in_processes,
+    ):
+        calculate_in_processes.return_value = 3
+        band_form_save.return_value = self.band_calc_standard_gb_large
+        call_command('calculate_all_fees', '--workers', '2')
+        band_tuples, workers = calculate_in_processes.call_args.args
+        self.assertEqual(workers, 2)
+        self.assertIn(
+            (
+                self.band_calc_standard_gb_large.size,
+                self.band_calc_standard_gb_large.level,
+                self.band_calc_standard_gb_large.country,
+                self.band_calc_standard_gb_large.currency,
+            ),
+            band_tuples,
+        )
+        # Writes still go through the serial loop
+        band_form_save.assert_called_with(commit=False)
+        warning.assert_not_called()
+
     @patch(f'{CB}.models.Band.save')
     @patch(f'{CB}.forms.BandForm.save')
     @patch(f'{CB}.models.Supporter.save')
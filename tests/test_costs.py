@@ -0,0 +1,98 @@
+__copyright__ = "Copyright 2023 Birkbeck, University of London"
+__author__ = "Open Library of Humanities"
+__license__ = "AGPL v3"
+__maintainer__ = "Open Library of Humanities"
+
+import collections
+import io
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+
+from plugins.consortial_billing import costs, forms
+from plugins.consortial_billing.tests import test_models
+
+CB = 'plugins.consortial_billing'
+
+
+@override_settings(
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    },
+)
+class CostTests(test_models.TestCaseWithData):
+
+    def setUp(self):
+        super().setUp()
+        costs.clear_costs()
+
+    def test_measure_only_inside_context(self):
+        self.band_calc_silver_be_small.calculate_fee()
+        self.assertListEqual(costs.get_cost_summary(), [])
+
+    def test_measure_calculate_fee(self):
+        with costs.cost_context('signup'):
+            self.band_calc_silver_be_small.calculate_fee()
+            self.band_calc_standard_gb_large.calculate_fee()
+        summary = costs.get_cost_summary()
+        self.assertEqual(len(summary), 1)
+        row = summary[0]
+        self.assertEqual(row['endpoint'], 'signup')
+        self.assertEqual(row['operation'], 'band_calculate_fee')
+        self.assertEqual(row['calls'], 2)
+        self.assertGreater(row['queries'], 0)
+        self.assertIn('json_parses_per_call', row)
+
+    @patch(f'{CB}.models.Band.calculate_fee')
+    def test_measure_form_save_in_nested_context(self, calc_fee):
+        calc_fee.return_value = (1230, '')
+        data = {
+            'country': 'BE',
+            'currency': self.currency_eur,
+            'size': self.size_small,
+            'level': self.level_silver,
+            'category': 'calculated',
+        }
+        with costs.cost_context('signup'):
+            forms.BandForm(data).save(commit=False)
+            with costs.cost_context('nested'):
+                forms.BandForm(data).save(commit=False)
+        summary = costs.get_cost_summary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['operation'], 'base_band_form_save')
+        self.assertEqual(summary[0]['calls'], 2)
+
+    def test_record_costs_increments_counters(self):
+        totals = {
+            'band_calculate_fee': collections.Counter({
+                'calls': 1,
+                'queries': 3,
+                'ms': 1.5,
+                'max_ms': 1.5,
+            }),
+        }
+        costs.record_costs('signup', totals)
+        cache.delete(costs.COSTS_CACHE_KEY)
+        costs.record_costs('signup', totals)
+        summary = costs.get_cost_summary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['calls'], 2)
+        self.assertEqual(summary[0]['queries'], 6)
+        self.assertEqual(summary[0]['ms'], 3)
+        self.assertEqual(summary[0]['max_ms'], 1.5)
+        self.assertEqual(
+            cache.get(costs.counter_key('signup', 'band_calculate_fee', 'us')),
+            3000,
+        )
+
+    def test_show_fee_costs(self):
+        with costs.cost_context('manager'):
+            self.band_calc_silver_be_small.calculate_fee()
+        output = io.StringIO()
+        call_command('show_fee_costs', '--reset', stdout=output)
+        self.assertIn('manager band_calculate_fee: 1 calls', output.getvalue())
+        self.assertListEqual(costs.get_cost_summary(), [])
@@ -7,9 +7,9 @@ from copy import copy
 from datetime import timedelta
 from django.core.exceptions import ValidationError
 
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
-from plugins.consortial_billing import forms
+from plugins.consortial_billing import forms, models
 from plugins.consortial_billing.tests import test_models
 
 CB = 'plugins.consortial_billing'
@@ -42,6 +42,44 @@ class FormTests(test_models.TestCaseWithData):
         self.assertEqual(band.fee, 1000)
         self.assertEqual(band.warnings, 'Oh no!')
 
+    @patch(f'{CB}.models.Band.calculate_fee')
+    def test_band_form_save_with_fee_calculator(self, calc_fee):
+        fee_calculator = Mock()
+        fee_calculator.calculate.return_value = (1230, '')
+        data = {
+            'country': 'BE',
+            'currency': self.currency_eur,
+            'size': self.size_small,
+            'level': self.level_silver,
+            'category': 'calculated',
+        }
+        band_form = forms.BandForm(data, fee_calculator=fee_calculator)
+        band = band_form.save(commit=False)
+        calc_fee.assert_not_called()
+        fee_calculator.calculate.assert_called_once_with(
+            self.size_small,
+            self.level_silver,
+            'BE',
+            self.currency_eur,
+        )
+        self.assertEqual(band.fee, 1230)
+
+    @patch(f'{CB}.models.Band.calculate_fee')
+    @patch(f'{CB}.logic.get_fee_quote')
+    def test_band_form_save_with_fee_quote(self, get_quote, calc_fee):
+        get_quote.return_value = (1230, '')
+        data = {
+            'country': 'BE',
+            'currency': self.currency_eur,
+            'size': self.size_small,
+            'level': self.level_silver,
+            'category': 'calculated',
+        }
+        band_form = forms.BandForm(data)
+        band = band_form.save(commit=False)
+        calc_fee.assert_not_called()
+        self.assertEqual(band.fee, 1230)
+
     @patch(f'{CB}.models.Band.calculate_fee')
     @patch(f'{CB}.logic.determine_billing_agent')
     def test_band_form_save_existing_band_commit(self, det_agent, calc_fee):
@@ -83,6 +121,27 @@ class FormTests(test_models.TestCaseWithData):
         )
         band.delete()
 
+    @patch(f'{CB}.models.Band.calculate_fee')
+    @patch(f'{CB}.logic.determine_billing_agent')
+    def test_band_form_save_ignores_last_years_band(self, det_agent, calc_fee):
+        det_agent.return_value = self.agent_default
+        calc_fee.return_value = (2000, '')
+        old_band = self.band_calc_silver_be_small
+        old_band.datetime -= timedelta(days=366)
+        old_band.save()
+
+        data = {
+            'country': 'BE',
+            'currency': self.currency_eur,
+            'size': self.size_small,
+            'level': self.level_silver,
+            'category': 'calculated',
+        }
+        band_form = forms.BandForm(data)
+        band = band_form.save()
+        self.assertNotEqual(band.pk, old_band.pk)
+        band.delete()
+
     @patch(f'{CB}.models.Band.calculate_fee')
     @patch(f'{CB}.logic.determine_billing_agent')
     def test_band_form_save_handles_duplicates(self, det_agent, calc_fee):
@@ -105,3 +164,36 @@ class FormTests(test_models.TestCaseWithData):
         self.assertEqual(band.pk, self.band_calc_silver_be_small.pk)
 
         duplicate_band.delete()
+
+    @patch(f'{CB}.models.Band.calculate_fee')
+    @patch(f'{CB}.logic.determine_billing_agent')
+    def test_band_form_save_loses_race(self, det_agent, calc_fee):
+        det_agent.return_value = self.agent_default
+        calc_fee.return_value = (2000, '')
+        get_matching_band = forms.BaseBandForm.get_matching_band
+        lookups = []
+
+        def miss_first_lookup(band, lock=False):
+            # As if another request saved the band just after this lookup
+            lookups.append(lock)
+            if len(lookups) == 1:
+                return band
+            return get_matching_band(band, lock=lock)
+
+        data = {
+            'country': 'BE',
+            'currency': self.currency_eur,
+            'size': self.size_small,
+            'level': self.level_silver,
+            'category': 'calculated',
+        }
+        bands_before = models.Band.objects.count()
+        with patch.object(
+            forms.BaseBandForm,
+            'get_matching_band',
+            side_effect=miss_first_lookup,
+        ):
+            band = forms.BandForm(data).save()
+        self.assertEqual(band.pk, self.band_calc_silver_be_small.pk)
+        self.assertEqual(lookups, [False, True])
+        self.assertEqual(models.Band.objects.count(), bands_before)
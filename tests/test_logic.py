@@ -6,10 +6,14 @@ __maintainer__ = "Open Library of Humanities"
 from unittest.mock import patch
 import decimal
 
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ValidationError, \
+    ObjectDoesNotExist
+from django.core.signals import request_finished
 
-from plugins.consortial_billing import logic, models as supporter_models
+from plugins.consortial_billing import logic, utils, plugin_settings, \
+    models as supporter_models
 from plugins.consortial_billing.tests import test_models
+from utils import setting_handler
 from utils.logger import get_logger
 
 logic_logger = get_logger(logic.__name__)
@@ -26,31 +30,43 @@ class LogicTests(test_models.TestCaseWithData):
             1500,
         )
 
-    @patch(f'{CB}.utils.open_saved_world_bank_data')
+    @patch(f'{CB}.utils.open_saved_indicator_values')
     def test_get_indicator_by_country(self, open_saved):
 
-        open_saved.return_value = []
+        open_saved.return_value = {}
         data = logic.get_indicator_by_country(self.fake_indicator, 2050)
         open_saved.assert_called()
         self.assertEqual(data, {})
 
-        open_saved.return_value = ['something', None]
+        utils.indicator_cache.clear()
+        open_saved.return_value = {'NLD': 12345}
         data = logic.get_indicator_by_country(self.fake_indicator, 2050)
-        open_saved.assert_called()
-        self.assertEqual(data, {})
+        self.assertEqual(data['NLD'], 12345)
 
-        open_saved.return_value = [
-            {},
-            [
-                {
-                    'countryiso3code': 'NLD',
-                    'value': 12345,
-                }
-            ]
-        ]
+    @patch(f'{CB}.utils.open_saved_indicator_values')
+    def test_get_indicator_by_country_from_observations(self, open_saved):
+        supporter_models.IndicatorObservation.objects.create(
+            indicator=self.fake_indicator,
+            country='NLD',
+            year=2050,
+            value=decimal.Decimal('12345'),
+        )
         data = logic.get_indicator_by_country(self.fake_indicator, 2050)
+        open_saved.assert_not_called()
         self.assertEqual(data['NLD'], 12345)
 
+    @patch(f'{CB}.utils.open_saved_indicator_values')
+    def test_get_indicator_by_country_uses_cache(self, open_saved):
+        open_saved.return_value = {'NLD': 12345}
+        stats_before = utils.indicator_cache.stats
+        logic.get_indicator_by_country(self.fake_indicator, 2050)
+        data = logic.get_indicator_by_country(self.fake_indicator, 2050)
+        stats_after = utils.indicator_cache.stats
+        open_saved.assert_called_once()
+        self.assertEqual(data['NLD'], 12345)
+        self.assertEqual(stats_after['hits'] - stats_before['hits'], 1)
+        self.assertEqual(stats_after['misses'] - stats_before['misses'], 1)
+
     def test_countries_with_billing_agents(self):
         self.assertEqual(
             {self.agent_gb.country},
@@ -139,6 +155,25 @@ class LogicTests(test_models.TestCaseWithData):
         self.band_base_standard_gb.category = 'base'
         self.band_base_standard_gb.save()
 
+    def test_base_band_resolver_loads_once(self):
+        with self.assertNumQueries(3):
+            resolver = logic.BaseBandResolver()
+            for level in [None, self.level_standard, self.level_silver]:
+                for country in [None, 'GB', 'DE', 'NL']:
+                    resolver.get_base_band(level=level, country=country)
+        self.assertEqual(
+            resolver.get_base_band(level=self.level_silver),
+            self.band_base_silver_de,
+        )
+        self.assertEqual(
+            resolver.get_base_band(country='GB'),
+            self.band_base_standard_gb,
+        )
+        self.assertEqual(
+            resolver.get_base_band(level=self.level_silver, country='NL'),
+            self.band_base_silver_de,
+        )
+
     @patch(f'{CB}.models.Band.objects.count')
     def test_get_base_band_with_no_bands_at_all(self, band_count):
         # In other words, the plugin is being
@@ -197,6 +232,387 @@ class LogicTests(test_models.TestCaseWithData):
             self.assertEqual(multiplier, 1)
             self.assertEqual(warning, warning_text)
 
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_latest_multiplier_for_indicator_from_index(self, get_indicator):
+        year = logic.last_five_years()[-1]
+        for country, value in [('dog', 5), ('cat', 10)]:
+            supporter_models.LatestIndicatorValue.objects.create(
+                indicator=self.fake_indicator,
+                country=country,
+                year=year,
+                value=value,
+            )
+        multiplier, warning = logic.latest_multiplier_for_indicator(
+            self.fake_indicator,
+            'dog',
+            'cat',
+            'No dogs found!',
+        )
+        get_indicator.assert_not_called()
+        self.assertEqual(multiplier, decimal.Decimal('0.5'))
+        self.assertEqual(warning, '')
+
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_latest_multiplier_for_indicator_index_years_differ(
+        self,
+        get_indicator,
+    ):
+        years = logic.last_five_years()
+        for country, year in [('dog', years[-2]), ('cat', years[-1])]:
+            supporter_models.LatestIndicatorValue.objects.create(
+                indicator=self.fake_indicator,
+                country=country,
+                year=year,
+                value=5,
+            )
+        get_indicator.return_value = {'dog': 5, 'cat': 10}
+        multiplier, _warning = logic.latest_multiplier_for_indicator(
+            self.fake_indicator,
+            'dog',
+            'cat',
+            'No dogs found!',
+        )
+        get_indicator.assert_called()
+        self.assertEqual(multiplier, 0.5)
+
+    @patch(f'{CB}.logic.get_latest_indicator_values')
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_latest_multiplier_for_indicator_from_snapshot(
+        self,
+        get_indicator,
+        get_latest,
+    ):
+        years = logic.last_five_years()
+        for country, year, value in [
+            ('dog', years[-1], None),
+            ('cat', years[-1], 10),
+            ('dog', years[-2], 5),
+            ('cat', years[-2], 20),
+        ]:
+            supporter_models.IndicatorObservation.objects.create(
+                indicator=self.fake_indicator,
+                country=country,
+                year=year,
+                value=value,
+            )
+        utils.write_indicator_snapshot()
+        multiplier, warning = logic.latest_multiplier_for_indicator(
+            self.fake_indicator,
+            'dog',
+            'cat',
+            'No dogs found!',
+        )
+        get_indicator.assert_not_called()
+        get_latest.assert_not_called()
+        self.assertEqual(multiplier, decimal.Decimal('0.25'))
+        self.assertEqual(warning, '')
+
+    def test_get_indicator_by_country_from_snapshot(self):
+        supporter_models.IndicatorObservation.objects.create(
+            indicator=self.fake_indicator,
+            country='NLD',
+            year=2050,
+            value=decimal.Decimal('12345.678'),
+        )
+        utils.write_indicator_snapshot()
+        supporter_models.IndicatorObservation.objects.all().delete()
+        data = logic.get_indicator_by_country(self.fake_indicator, 2050)
+        self.assertEqual(data, {'NLD': decimal.Decimal('12345.678')})
+
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_multiplier_matrix_matches_bands_and_currencies(
+        self,
+        get_indicator,
+    ):
+        years = logic.last_five_years()
+
+        def indicator_by_country(indicator, year):
+            if indicator == plugin_settings.RATE_INDICATOR:
+                return {
+                    'EMU': decimal.Decimal('0.9'),
+                    'GBR': decimal.Decimal('0.8') if year != years[-1] else 0,
+                }
+            if year == years[-1]:
+                # Only some countries have the latest data
+                return {
+                    'DEU': decimal.Decimal('40000'),
+                    'GBR': 0,
+                    'BEL': decimal.Decimal('30000'),
+                }
+            return {
+                'DEU': decimal.Decimal('50000'),
+                'GBR': decimal.Decimal('45000'),
+                'FRA': decimal.Decimal('42000'),
+            }
+        get_indicator.side_effect = indicator_by_country
+
+        matrix = logic.MultiplierMatrix()
+        for band in supporter_models.Band.objects.all():
+            base_band = logic.get_base_band(
+                level=band.level,
+                country=band.country,
+            )
+            self.assertEqual(
+                matrix.disparity(band.country, base_band),
+                band.economic_disparity,
+            )
+            self.assertEqual(
+                matrix.exchange_rate(band.currency, base_band),
+                band.exchange_rate,
+            )
+        for currency in supporter_models.Currency.objects.all():
+            self.assertEqual(
+                matrix.exchange_rate(currency),
+                currency.exchange_rate(),
+            )
+
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_multiplier_matrix_reads_data_once(self, get_indicator):
+        get_indicator.return_value = {
+            'DEU': decimal.Decimal('50000'),
+            'NLD': decimal.Decimal('55000'),
+        }
+        matrix = logic.MultiplierMatrix()
+        calls = get_indicator.call_count
+        multiplier, warning = matrix.disparity('NL', self.band_base_standard_de)
+        self.assertEqual(multiplier, decimal.Decimal('1.1'))
+        self.assertEqual(warning, '')
+        multiplier, warning = matrix.disparity('NZ', self.band_base_standard_de)
+        self.assertEqual(multiplier, 1)
+        self.assertEqual(
+            warning,
+            utils.setting('missing_data_economic_disparity'),
+        )
+        self.assertEqual(get_indicator.call_count, calls)
+
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_fee_calculator_matches_calculate_fee(self, get_indicator):
+        years = logic.last_five_years()
+
+        def indicator_by_country(indicator, year):
+            if indicator == plugin_settings.RATE_INDICATOR:
+                return {
+                    'EMU': decimal.Decimal('0.93'),
+                    'GBR': decimal.Decimal('0.81'),
+                }
+            if year == years[-1]:
+                return {'DEU': decimal.Decimal('51234.5')}
+            return {
+                'DEU': decimal.Decimal('48000'),
+                'GBR': decimal.Decimal('46123'),
+                'BEL': decimal.Decimal('52000.25'),
+                'NLD': decimal.Decimal('57000'),
+            }
+        get_indicator.side_effect = indicator_by_country
+
+        band_tuples = [
+            (size, level, country, currency)
+            for size in supporter_models.SupporterSize.objects.all()
+            for level in supporter_models.SupportLevel.objects.all()
+            for country in ['DE', 'GB', 'BE', 'NL', 'FR']
+            for currency in supporter_models.Currency.objects.all()
+        ]
+        calculator = logic.FeeCalculator()
+        results = calculator.calculate_many(band_tuples + band_tuples[:3])
+        self.assertEqual(len(calculator.results), len(band_tuples))
+        for (size, level, country, currency), result in zip(
+            band_tuples,
+            results,
+        ):
+            band = supporter_models.Band(
+                size=size,
+                level=level,
+                country=country,
+                currency=currency,
+            )
+            self.assertEqual(result, band.calculate_fee())
+
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_fee_calculator_in_processes_matches_serial(self, get_indicator):
+        get_indicator.return_value = {
+            'EMU': decimal.Decimal('0.93'),
+            'GBR': decimal.Decimal('0.81'),
+            'DEU': decimal.Decimal('48000'),
+            'BEL': decimal.Decimal('52000.25'),
+        }
+        band_tuples = [
+            (size, level, country, currency)
+            for size in supporter_models.SupporterSize.objects.all()
+            for level in supporter_models.SupportLevel.objects.all()
+            for country in ['DE', 'GB', 'BE']
+            for currency in supporter_models.Currency.objects.all()
+        ]
+        serial = logic.FeeCalculator()
+        expected = serial.calculate_many(band_tuples)
+
+        parallel = logic.FeeCalculator()
+        filled = parallel.calculate_in_processes(
+            band_tuples + [(None, None, 'NL', None)],
+            workers=2,
+            chunk_size=5,
+        )
+        self.assertEqual(filled, len(band_tuples))
+        with patch.object(parallel, 'calculate_fee') as calculate_fee:
+            self.assertListEqual(
+                parallel.calculate_many(band_tuples),
+                expected,
+            )
+            calculate_fee.assert_not_called()
+
+    @patch(f'{CB}.logic.get_indicator_by_country')
+    def test_fixed_point_fees_match_decimal_fees(self, get_indicator):
+        def indicator_by_country(indicator, year):
+            if indicator == plugin_settings.RATE_INDICATOR:
+                return {
+                    'EMU': decimal.Decimal('0.9316383333'),
+                    'GBR': decimal.Decimal('0.8112345'),
+                }
+            return {
+                'DEU': decimal.Decimal('51234.56789'),
+                'GBR': decimal.Decimal('46123.4'),
+                'BEL': decimal.Decimal('52000.25'),
+                'NLD': decimal.Decimal('57000'),
+            }
+        get_indicator.side_effect = indicator_by_country
+
+        checked, _fallbacks, mismatches = logic.verify_fixed_point_fees()
+        self.assertGreater(checked, 0)
+        self.assertListEqual(mismatches, [])
+
+    def test_round_fixed_point_to_ten(self):
+        # 1234.5 and 1235 exactly
+        self.assertEqual(logic.round_fixed_point_to_ten(12345, -1), 1230)
+        self.assertIsNone(logic.round_fixed_point_to_ten(12350, -1))
+        self.assertEqual(logic.round_fixed_point_to_ten(123, 1), 1230)
+        self.assertEqual(
+            logic.to_fixed_point(decimal.Decimal('-0.0125')),
+            (-125, -4),
+        )
+
+    def test_fee_calculator_needs_all_fields(self):
+        calculator = logic.FeeCalculator()
+        with self.assertRaises(ValidationError):
+            calculator.calculate(
+                self.size_large,
+                self.level_standard,
+                None,
+                self.currency_eur,
+            )
+
+    def test_dependency_fingerprint_follows_inputs(self):
+        args = (
+            self.size_small,
+            self.level_silver,
+            'BE',
+            self.currency_eur,
+        )
+        fingerprint = logic.FeeCalculator().dependency_fingerprint(*args)
+        self.assertEqual(
+            logic.FeeCalculator().dependency_fingerprint(*args),
+            fingerprint,
+        )
+        self.size_small.multiplier = decimal.Decimal('0.3')
+        self.size_small.save()
+        self.assertNotEqual(
+            logic.FeeCalculator().dependency_fingerprint(*args),
+            fingerprint,
+        )
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    def test_build_fee_quotes(self, calculate):
+        calculate.return_value = (1230, 'Oh no!')
+        built = logic.build_fee_quotes()
+        self.assertEqual(built, supporter_models.FeeQuote.objects.count())
+        self.assertEqual(
+            logic.get_fee_quote(
+                self.size_small,
+                self.level_silver,
+                'BE',
+                self.currency_eur,
+            ),
+            (1230, 'Oh no!'),
+        )
+        self.assertTrue(logic.fee_quotes_built())
+        self.assertEqual(logic.current_fee_quotes().count(), built)
+
+        utils.bump_configuration_version()
+        self.assertIsNone(logic.fee_quotes_built())
+        self.assertFalse(logic.current_fee_quotes().exists())
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    def test_build_fee_quotes_during_initial_config(self, calculate):
+        calculate.side_effect = TypeError
+        self.assertEqual(logic.build_fee_quotes(), 0)
+        self.assertFalse(supporter_models.FeeQuote.objects.exists())
+
+    @patch(f'{CB}.utils.setting')
+    def test_build_fee_quotes_before_settings_exist(self, setting):
+        setting.side_effect = ObjectDoesNotExist
+        self.assertEqual(logic.build_fee_quotes(), 0)
+        self.assertIsNone(logic.fee_quotes_built())
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    def test_fee_quotes_invalidated_by_config_change(self, calculate):
+        calculate.return_value = (1230, '')
+        logic.build_fee_quotes()
+        self.currency_eur.region = 'DEU'
+        self.currency_eur.save()
+        self.assertIsNone(logic.fee_quotes_built())
+
+    @patch(f'{CB}.logic.build_fee_quotes')
+    def test_fee_quotes_not_rebuilt_during_request(self, build_fee_quotes):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.level_standard.save()
+        request_finished.send(sender=None)
+        build_fee_quotes.assert_not_called()
+
+    @patch(f'{CB}.logic.FeeCalculator.calculate')
+    def test_fee_quotes_from_old_version_ignored(self, calculate):
+        calculate.return_value = (1230, '')
+        logic.build_fee_quotes()
+        utils.bump_configuration_version()
+        self.assertIsNone(
+            logic.get_fee_quote(
+                self.size_small,
+                self.level_silver,
+                'BE',
+                self.currency_eur,
+            )
+        )
+
+    def test_keep_default_unique_changes_configuration(self):
+        version = utils.get_configuration_version()
+        logic.keep_default_unique(
+            supporter_models.SupportLevel(name='Gold', default=True),
+        )
+        self.assertGreater(utils.get_configuration_version(), version)
+
+    @patch(f'{CB}.logic.configuration_changed')
+    def test_other_setting_saves_skip_fee_configuration(self, changed):
+        setting_handler.save_setting('general', 'journal_name', None, 'Test')
+        changed.assert_not_called()
+        setting_handler.save_setting(
+            'plugin:consortial_billing',
+            'minimum_fee',
+            None,
+            '50',
+        )
+        changed.assert_called_once()
+
+    def test_calculated_band_bulk_create_keeps_configuration(self):
+        version = utils.get_configuration_version()
+        supporter_models.Band.objects.bulk_create([
+            supporter_models.Band(
+                size=self.size_small,
+                country='BE',
+                currency=self.currency_eur,
+                level=self.level_silver,
+                fee=1230,
+                category='calculated',
+            ),
+        ])
+        self.assertEqual(utils.get_configuration_version(), version)
+
     def test_latest_multiplier_for_indicator_during_initial_config(self):
         measure_key = 'dog'
         base_key = '---'
@@ -250,9 +666,74 @@ class LogicTests(test_models.TestCaseWithData):
         )
         self.assertEqual(
             exchange_rate.call_count,
-            4,
+            2,
         )
 
+    @patch(f'{CB}.models.Currency.exchange_rate')
+    def test_get_total_revenue_currency_without_supporters(
+        self,
+        exchange_rate,
+    ):
+        exchange_rate.return_value = (decimal.Decimal('1.000'), '')
+        supporter_models.Currency.objects.create(code='USD', region='USA')
+        self.assertTupleEqual(
+            (3500, self.currency_eur),
+            logic.get_total_revenue(),
+        )
+
+    @patch(f'{CB}.models.Currency.exchange_rate', autospec=True)
+    def test_exchange_rate_matrix(self, exchange_rate):
+        def rate(currency):
+            if currency.code == 'GBP':
+                return decimal.Decimal('0.8'), ''
+            return decimal.Decimal('0.9'), ''
+        exchange_rate.side_effect = rate
+
+        converted = self.currency_gbp.convert_from(900, self.currency_eur)
+        self.assertAlmostEqual(converted, 800)
+        self.assertAlmostEqual(self.currency_gbp.convert_from(900, 'EUR'), 800)
+        self.assertEqual(exchange_rate.call_count, 2)
+
+        # Rebuilt when the configuration changes
+        utils.bump_configuration_version()
+        self.currency_eur.convert_from(800, self.currency_gbp)
+        self.assertEqual(exchange_rate.call_count, 4)
+
+    @patch(f'{CB}.models.logger.error')
+    def test_convert_from_unknown_currency_code(self, error):
+        self.assertEqual(self.currency_gbp.convert_from(900, 'XYZ'), 900)
+        error.assert_called_once()
+
+    @patch(f'{CB}.models.Currency.exchange_rate', autospec=True)
+    def test_convert_from_unsaved_currency(self, exchange_rate):
+        def rate(currency):
+            if currency.code == 'GBP':
+                return decimal.Decimal('0.8'), ''
+            return decimal.Decimal('0.9'), ''
+        exchange_rate.side_effect = rate
+        currency = supporter_models.Currency(code='CHF', region='CHE')
+        self.assertAlmostEqual(self.currency_gbp.convert_from(900, currency), 800)
+
+    @patch(f'{CB}.models.Currency.exchange_rate', autospec=True)
+    def test_fee_in_unsaved_currency(self, exchange_rate):
+        def rate(currency):
+            if currency.code == 'CHF':
+                return decimal.Decimal('0.9'), ''
+            return decimal.Decimal('0.8'), ''
+        exchange_rate.side_effect = rate
+        currency = supporter_models.Currency(code='CHF', region='CHE')
+        band = self.band_calc_standard_gb_large
+        self.assertAlmostEqual(
+            band.fee_in_currency(currency),
+            band.fee * decimal.Decimal('0.9') / decimal.Decimal('0.8'),
+        )
+
+    @patch(f'{CB}.models.logger.error')
+    def test_fee_in_unknown_currency_code(self, error):
+        band = self.band_calc_standard_gb_large
+        self.assertEqual(band.fee_in_currency('XYZ'), band.fee)
+        error.assert_called_once()
+
     @patch(f'{CB}.models.Currency.exchange_rate')
     def test_get_total_revenue_in_currency(self, exchange_rate):
         exchange_rate.return_value = (decimal.Decimal('1.000'), '')
@@ -262,5 +743,5 @@ class LogicTests(test_models.TestCaseWithData):
         )
         self.assertEqual(
             exchange_rate.call_count,
-            4,
+            2,
         )
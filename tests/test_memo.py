@@ -0,0 +1,60 @@
+__copyright__ = "Copyright 2023 Birkbeck, University of London"
+__author__ = "Open Library of Humanities"
+__license__ = "AGPL v3"
+__maintainer__ = "Open Library of Humanities"
+
+from plugins.consortial_billing import memo, logic, utils
+from plugins.consortial_billing.tests import test_models
+
+
+class CountCalls:
+
+    def __init__(self):
+        self.call_count = 0
+
+    def __call__(self, *args):
+        self.call_count += 1
+        return 5
+
+
+class MemoTests(test_models.TestCaseWithData):
+
+    def test_memoize_only_inside_context(self):
+        function = CountCalls()
+        memoized = memo.memoize(function)
+        memoized(1)
+        memoized(1)
+        self.assertEqual(function.call_count, 2)
+
+        with memo.memo_context():
+            memoized(1)
+            memoized(1)
+            memoized(2)
+            with memo.memo_context():
+                memoized(2)
+        self.assertEqual(function.call_count, 4)
+
+    def test_memoize_unhashable_arguments(self):
+        function = CountCalls()
+        memoized = memo.memoize(function)
+        with memo.memo_context():
+            memoized([1])
+            memoized([1])
+        self.assertEqual(function.call_count, 2)
+
+    def test_memoize_cache_clear(self):
+        function = CountCalls()
+        memoized = memo.memoize(function)
+        with memo.memo_context():
+            memoized(1)
+            memoized.cache_clear()
+            memoized(1)
+        self.assertEqual(function.call_count, 2)
+
+    def test_memo_context_removes_repeat_queries(self):
+        with memo.memo_context():
+            with self.assertNumQueries(3):
+                for _num in range(3):
+                    logic.countries_with_billing_agents()
+                    logic.determine_billing_agent('GB')
+                    utils.get_standard_support_level()
@@ -3,20 +3,157 @@ __author__ = "Open Library of Humanities"
 __license__ = "AGPL v3"
 __maintainer__ = "Open Library of Humanities"
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, Mock
+from urllib.parse import urlparse, parse_qs
 import decimal
+import json
+import os
+import tempfile
+import threading
+import time
 
+from django.db import IntegrityError, transaction
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
 from django.http import HttpRequest
 
-from plugins.consortial_billing import models, plugin_settings
+from plugins.consortial_billing import models, plugin_settings, logic
 from plugins.consortial_billing import utils
 from utils.testing import helpers
 from press import models as press_models
 from cms.models import Page
 
 
+def make_world_bank_records(indicator, year, values):
+    """
+    Builds World Bank API records for testing
+    :values: dict of country codes and values
+    """
+    return [
+        {
+            'indicator': {'id': indicator, 'value': 'Test indicator'},
+            'country': {'id': code[:2], 'value': code},
+            'countryiso3code': code,
+            'date': str(year),
+            'value': value,
+            'unit': '',
+            'obs_status': '',
+            'decimal': 0,
+        } for code, value in values.items()
+    ]
+
+
+def make_world_bank_content(
+    indicator,
+    year,
+    values,
+    page=1,
+    pages=1,
+    records=None,
+):
+    """
+    Builds a World Bank API response body for testing
+    :values: dict of country codes and values
+    :records: records to use instead of building them from values
+    """
+    if records is None:
+        records = make_world_bank_records(indicator, year, values)
+    metadata = {
+        'page': page,
+        'pages': pages,
+        'per_page': 500,
+        'total': len(records),
+    }
+    return json.dumps([metadata, records]).encode()
+
+
+class WorldBankStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        indicator = url.path.rstrip('/').split('/')[-1]
+        query = parse_qs(url.query)
+        first_year, _sep, last_year = query['date'][0].partition(':')
+        per_page = int(query.get('per_page', ['500'])[0])
+        page = int(query.get('page', ['1'])[0])
+        time.sleep(stub.delays.get(page, 0))
+        with stub.lock:
+            stub.requests.append(self.path)
+            failures = stub.failures_left.get(self.path, stub.failures)
+            stub.failures_left[self.path] = failures - 1
+        if failures > 0:
+            status, body = 503, b'[]'
+        else:
+            status = 200
+            records = []
+            for year in range(
+                int(last_year or first_year),
+                int(first_year) - 1,
+                -1,
+            ):
+                records += make_world_bank_records(
+                    indicator,
+                    year,
+                    stub.values,
+                )
+            pages = max(1, -(-len(records) // per_page))
+            body = make_world_bank_content(
+                indicator,
+                first_year,
+                stub.values,
+                page=page,
+                pages=pages,
+                records=records[(page - 1) * per_page:page * per_page],
+            )
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WorldBankStub:
+    """
+    A local server that stands in for api.worldbank.org
+    :values: dict of country codes and values to return for any request
+    :failures: how many times to fail each request before succeeding
+    :delays: optional dict of page numbers and seconds to wait
+             before responding with that page
+    """
+
+    def __init__(self, values, failures=0, delays=None):
+        self.values = values
+        self.failures = failures
+        self.delays = delays or {}
+        self.failures_left = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), WorldBankStubHandler)
+        self.server.stub = self
+        host, port = self.server.server_address
+        self.api = f'http://{host}:{port}/v2/country/all/indicator/'
+        self.patcher = patch(
+            'plugins.consortial_billing.utils.WORLD_BANK_API',
+            self.api,
+        )
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.patcher.start()
+        return self
+
+    def __exit__(self, *args):
+        self.patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class TestCaseWithData(TestCase):
 
     @classmethod
@@ -188,6 +325,18 @@ class TestCaseWithData(TestCase):
         )
 
     def setUp(self):
+        utils.indicator_cache.clear()
+        logic.exchange_rate_matrices.clear()
+
+        # Keep each test's indicator snapshot to itself
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        snapshot_path = patch(
+            'plugins.consortial_billing.utils.indicator_snapshot_path',
+            return_value=os.path.join(snapshot_dir.name, 'snapshot.bin'),
+        )
+        snapshot_path.start()
+        self.addCleanup(snapshot_path.stop)
         self.request = Mock(HttpRequest)
         type(self.request).GET = {}
         type(self.request).POST = {}
@@ -280,6 +429,18 @@ class ModelTests(TestCaseWithData):
             latest_multiplier.assert_called()
             self.assertEqual(fee, expected_fee)
 
+    @patch(
+        'plugins.consortial_billing.logic.latest_multiplier_for_indicator',
+        return_value=(decimal.Decimal(1), ''),
+    )
+    def test_band_calculate_fee_resolves_base_band_once(self, _latest):
+        with patch(
+            'plugins.consortial_billing.logic.get_base_band',
+            wraps=logic.get_base_band,
+        ) as get_base_band:
+            self.band_calc_silver_be_small.calculate_fee()
+        get_base_band.assert_called_once()
+
     def test_band_determine_billing_agent_default(self):
         agent = self.band_special_silver_fr_small.determine_billing_agent()
         self.assertEqual(agent, self.agent_default)
@@ -298,6 +459,52 @@ class ModelTests(TestCaseWithData):
             self.band_calc_standard_gb_large.save()
             calculate_fee.assert_called_once()
 
+    def test_band_save_sets_lookup_fields(self):
+        band = self.band_calc_silver_be_small
+        self.assertEqual(band.year, band.datetime.year)
+        fingerprint = band.fingerprint
+        self.assertEqual(fingerprint, band.get_fingerprint())
+        band.fee += 10
+        band.save()
+        self.assertNotEqual(band.fingerprint, fingerprint)
+
+    def test_band_queryset_update_refreshes_fingerprint(self):
+        band = self.band_calc_silver_be_small
+        models.Band.objects.filter(pk=band.pk).update(fee=band.fee + 10)
+        band.refresh_from_db()
+        self.assertEqual(band.fingerprint, band.get_fingerprint())
+
+    def test_calculated_bands_are_unique(self):
+        duplicate_band = models.Band(
+            level=self.level_silver,
+            country='BE',
+            size=self.size_small,
+            currency=self.currency_eur,
+            billing_agent=self.agent_default,
+            fee=2000,
+            warnings='',
+            category='calculated',
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            duplicate_band.save(claim_fingerprint=True)
+
+        # Other callers save a duplicate that lookups do not find
+        duplicate_band.pk = None
+        duplicate_band.save()
+        self.assertIsNone(duplicate_band.fingerprint)
+
+        # Special bands are never matched, so they can repeat
+        for _num in range(2):
+            models.Band.objects.create(
+                level=self.level_silver,
+                country='FR',
+                size=self.size_small,
+                currency=self.currency_eur,
+                billing_agent=self.agent_default,
+                fee=7777,
+                category='special',
+            )
+
     def test_band_save_special_formerly_calculated(self):
         # Set up test data
         self.band_calc_standard_gb_large.category = 'special'
@@ -5,8 +5,12 @@ __maintainer__ = "Open Library of Humanities"
 
 from unittest.mock import patch, Mock, PropertyMock
 import decimal
+import io
+import json
 
-from plugins.consortial_billing import utils, models as supporter_models
+from cms import models as cms_models
+from plugins.consortial_billing import utils, logic, plugin_settings, \
+    models as supporter_models
 from plugins.consortial_billing.tests import test_models
 
 CB = 'plugins.consortial_billing'
@@ -41,6 +45,208 @@ class UtilsTests(test_models.TestCaseWithData):
                     opened_as = get_label.call_args.kwargs['label']
                     self.assertEqual(saved_as, opened_as)
 
+                with patch(f'{CB}.utils.iter_world_bank_values'):
+                    utils.open_saved_indicator_values(
+                        self.fake_indicator,
+                        2023,
+                    )
+                    streamed_as = get_label.call_args.kwargs['label']
+                    self.assertEqual(saved_as, streamed_as)
+
+    @patch('cms.models.MediaFile.objects.get_or_create')
+    def test_save_media_file_clears_indicator_cache(self, get_or_create):
+        get_or_create.return_value = (Mock(), True)
+        utils.indicator_cache.get(
+            self.fake_indicator,
+            2023,
+            lambda indicator, year: {'NLD': 12345},
+        )
+        utils.save_media_file('test.json', '')
+        self.assertEqual(utils.indicator_cache.stats['size'], 0)
+
+    def test_indicator_cache_follows_configuration_version(self):
+        load = Mock(return_value={'NLD': 12345})
+        utils.indicator_cache.get(self.fake_indicator, 2023, load)
+        utils.indicator_cache.get(self.fake_indicator, 2023, load)
+        self.assertEqual(load.call_count, 1)
+
+        utils.bump_configuration_version()
+        utils.indicator_cache.get(self.fake_indicator, 2023, load)
+        self.assertEqual(load.call_count, 2)
+
+    def test_indicator_cache_hit_without_queries(self):
+        load = Mock(return_value={'NLD': 12345})
+        utils.indicator_cache.get(self.fake_indicator, 2023, load)
+        with self.assertNumQueries(0):
+            utils.indicator_cache.get(self.fake_indicator, 2023, load)
+        self.assertEqual(load.call_count, 1)
+
+    @patch(f'{CB}.utils.VERSION_CHECK_SECONDS', 0)
+    def test_indicator_cache_rereads_version(self):
+        load = Mock(return_value={'NLD': 12345})
+        utils.indicator_cache.get(self.fake_indicator, 2023, load)
+        with self.assertNumQueries(1):
+            utils.indicator_cache.get(self.fake_indicator, 2023, load)
+
+    def test_only_indicator_files_change_configuration(self):
+        version = utils.get_configuration_version()
+        cms_models.MediaFile.objects.create(
+            label=f'{plugin_settings.SHORT_NAME}/{utils.DEMO_DATA_FILENAME}',
+        )
+        self.assertEqual(utils.get_configuration_version(), version)
+
+        cms_models.MediaFile.objects.create(
+            label=f'{plugin_settings.SHORT_NAME}/'
+                  f'{self.fake_indicator}_2023.json',
+        )
+        self.assertNotEqual(utils.get_configuration_version(), version)
+
+    def test_save_observations_for_indicator_and_year(self):
+        content = test_models.make_world_bank_content(
+            self.fake_indicator,
+            2023,
+            {'NLD': 12345.6, 'BEL': None, '': 1},
+        )
+        saved = utils.save_observations_for_indicator_and_year(
+            self.fake_indicator,
+            2023,
+            content,
+        )
+        self.assertEqual(saved, 2)
+        observation = supporter_models.IndicatorObservation.objects.get(
+            indicator=self.fake_indicator,
+            year=2023,
+            country='NLD',
+        )
+        self.assertEqual(observation.value, decimal.Decimal('12345.6'))
+
+        # Saving again replaces rather than duplicates
+        utils.save_observations_for_indicator_and_year(
+            self.fake_indicator,
+            2023,
+            content,
+        )
+        self.assertEqual(
+            supporter_models.IndicatorObservation.objects.filter(
+                indicator=self.fake_indicator,
+            ).count(),
+            2,
+        )
+
+    def test_save_observations_for_indicator_and_year_bad_content(self):
+        saved = utils.save_observations_for_indicator_and_year(
+            self.fake_indicator,
+            2023,
+            b'',
+        )
+        self.assertEqual(saved, 0)
+
+    @patch(f'{CB}.utils.save_media_file')
+    def test_save_file_for_indicator_and_year_reports_changes(
+        self,
+        save_media_file,
+    ):
+        content = test_models.make_world_bank_content(
+            self.fake_indicator,
+            2023,
+            {'NLD': 123, 'GBR': 456},
+        )
+        changed = utils.save_file_for_indicator_and_year(
+            self.fake_indicator,
+            2023,
+            content,
+        )
+        self.assertSetEqual(changed, {'NLD', 'GBR'})
+
+        content = test_models.make_world_bank_content(
+            self.fake_indicator,
+            2023,
+            {'NLD': 123, 'GBR': 789},
+        )
+        changed = utils.save_file_for_indicator_and_year(
+            self.fake_indicator,
+            2023,
+            content,
+        )
+        self.assertSetEqual(changed, {'GBR'})
+        self.assertEqual(save_media_file.call_count, 2)
+
+    @patch(f'{CB}.utils.indicator_cache.clear')
+    @patch(f'{CB}.utils.save_media_file')
+    def test_save_file_for_indicator_and_year_skips_unchanged(
+        self,
+        save_media_file,
+        cache_clear,
+    ):
+        content = test_models.make_world_bank_content(
+            self.fake_indicator,
+            2023,
+            {'NLD': 123},
+        )
+        utils.save_file_for_indicator_and_year(
+            self.fake_indicator,
+            2023,
+            content,
+        )
+        cache_clear.reset_mock()
+        with patch(f'{CB}.utils.cms_models.MediaFile.objects.filter') as find:
+            find.return_value.exists.return_value = True
+            changed = utils.save_file_for_indicator_and_year(
+                self.fake_indicator,
+                2023,
+                content,
+            )
+        self.assertSetEqual(changed, set())
+        save_media_file.assert_called_once()
+        cache_clear.assert_not_called()
+
+    def test_indicator_snapshot_reopens_new_snapshot(self):
+        supporter_models.IndicatorObservation.objects.create(
+            indicator=self.fake_indicator,
+            country='NLD',
+            year=2023,
+            value=123,
+        )
+        self.assertIsNone(utils.get_indicator_snapshot())
+        utils.write_indicator_snapshot()
+        snapshot = utils.get_indicator_snapshot()
+        self.assertIs(snapshot, utils.get_indicator_snapshot())
+        self.assertEqual(
+            snapshot.value(self.fake_indicator, 2023, 'NLD'),
+            123,
+        )
+        self.assertIsNone(snapshot.value(self.fake_indicator, 2023, 'GBR'))
+
+        supporter_models.IndicatorObservation.objects.create(
+            indicator=self.fake_indicator,
+            country='GBR',
+            year=2023,
+            value=456,
+        )
+        utils.write_indicator_snapshot()
+        snapshot = utils.get_indicator_snapshot()
+        self.assertEqual(
+            snapshot.values(self.fake_indicator, 2023),
+            {'GBR': 456, 'NLD': 123},
+        )
+
+    def test_rebuild_latest_indicator_values(self):
+        for year, value in [(2021, 100), (2022, 200), (2023, None)]:
+            supporter_models.IndicatorObservation.objects.create(
+                indicator=self.fake_indicator,
+                country='NLD',
+                year=year,
+                value=value,
+            )
+        indexed = utils.rebuild_latest_indicator_values(self.fake_indicator)
+        self.assertEqual(indexed, 1)
+        latest = supporter_models.LatestIndicatorValue.objects.get(
+            indicator=self.fake_indicator,
+            country='NLD',
+        )
+        self.assertEqual(latest.year, 2022)
+        self.assertEqual(latest.value, 200)
+
     def test_fetch_world_bank_data_200(self):
         with patch(
             'plugins.consortial_billing.utils.save_file_for_indicator_and_year'
@@ -56,6 +262,96 @@ class UtilsTests(test_models.TestCaseWithData):
                 save_file.assert_called()
                 self.assertEqual(status_code, 200)
 
+    def test_world_bank_session_pools_connections(self):
+        session = utils.world_bank_session(pool_size=3, retries=2)
+        adapter = session.get_adapter(utils.WORLD_BANK_API)
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.total, 2)
+
+    def test_fetch_world_bank_datasets(self):
+        with patch(
+            f'{CB}.utils.save_file_for_indicator_and_year'
+        ) as save_file:
+            with test_models.WorldBankStub({'NLD': 123}) as stub:
+                status_codes = utils.fetch_world_bank_datasets(
+                    [self.fake_indicator],
+                    [2022, 2023],
+                )
+            self.assertDictEqual(
+                status_codes,
+                {(self.fake_indicator, 2022): 200, (self.fake_indicator, 2023): 200},
+            )
+            self.assertEqual(save_file.call_count, 2)
+            self.assertEqual(len(stub.requests), 1)
+            self.assertIn('date=2022:2023', stub.requests[0])
+
+    @patch(f'{CB}.utils.RANGE_PER_PAGE', 1)
+    def test_fetch_world_bank_datasets_follows_pages(self):
+        with patch(
+            f'{CB}.utils.save_file_for_indicator_and_year'
+        ) as save_file:
+            with test_models.WorldBankStub({'NLD': 123, 'GBR': 456}) as stub:
+                status_codes = utils.fetch_world_bank_datasets(
+                    [self.fake_indicator],
+                    [2022, 2023],
+                )
+            self.assertEqual(len(stub.requests), 4)
+            self.assertEqual(status_codes[(self.fake_indicator, 2022)], 200)
+            saved = {
+                call.args[1]: dict(
+                    utils.iter_world_bank_values(io.BytesIO(call.args[2]))
+                ) for call in save_file.call_args_list
+            }
+            self.assertDictEqual(
+                saved[2022],
+                {'NLD': decimal.Decimal('123'), 'GBR': decimal.Decimal('456')},
+            )
+            self.assertEqual(len(saved[2023]), 2)
+
+    @patch(f'{CB}.utils.RANGE_PER_PAGE', 1)
+    def test_fetch_world_bank_datasets_keeps_page_order(self):
+        values = {'NLD': 123, 'GBR': 456, 'BEL': 789}
+        with patch(
+            f'{CB}.utils.save_file_for_indicator_and_year'
+        ) as save_file:
+            # Page 3 arrives before page 2
+            with test_models.WorldBankStub(values, delays={2: 0.5}):
+                utils.fetch_world_bank_datasets([self.fake_indicator], [2023])
+        content = save_file.call_args.args[2]
+        self.assertEqual(
+            content,
+            utils.join_world_bank_records([
+                json.dumps(record) for record in
+                test_models.make_world_bank_records(
+                    self.fake_indicator,
+                    2023,
+                    values,
+                )
+            ]),
+        )
+
+    def test_fetch_world_bank_datasets_no_records(self):
+        with patch(
+            f'{CB}.utils.save_file_for_indicator_and_year'
+        ) as save_file:
+            with test_models.WorldBankStub({}):
+                status_codes = utils.fetch_world_bank_datasets(
+                    [self.fake_indicator],
+                    [2023],
+                )
+            save_file.assert_not_called()
+            self.assertEqual(status_codes[(self.fake_indicator, 2023)], 204)
+
+    def test_form_world_bank_url_with_page(self):
+        url = utils.form_world_bank_url(
+            self.fake_indicator,
+            '2019:2023',
+            page=2,
+            per_page=1000,
+        )
+        self.assertIn('date=2019:2023', url)
+        self.assertIn('per_page=1000&page=2', url)
+
     def test_fetch_world_bank_data_404(self):
         with patch(
             'plugins.consortial_billing.utils.save_file_for_indicator_and_year'
@@ -133,6 +429,44 @@ class UtilsTests(test_models.TestCaseWithData):
         media_get.assert_called()
         load_json.assert_called()
 
+    def test_iter_world_bank_values(self):
+        content = test_models.make_world_bank_content(
+            self.fake_indicator,
+            2023,
+            {'NLD': 12345.6, 'BEL': None},
+        )
+        values = list(
+            utils.iter_world_bank_values(io.BytesIO(content), chunk_size=16)
+        )
+        self.assertListEqual(
+            values,
+            [('NLD', decimal.Decimal('12345.6')), ('BEL', None)],
+        )
+
+    @patch(f'{CB}.utils.logger.error')
+    def test_iter_world_bank_values_skips_non_numeric_values(self, error):
+        content = test_models.make_world_bank_content(
+            self.fake_indicator,
+            2023,
+            {'NLD': 12345.6, 'GBR': 'n/a', 'BEL': None},
+        )
+        values = list(utils.iter_world_bank_values(io.BytesIO(content)))
+        self.assertListEqual(
+            values,
+            [('NLD', decimal.Decimal('12345.6')), ('BEL', None)],
+        )
+        error.assert_called()
+
+    def test_iter_world_bank_values_without_records(self):
+        for content in [
+            '',
+            '[]',
+            '[{"message": [{"id": "120", "value": "Invalid value"}]}]',
+            '[{"page": 1, "pages": 0}, null]',
+        ]:
+            values = list(utils.iter_world_bank_values(io.StringIO(content)))
+            self.assertListEqual(values, [])
+
     @patch('builtins.open')
     @patch('json.loads')
     def test_load_json_with_decimals(self, json_loads, patched_open):
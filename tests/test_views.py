@@ -10,7 +10,8 @@ from django.http import QueryDict
 from django.urls import reverse
 from django.core.exceptions import ImproperlyConfigured
 
-from plugins.consortial_billing import views, plugin_settings
+from plugins.consortial_billing import views, plugin_settings, \
+    models as supporter_models
 from plugins.consortial_billing.tests import test_models
 from core import include_urls  # imported so that urls will load
 
@@ -65,6 +66,29 @@ class ViewTests(test_models.TestCaseWithData):
             response.context['plugin_settings'],
         )
 
+    @patch('plugins.consortial_billing.logic.latest_multiplier_for_indicator')
+    def test_manager_context_data_years(self, latest_multiplier):
+        latest_multiplier.return_value = (decimal.Decimal('1.000'), '')
+        supporter_models.LatestIndicatorValue.objects.create(
+            indicator=plugin_settings.DISPARITY_INDICATOR,
+            country='DEU',
+            year=2022,
+            value=50000,
+        )
+        self.client.force_login(self.user_staff)
+        response = self.client.get(
+            reverse('supporters_manager'),
+            SERVER_NAME=self.press.domain,
+        )
+        self.assertIn(
+            ('GNI per capita, Germany', 2022),
+            response.context['data_years'],
+        )
+        self.assertIn(
+            ('Exchange rate, GBP', None),
+            response.context['data_years'],
+        )
+
     @patch('plugins.consortial_billing.logic.latest_multiplier_for_indicator')
     @patch('plugins.consortial_billing.views.render')
     @patch('plugins.consortial_billing.views.call_command')
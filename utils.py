@@ -4,21 +4,37 @@ __license__ = "AGPL v3"
 __maintainer__ = "Open Library of Humanities"
 
 import os
+import io
+import re
+import codecs
+import collections
+import filecmp
+import hashlib
+import mmap
+import struct
+import tempfile
+import time
 import requests
 import json
 import decimal
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from typing import List
 from tqdm import tqdm
 from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from django.utils import timezone
 from django.core.files.base import ContentFile
 from django.conf import settings
 from django.contrib import admin
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
 
 from cms import models as cms_models
 from utils import setting_handler
-from plugins.consortial_billing import plugin_settings, models
+from plugins.consortial_billing import plugin_settings, models, memo
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -42,8 +58,363 @@ DEMO_COUNTRIES = [
     # ('NO', 'EUR', 'EMU'),
 ]
 DEMO_DATA_FILENAME = 'band_demo_data.json'
+WHITESPACE = re.compile(r'\s*')
 
+WORLD_BANK_API = 'https://api.worldbank.org/v2/country/all/indicator/'
+FETCH_WORKERS = 4
+FETCH_TIMEOUT = 30
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+RANGE_PER_PAGE = 2000
+INDICATOR_SNAPSHOT_FILENAME = 'indicator_snapshot.bin'
+VERSION_CHECK_SECONDS = 5
+INDICATOR_DATASET_LABEL = re.compile(
+    re.escape(plugin_settings.SHORT_NAME) + r'/[^/]+_\d{4}\.json'
+)
 
+
+class IndicatorCache:
+    """
+    A per-process cache of World Bank indicator data, so that each
+    dataset is only read and parsed once per process.
+    Keys are (indicator, year) tuples and values are dicts
+    of country codes and indicator values, which callers should not mutate.
+    A year of None holds the latest-value index for the indicator.
+    The data is dropped when the configuration version changes.
+    The version is read at most every VERSION_CHECK_SECONDS,
+    so that a warm lookup costs no queries, and other processes'
+    updates are picked up within that time.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.version = None
+        self.version_checked = None
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self):
+        now = time.monotonic()
+        if self.version_checked is not None \
+                and now - self.version_checked < VERSION_CHECK_SECONDS:
+            return
+        version = get_configuration_version()
+        if version != self.version:
+            self.data.clear()
+            self.version = version
+        self.version_checked = now
+
+    def expire_version(self):
+        """
+        Reads the version again on the next lookup
+        """
+        self.version_checked = None
+
+    def get(self, indicator, year, load):
+        """
+        Gets the cached data, calling load(indicator, year) on a miss
+        """
+        self.check_version()
+        key = (indicator, year)
+        if key in self.data:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.data[key] = load(indicator, year)
+        return self.data[key]
+
+    def clear(self):
+        self.data.clear()
+        self.expire_version()
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+        }
+
+
+indicator_cache = IndicatorCache()
+
+# Counts of media file opens, snapshot opens and JSON parses
+# in this process, for benchmarks and instrumentation
+io_counters = collections.Counter()
+
+
+@memo.memoize
+def get_configuration_version():
+    """
+    :return: the current configuration version as an int,
+             read once per memo context
+    """
+    version = models.ConfigurationVersion.objects.filter(
+        pk=1,
+    ).values_list(
+        'version', flat=True,
+    ).first()
+    return version or 0
+
+
+def bump_configuration_version():
+    """
+    Announces that the billing configuration or indicator data
+    has changed, so that caches keyed on the version are dropped.
+    The new version is at least the current time in microseconds,
+    so a version rolled back with its transaction is not reused
+    for different data.
+    """
+    now = timezone.now()
+    floor = int(now.timestamp() * 1000000)
+    values = {
+        'version': Greatest(F('version') + 1, Value(floor)),
+        'updated': now,
+    }
+    updated = models.ConfigurationVersion.objects.filter(pk=1).update(**values)
+    if not updated:
+        _version, created = models.ConfigurationVersion.objects.get_or_create(
+            pk=1,
+            defaults={'version': floor},
+        )
+        if not created:
+            models.ConfigurationVersion.objects.filter(pk=1).update(**values)
+    get_configuration_version.cache_clear()
+    indicator_cache.expire_version()
+
+
+class IndicatorSnapshot:
+    """
+    A read-only, memory-mapped snapshot of all stored indicator data,
+    so that every worker process on a host shares one copy of it
+    in the page cache instead of building its own.
+
+    The file holds a header, a table of (indicator, year) datasets,
+    a sorted index of three-letter country codes, and then for each
+    dataset an array with one fixed-width value per country.
+    Values are stored as ASCII decimal strings so they stay exact.
+    Blank values are missing.
+    """
+
+    MAGIC = b'CBIS'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHII')
+    DATASET = struct.Struct('<30sI')
+    CODE_WIDTH = 3
+
+    def __init__(self, path):
+        io_counters['snapshot_opens'] += 1
+        with open(path, 'rb') as file_ref:
+            self.stat = os.fstat(file_ref.fileno())
+            self.buffer = mmap.mmap(
+                file_ref.fileno(),
+                0,
+                access=mmap.ACCESS_READ,
+            )
+        (
+            magic,
+            version,
+            self.value_width,
+            self.country_count,
+            dataset_count,
+        ) = self.HEADER.unpack_from(self.buffer, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f'{path} is not an indicator snapshot')
+
+        offset = self.HEADER.size
+        self.datasets = {}
+        self.indicators = set()
+        for position in range(dataset_count):
+            indicator, year = self.DATASET.unpack_from(self.buffer, offset)
+            indicator = indicator.rstrip(b'\0').decode()
+            self.datasets[(indicator, year)] = position
+            self.indicators.add(indicator)
+            offset += self.DATASET.size
+        self.index_offset = offset
+        self.values_offset = offset + self.country_count * self.CODE_WIDTH
+
+    def is_same_file(self, stat):
+        return (
+            stat.st_ino == self.stat.st_ino
+            and stat.st_size == self.stat.st_size
+            and stat.st_mtime_ns == self.stat.st_mtime_ns
+        )
+
+    def country_code(self, position):
+        start = self.index_offset + position * self.CODE_WIDTH
+        return self.buffer[start:start + self.CODE_WIDTH]
+
+    def country_position(self, country):
+        """
+        Finds a country in the sorted index by binary search
+        :country: a country or region code such as GBR
+        :return: the position of the country, or None
+        """
+        try:
+            code = str(country).encode('ascii').ljust(self.CODE_WIDTH, b'\0')
+        except UnicodeEncodeError:
+            return None
+        if len(code) != self.CODE_WIDTH:
+            return None
+        low, high = 0, self.country_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.country_code(middle) < code:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.country_count and self.country_code(low) == code:
+            return low
+        return None
+
+    def read_value(self, dataset, position):
+        start = self.values_offset + (
+            dataset * self.country_count + position
+        ) * self.value_width
+        text = self.buffer[start:start + self.value_width].strip()
+        return decimal.Decimal(text.decode()) if text else None
+
+    def value(self, indicator, year, country):
+        """
+        :return: the value as decimal.Decimal, or None if it is missing
+        """
+        dataset = self.datasets.get((indicator, year))
+        if dataset is None:
+            return None
+        position = self.country_position(country)
+        if position is None:
+            return None
+        return self.read_value(dataset, position)
+
+    def values(self, indicator, year):
+        """
+        :return: dict of country codes and values, without missing values
+        """
+        dataset = self.datasets[(indicator, year)]
+        values = {}
+        for position in range(self.country_count):
+            value = self.read_value(dataset, position)
+            if value is not None:
+                code = self.country_code(position).rstrip(b'\0').decode()
+                values[code] = value
+        return values
+
+
+indicator_snapshot = None
+
+
+def indicator_snapshot_path():
+    return os.path.join(
+        settings.MEDIA_ROOT,
+        plugin_settings.SHORT_NAME,
+        INDICATOR_SNAPSHOT_FILENAME,
+    )
+
+
+def get_indicator_snapshot():
+    """
+    Gets the memory-mapped indicator snapshot, reopening it
+    if another process has written a new one since it was opened
+    :return: IndicatorSnapshot, or None if there is no usable snapshot
+    """
+    global indicator_snapshot
+    path = indicator_snapshot_path()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        indicator_snapshot = None
+        return None
+    if indicator_snapshot and indicator_snapshot.is_same_file(stat):
+        return indicator_snapshot
+    try:
+        indicator_snapshot = IndicatorSnapshot(path)
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(e)
+        logger.error(f'...while trying to open {path}')
+        indicator_snapshot = None
+        return None
+
+    # Data cached from the previous snapshot may now be out of date
+    indicator_cache.clear()
+    return indicator_snapshot
+
+
+def write_indicator_snapshot():
+    """
+    Compiles all stored indicator observations into a new snapshot file.
+    The file is written alongside the old one and moved into place,
+    so readers never see a partly written snapshot.
+    If it is the same as the old one, it is discarded.
+    :return: number of datasets in the snapshot
+    """
+    datasets = {}
+    countries = set()
+    observations = models.IndicatorObservation.objects.order_by().values_list(
+        'indicator', 'year', 'country', 'value',
+    )
+    for indicator, year, country, value in observations:
+        try:
+            code = country.encode('ascii')
+        except UnicodeEncodeError:
+            continue
+        if not code or len(code) > IndicatorSnapshot.CODE_WIDTH:
+            continue
+        code = code.ljust(IndicatorSnapshot.CODE_WIDTH, b'\0')
+        countries.add(code)
+        dataset = datasets.setdefault((indicator, year), {})
+        if value is not None:
+            dataset[code] = str(value).encode('ascii')
+
+    countries = sorted(countries)
+    keys = sorted(datasets)
+    value_width = max(
+        [len(value) for dataset in datasets.values()
+         for value in dataset.values()] or [1]
+    )
+    path = indicator_snapshot_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path),
+        prefix=INDICATOR_SNAPSHOT_FILENAME,
+        delete=False,
+    ) as file_ref:
+        file_ref.write(
+            IndicatorSnapshot.HEADER.pack(
+                IndicatorSnapshot.MAGIC,
+                IndicatorSnapshot.VERSION,
+                value_width,
+                len(countries),
+                len(keys),
+            )
+        )
+        for indicator, year in keys:
+            file_ref.write(
+                IndicatorSnapshot.DATASET.pack(indicator.encode(), year)
+            )
+        file_ref.write(b''.join(countries))
+        blank = b' ' * value_width
+        for key in keys:
+            dataset = datasets[key]
+            file_ref.write(
+                b''.join(
+                    dataset[code].ljust(value_width) if code in dataset
+                    else blank for code in countries
+                )
+            )
+        file_ref.flush()
+        os.fsync(file_ref.fileno())
+    if os.path.exists(path) and filecmp.cmp(file_ref.name, path, shallow=False):
+        # Nothing has changed, so the caches are still good
+        os.remove(file_ref.name)
+        return len(keys)
+    os.chmod(file_ref.name, 0o644)
+    os.replace(file_ref.name, path)
+    from plugins.consortial_billing import logic
+    logic.configuration_changed()
+    return len(keys)
+
+
+@memo.memoize
 def setting(name, journal=None):
     group = 'plugin:consortial_billing'
     return setting_handler.get_setting(group, name, journal).processed_value
@@ -62,43 +433,339 @@ def save_media_file(filename, content):
     content_file = ContentFile(content)
     file.uploaded = timezone.now()
     file.file.save(filename, content_file, save=True)
+
+    # Any cached indicator data may now be out of date
+    indicator_cache.clear()
     return file
 
 
-def form_world_bank_url(indicator, year):
-    base = 'https://api.worldbank.org/v2/country/all/indicator/'
-    params = f'?date={year}&format=json&per_page=500'
+def form_world_bank_url(indicator, year, page=None, per_page=500):
+    """
+    :year: YYYY, or a range of years as YYYY:YYYY
+    :page: the page of results to ask for, if not the first
+    """
+    base = WORLD_BANK_API
+    params = f'?date={year}&format=json&per_page={per_page}'
+    if page:
+        params += f'&page={page}'
     return base + indicator + params
 
 
 def save_file_for_indicator_and_year(indicator, year, content):
+    """
+    Saves a World Bank API response and its observations,
+    unless it is identical to the content already saved
+    :indicator: A world bank indicator string such as PA.NUS.FCRF
+    :year: YYYY as int
+    :content: the API response body
+    :return: set of the country codes whose values changed
+    """
+    if isinstance(content, str):
+        content = content.encode()
     filename = os.path.join(
         plugin_settings.SHORT_NAME,
         f'{indicator}_{year}.json',
     )
+    content_hash = hashlib.sha256(content).hexdigest()
+    dataset = models.IndicatorDataset.objects.filter(
+        indicator=indicator,
+        year=year,
+    ).first()
+    if dataset and dataset.content_hash == content_hash and \
+            cms_models.MediaFile.objects.filter(label=filename).exists():
+        dataset.checked = timezone.now()
+        dataset.save()
+        return set()
+
+    old_values = get_observed_values(indicator, year)
     save_media_file(filename, content)
+    save_observations_for_indicator_and_year(indicator, year, content)
+    new_values = get_observed_values(indicator, year)
+
+    # Caches and quotes built from the old values are out of date
+    from plugins.consortial_billing import logic
+    logic.configuration_changed()
+
+    now = timezone.now()
+    models.IndicatorDataset.objects.update_or_create(
+        indicator=indicator,
+        year=year,
+        defaults={
+            'content_hash': content_hash,
+            'updated': now,
+            'checked': now,
+        },
+    )
+    return {
+        country for country in old_values.keys() | new_values.keys()
+        if old_values.get(country) != new_values.get(country)
+    }
+
+
+def get_observed_values(indicator, year):
+    return dict(
+        models.IndicatorObservation.objects.filter(
+            indicator=indicator,
+            year=year,
+        ).values_list(
+            'country', 'value',
+        )
+    )
+
+
+def save_observations_for_indicator_and_year(indicator, year, content):
+    """
+    Replaces the stored observations for an indicator and year
+    with the country values in a World Bank API response
+    :indicator: A world bank indicator string such as PA.NUS.FCRF
+    :year: YYYY as int
+    :content: the API response body
+    :return: number of observations saved
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    try:
+        values = {
+            country: value for country, value
+            in iter_world_bank_values(io.BytesIO(content))
+            if country
+        }
+    except (TypeError, ValueError) as e:
+        logger.error(e)
+        logger.error(f'...while trying to save {indicator} {year} data')
+        return 0
+    if not values:
+        return 0
+
+    with transaction.atomic():
+        models.IndicatorObservation.objects.filter(
+            indicator=indicator,
+            year=year,
+        ).delete()
+        models.IndicatorObservation.objects.bulk_create(
+            models.IndicatorObservation(
+                indicator=indicator,
+                country=country,
+                year=year,
+                value=value,
+            ) for country, value in values.items()
+        )
+    indicator_cache.clear()
+    return len(values)
+
+
+def rebuild_latest_indicator_values(indicator):
+    """
+    Rebuilds the index of each country's latest non-empty value
+    for an indicator from the stored observations
+    :indicator: A world bank indicator string such as PA.NUS.FCRF
+    :return: number of countries indexed
+    """
+    observations = models.IndicatorObservation.objects.filter(
+        indicator=indicator,
+        value__isnull=False,
+    ).exclude(
+        value=0,
+    ).order_by(
+        'country', '-year',
+    ).values_list(
+        'country', 'year', 'value',
+    )
+    latest = {}
+    for country, year, value in observations:
+        latest.setdefault(country, (year, value))
+
+    with transaction.atomic():
+        models.LatestIndicatorValue.objects.filter(
+            indicator=indicator,
+        ).delete()
+        models.LatestIndicatorValue.objects.bulk_create(
+            models.LatestIndicatorValue(
+                indicator=indicator,
+                country=country,
+                year=year,
+                value=value,
+            ) for country, (year, value) in latest.items()
+        )
+    indicator_cache.clear()
+    from plugins.consortial_billing import logic
+    logic.configuration_changed()
+    return len(latest)
 
 
-def fetch_world_bank_data(indicator, year):
+def fetch_world_bank_data(indicator, year, changes=None):
     """
     Gets API data and calls save_media_file if status is 200
     :indicator: A world bank indicator string such as PA.NUS.FCRF
     :year: YYYY as int
+    :changes: optional dict to fill with (indicator, year) -> set of
+              the country codes whose values changed
     :return: status code
     """
     url = form_world_bank_url(indicator, year)
     response = requests.get(url)
     if response.status_code == 200:
-        save_file_for_indicator_and_year(indicator, year, response.content)
+        changed = save_file_for_indicator_and_year(
+            indicator,
+            year,
+            response.content,
+        )
+        if changes is not None:
+            changes[(indicator, year)] = changed
     return response.status_code
 
 
+def world_bank_session(pool_size=FETCH_WORKERS, retries=None, backoff=None):
+    """
+    Makes a requests session with a connection pool for the World Bank API
+    that retries failed requests with exponential backoff
+    """
+    retry = Retry(
+        total=FETCH_RETRIES if retries is None else retries,
+        backoff_factor=FETCH_BACKOFF if backoff is None else backoff,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET'],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetch_world_bank_datasets(
+        indicators,
+        years,
+        workers=FETCH_WORKERS,
+        timeout=FETCH_TIMEOUT,
+        session=None,
+        changes=None,
+    ):
+    """
+    Gets API data for several indicators and years in parallel over
+    one pooled session. Each indicator is requested as one range of years,
+    following pagination, and the records are split into one saved
+    dataset per year. Only the network requests run concurrently:
+    responses are read and saved by the calling thread.
+    :indicators: World Bank indicator strings such as PA.NUS.FCRF
+    :years: YYYY as ints
+    :workers: the maximum number of requests in flight at once
+    :timeout: seconds to wait for each response
+    :changes: optional dict to fill with (indicator, year) -> set of
+              the country codes whose values changed
+    :return: dict of (indicator, year) -> status code,
+             or None where the request failed outright
+    """
+    if not session:
+        session = world_bank_session(pool_size=workers)
+    date_range = f'{min(years)}:{max(years)}'
+    records = {
+        (indicator, year): [] for indicator in indicators for year in years
+    }
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def request_page(indicator, page):
+            url = form_world_bank_url(
+                indicator,
+                date_range,
+                page=page,
+                per_page=RANGE_PER_PAGE,
+            )
+            return executor.submit(session.get, url, timeout=timeout)
+
+        pending = {
+            request_page(indicator, 1): (indicator, 1)
+            for indicator in indicators
+        }
+        while pending:
+            done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                indicator, page = pending.pop(future)
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    logger.error(e)
+                    logger.error(f'...while trying to fetch {indicator} data')
+                    failures[indicator] = None
+                    continue
+                if response.status_code != 200:
+                    failures[indicator] = response.status_code
+                    continue
+                metadata = {}
+                for record, text in iter_world_bank_records(
+                    io.BytesIO(response.content),
+                    metadata=metadata,
+                ):
+                    key = (indicator, record_year(record))
+                    if key in records:
+                        records[key].append((page, text))
+                if page == 1:
+                    pages = int(metadata.get('pages') or 1)
+                    for next_page in range(2, pages + 1):
+                        pending[request_page(indicator, next_page)] = (
+                            indicator, next_page
+                        )
+
+    status_codes = {}
+    for (indicator, year), page_texts in records.items():
+        if indicator in failures:
+            status_codes[(indicator, year)] = failures[indicator]
+        elif not page_texts:
+            status_codes[(indicator, year)] = 204
+        else:
+            # Pages arrive in any order, but the saved content has to
+            # be the same each time, so that unchanged data is a no-op
+            page_texts.sort(key=lambda page_text: page_text[0])
+            changed = save_file_for_indicator_and_year(
+                indicator,
+                year,
+                join_world_bank_records(
+                    [text for _page, text in page_texts]
+                ),
+            )
+            if changes is not None:
+                changes[(indicator, year)] = changed
+            status_codes[(indicator, year)] = 200
+    return status_codes
+
+
+def record_year(record):
+    try:
+        return int(record.get('date'))
+    except (TypeError, ValueError):
+        return None
+
+
+def join_world_bank_records(texts):
+    """
+    Puts records back together as a single-page World Bank API response,
+    keeping the JSON of each record exactly as it was received
+    :texts: JSON strings
+    :return: bytes
+    """
+    metadata = {
+        'page': 1,
+        'pages': 1,
+        'per_page': len(texts),
+        'total': len(texts),
+    }
+    return f'[{json.dumps(metadata)},[{",".join(texts)}]]'.encode()
+
+
 def load_json_with_decimals(file_ref):
     """
     Loads a JSON media file with decimals for all numbers.
     :file_ref: An open file reference
     :returns: Python-loaded JSON with decimal.Decimal for numbers
     """
+    io_counters['json_parses'] += 1
     return json.loads(
         file_ref.read(),
         parse_float=decimal.Decimal,
@@ -106,6 +773,100 @@ def load_json_with_decimals(file_ref):
     )
 
 
+def iter_world_bank_records(file_ref, chunk_size=8192, metadata=None):
+    """
+    Streams records from a World Bank API response one at a time,
+    without loading the whole document. Numbers are left as strings.
+    :file_ref: An open file reference, in text or binary mode
+    :chunk_size: how much to read at a time
+    :metadata: an optional dict to fill with the response metadata
+    :yield: tuples of the decoded record and its JSON text as received
+    """
+    io_counters['json_parses'] += 1
+    decoder = json.JSONDecoder(parse_float=str, parse_int=str)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    exhausted = False
+
+    def read_more():
+        nonlocal buffer, position, exhausted
+        chunk = file_ref.read(chunk_size)
+        if not chunk:
+            exhausted = True
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk, final=exhausted)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def peek():
+        # Skips whitespace and returns the next character,
+        # or an empty string at the end of the document
+        nonlocal position
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer):
+                return buffer[position]
+            if exhausted:
+                return ''
+            read_more()
+
+    def decode_next():
+        nonlocal position
+        while True:
+            start = position
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+                return value, buffer[start:position]
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                read_more()
+
+    # The response is a list of metadata followed by a list of records,
+    # but error responses and empty years leave out the records.
+    if peek() != '[':
+        return
+    position += 1
+    if peek() != '{':
+        return
+    response_metadata, _text = decode_next()
+    if metadata is not None:
+        metadata.update(response_metadata)
+    if peek() != ',':
+        return
+    position += 1
+    if peek() != '[':
+        return
+    position += 1
+    while peek() not in [']', '']:
+        yield decode_next()
+        if peek() == ',':
+            position += 1
+
+
+def iter_world_bank_values(file_ref, chunk_size=8192):
+    """
+    Streams country codes and values from a World Bank API response,
+    converting only the values it keeps to decimal.Decimal.
+    :file_ref: An open file reference, in text or binary mode
+    :chunk_size: how much to read at a time
+    :yield: tuples of country code and decimal.Decimal or None,
+            skipping records whose value is not a number
+    """
+    for record, _text in iter_world_bank_records(file_ref, chunk_size):
+        country = record.get('countryiso3code')
+        value = record.get('value')
+        if value is not None:
+            try:
+                value = decimal.Decimal(value)
+            except (decimal.InvalidOperation, ValueError) as e:
+                logger.error(e)
+                logger.error(f'...while trying to read the value for {country}')
+                continue
+        yield country, value
+
+
 def open_json_media_file(filename):
     """
     Opens a JSON file saved as a Janeway media file.
@@ -113,6 +874,7 @@ def open_json_media_file(filename):
     """
     try:
         file = cms_models.MediaFile.objects.get(label=filename)
+        io_counters['media_file_opens'] += 1
         with file.file.open('r') as file_ref:
             return load_json_with_decimals(file_ref)
     except cms_models.MediaFile.DoesNotExist as e:
@@ -121,6 +883,33 @@ def open_json_media_file(filename):
         return []
 
 
+def open_saved_indicator_values(
+        indicator: str,
+        year: int,
+    ) -> dict[str, decimal.Decimal]:
+    """
+    Streams the country values out of saved API data for indicator
+    :indicator: A world bank indicator string such as PA.NUS.FCRF
+    :return: dict of country codes and decimal.Decimal values
+    """
+    filename = os.path.join(
+        plugin_settings.SHORT_NAME,
+        f'{indicator}_{year}.json',
+    )
+    try:
+        file = cms_models.MediaFile.objects.get(label=filename)
+        io_counters['media_file_opens'] += 1
+        with file.file.open('rb') as file_ref:
+            return dict(iter_world_bank_values(file_ref))
+    except cms_models.MediaFile.DoesNotExist as e:
+        logger.error(e)
+        logger.error(f'...while trying to load {filename}')
+    except ValueError as e:
+        logger.error(e)
+        logger.error(f'...while trying to read {filename}')
+    return {}
+
+
 def open_saved_world_bank_data(indicator: str, year: int) -> List:
     """
     Opens saved API data for indicator
@@ -135,15 +924,18 @@ def open_saved_world_bank_data(indicator: str, year: int) -> List:
     return open_json_media_file(filename)
 
 
-def get_abstract_band(size, level, country, currency):
+def get_abstract_band(size, level, country, currency, fee_calculator=None):
     from plugins.consortial_billing import forms
-    band_form = forms.BandForm({
-        'size': size,
-        'level': level,
-        'country': country,
-        'currency': currency,
-        'category': 'calculated',
-    })
+    band_form = forms.BandForm(
+        {
+            'size': size,
+            'level': level,
+            'country': country,
+            'currency': currency,
+            'category': 'calculated',
+        },
+        fee_calculator=fee_calculator,
+    )
     if not band_form.is_valid():
         logger.error(band_form.errors)
     return band_form.save(commit=False)
@@ -170,6 +962,7 @@ def iter_demo_countries():
         return DEMO_COUNTRIES
 
 
+@memo.memoize
 def get_standard_support_level():
     """
     :return: SupportLevel object or None
@@ -186,7 +979,8 @@ def get_standard_support_level():
         return models.SupportLevel.objects.all().last()
 
 
-def make_table_of_higher_supporters_by_country_and_level():
+def make_table_of_higher_supporters_by_country_and_level(fixed_point=False):
+    from plugins.consortial_billing import logic
     standard_level = get_standard_support_level()
     levels = models.SupportLevel.objects.exclude(
         pk=standard_level.pk
@@ -199,13 +993,20 @@ def make_table_of_higher_supporters_by_country_and_level():
         data['thead'].append(str(level))
 
     data['tbody'] = {}
+    fee_calculator = logic.FeeCalculator(fixed_point=fixed_point)
     for country, curr_code, region in iter_demo_countries():
         currency, _ = models.Currency.objects.get_or_create(
             code=curr_code,
             region=region,
         )
         for level in levels:
-            band = get_abstract_band(size, level, country, currency)
+            band = get_abstract_band(
+                size,
+                level,
+                country,
+                currency,
+                fee_calculator=fee_calculator,
+            )
             country_name = short_country_name(band.country)
             if country_name not in data['tbody']:
                 data['tbody'][country_name] = {}
@@ -218,7 +1019,8 @@ def make_table_of_higher_supporters_by_country_and_level():
     return data
 
 
-def make_table_of_standard_supporters_by_country_and_size():
+def make_table_of_standard_supporters_by_country_and_size(fixed_point=False):
+    from plugins.consortial_billing import logic
     sizes = models.SupporterSize.objects.all().order_by('multiplier')
     standard_level = get_standard_support_level()
 
@@ -228,13 +1030,20 @@ def make_table_of_standard_supporters_by_country_and_size():
         data['thead'].append(str(size))
 
     data['tbody'] = {}
+    fee_calculator = logic.FeeCalculator(fixed_point=fixed_point)
     for country, curr_code, region in iter_demo_countries():
         currency, _ = models.Currency.objects.get_or_create(
             code=curr_code,
             region=region,
         )
         for size in sizes:
-            band = get_abstract_band(size, standard_level, country, currency)
+            band = get_abstract_band(
+                size,
+                standard_level,
+                country,
+                currency,
+                fee_calculator=fee_calculator,
+            )
             country_name = short_country_name(band.country)
             if country_name not in data['tbody']:
                 data['tbody'][country_name] = {}
@@ -247,7 +1056,8 @@ def make_table_of_standard_supporters_by_country_and_size():
     return data
 
 
-def make_table_showing_all_levels_by_country_and_size():
+def make_table_showing_all_levels_by_country_and_size(fixed_point=False):
+    from plugins.consortial_billing import logic
     levels = models.SupportLevel.objects.all().order_by('-order')
 
     data = {}
@@ -256,6 +1066,7 @@ def make_table_showing_all_levels_by_country_and_size():
         data['thead'].append(level.name)
 
     data['tbody'] = {}
+    fee_calculator = logic.FeeCalculator(fixed_point=fixed_point)
     for size in models.SupporterSize.objects.all().order_by('multiplier'):
         size_display = str(size)
         data['tbody'][size_display] = {}
@@ -265,7 +1076,13 @@ def make_table_showing_all_levels_by_country_and_size():
                     code=curr_code,
                     region=region,
                 )
-                band = get_abstract_band(size, level, country, currency)
+                band = get_abstract_band(
+                    size,
+                    level,
+                    country,
+                    currency,
+                    fee_calculator=fee_calculator,
+                )
                 country_name = short_country_name(band.country)
                 if country_name not in data['tbody'][size_display]:
                     data['tbody'][size_display][country_name] = {}
@@ -278,15 +1095,22 @@ def make_table_showing_all_levels_by_country_and_size():
     return data
 
 
-def generate_new_demo_data():
+def generate_new_demo_data(fixed_point=False):
     return [
-        make_table_of_higher_supporters_by_country_and_level(),
-        make_table_of_standard_supporters_by_country_and_size()
+        make_table_of_higher_supporters_by_country_and_level(
+            fixed_point=fixed_point,
+        ),
+        make_table_of_standard_supporters_by_country_and_size(
+            fixed_point=fixed_point,
+        ),
     ]
 
 
-def update_demo_band_data():
-    data_json = json.dumps(generate_new_demo_data(), separators=(',', ':'))
+def update_demo_band_data(fixed_point=False):
+    data_json = json.dumps(
+        generate_new_demo_data(fixed_point=fixed_point),
+        separators=(',', ':'),
+    )
     filename = os.path.join(plugin_settings.SHORT_NAME, DEMO_DATA_FILENAME)
     return save_media_file(filename, data_json)
 
@@ -10,7 +10,7 @@ from django.views.decorators.http import require_POST
 from django.utils.decorators import method_decorator
 from django.template import Template, RequestContext
 
-from plugins.consortial_billing import utils, \
+from plugins.consortial_billing import utils, memo, costs, \
      logic, models as supporter_models, plugin_settings, forms
 from plugins.consortial_billing.notifications import notify
 
@@ -49,16 +49,21 @@ def get_next_step(previous_step, default='1'):
 
 
 @staff_member_required
+@memo.memo_context()
+@costs.cost_context('manager')
 def manager(request):
 
     if request.POST:
         if 'fetch_data' in request.POST:
             indicator = request.POST.get('fetch_data', None)
-            call_command('fetch_world_bank_data', indicator)
+            call_command('fetch_world_bank_data', indicator, parallel=True)
 
         elif 'update_demo' in request.POST:
             call_command('update_demo_band_data')
 
+        elif 'build_fee_quotes' in request.POST:
+            call_command('build_fee_quotes')
+
     base_bands = logic.get_base_bands()
 
     latest_gni_data = logic.latest_dataset_for_indicator(
@@ -77,6 +82,22 @@ def manager(request):
         rate = rate.quantize(decimal.Decimal('1.000'))
         currencies.append((rate, curr.code))
 
+    # Show which year each country's latest figure comes from
+    latest_gni_values = logic.get_latest_indicator_values(
+        plugin_settings.DISPARITY_INDICATOR,
+    )
+    latest_rate_values = logic.get_latest_indicator_values(
+        plugin_settings.RATE_INDICATOR,
+    )
+    data_years = []
+    base_countries = {band.country for band in base_bands if band.country}
+    for country in sorted(base_countries, key=lambda country: country.name):
+        year, _value = latest_gni_values.get(country.alpha3, (None, None))
+        data_years.append((f'GNI per capita, {country.name}', year))
+    for curr in supporter_models.Currency.objects.all():
+        year, _value = latest_rate_values.get(curr.region, (None, None))
+        data_years.append((f'Exchange rate, {curr.code}', year))
+
     context = {
         'plugin': plugin_settings.SHORT_NAME,
         'supporters': supporter_models.Supporter.objects.all(),
@@ -84,10 +105,20 @@ def manager(request):
         'sizes': supporter_models.SupporterSize.objects.all(),
         'levels': supporter_models.SupportLevel.objects.all(),
         'currencies': currencies,
+        'data_years': data_years,
         'base_bands': base_bands,
         'latest_gni_data': latest_gni_data,
         'latest_exchange_rate_data': latest_exchange_rate_data,
         'latest_demo_data': latest_demo_data,
+        'fee_quotes_built': logic.fee_quotes_built(),
+        'fee_quote_count': logic.current_fee_quotes().count(),
+        'stale_fee_quote_count': supporter_models.FeeQuote.objects.exclude(
+            version=utils.get_configuration_version(),
+        ).count(),
+        'fee_costs': costs.get_cost_summary(),
+        'recalculation_runs': supporter_models.RecalculationRun.objects.order_by(
+            '-started',
+        )[:5],
         'settings': settings,
         'plugin_settings': plugin_settings,
     }
@@ -98,6 +129,8 @@ def manager(request):
 
 
 @base_check_required
+@memo.memo_context()
+@costs.cost_context('signup')
 def signup(request):
 
     band_form = forms.BandForm()
@@ -325,6 +358,8 @@ class SupporterList(GenericFacetedListView):
 
 
 @staff_member_required
+@memo.memo_context()
+@costs.cost_context('edit_supporter_band')
 def edit_supporter_band(request, supporter_id=None):
 
     supporter = None